@@ -0,0 +1,280 @@
+from functools import partial
+import logging
+import struct
+import time
+
+import numpy as np
+
+from pvchan import PvMqttChan
+
+import unittest
+from testfakes import Client, PutPipe, make_chan
+
+
+logger = logging.getLogger(__name__)
+
+# predefined constants
+AGGREGATE_TICK = 0.1 # seconds between frames
+AGGREGATE_TYPES = { # item types of aggregate frames
+    "int": ">i4",
+    "double": ">f8",
+}
+
+# Aggregate frame
+#   (count: int32, time: float64, updated items bitmask, items), all big-endian,
+#   bitmask has a bit for each item (np.packbits order), receiver puts updated items only
+AGG_HEADER = ">id" # item count, time
+AGG_HEADER_SIZE = struct.calcsize(AGG_HEADER)
+
+
+# Aggregate converter
+#   value is (items, updated, known) where 'updated' marks items changed since
+#   the previous frame and 'known' the ones received at least once;
+#   first frame and frames after reset of 'prev' mark all known items updated,
+#   so last value cache restores the whole state (see LastValue)
+class AggregateConv:
+    segmented = False
+    changed = True # frames are patches to previous ones
+
+    def __init__(self, datatype, count):
+        if datatype not in AGGREGATE_TYPES:
+            raise TypeError("Unknown aggregate item type '%s'" % datatype)
+        self.dtype = np.dtype(AGGREGATE_TYPES[datatype])
+        self.count = count
+        self.masksize = (count + 7)//8
+        self.size = AGG_HEADER_SIZE + self.masksize + count*self.dtype.itemsize
+        self.prev = None # a frame was sent
+
+    def encode(self, topic, value):
+        items, updated, known = value
+        if self.prev is None:
+            updated = known
+        self.prev = True
+        buf = bytearray(self.size)
+        struct.pack_into(AGG_HEADER, buf, 0, self.count, time.time())
+        buf[AGG_HEADER_SIZE:AGG_HEADER_SIZE + self.masksize] = np.packbits(updated).tobytes()
+        np.frombuffer(buf, self.dtype, self.count, AGG_HEADER_SIZE + self.masksize)[:] = items
+        return [(topic, buf)]
+
+    # returns (items, updated)
+    def decode(self, topic, payload):
+        if len(payload) != self.size:
+            raise ValueError("Aggregate frame size is %d, %d expected" % (len(payload), self.size))
+        count, stamp = struct.unpack_from(AGG_HEADER, payload)
+        if count != self.count:
+            raise ValueError("Aggregate frame has %d items, %d expected" % (count, self.count))
+        mask = np.frombuffer(payload, np.uint8, self.masksize, AGG_HEADER_SIZE)
+        updated = np.unpackbits(mask)[:count].astype(bool)
+        items = np.frombuffer(payload, self.dtype, count, AGG_HEADER_SIZE + self.masksize)
+        return items, updated
+
+
+# Aggregate state
+#   last values of aggregated PVs collected between frames
+class AggregateState:
+    def __init__(self, conv):
+        self.items = np.zeros(conv.count, conv.dtype.newbyteorder("="))
+        self.updated = np.zeros(conv.count, bool)
+        self.known = np.zeros(conv.count, bool)
+        self.first = None # time of the first update since the previous frame
+
+    def update(self, index, value):
+        self.items[index] = value
+        self.updated[index] = True
+        self.known[index] = True
+        if self.first is None:
+            self.first = time.time()
+
+    # returns (first update time, frame value) or None if nothing was updated
+    def frame(self):
+        if self.first is None:
+            return None
+        frame = (self.first, (self.items.copy(), self.updated.copy(), self.known.copy()))
+        self.updated[:] = False
+        self.first = None
+        return frame
+
+
+# Aggregate channel
+#   connects a list of scalar PVs with one MQTT topic,
+#   pm: updates are collected and published as one frame each 'tick' seconds,
+#   mp: updated items of received frames are put to their PVs;
+#   connection is like a scalar one but with a list of PVs in "pv",
+#   "datatype" is an item type of AGGREGATE_TYPES ("int" by default)
+class AggregateChan(PvMqttChan):
+    def __init__(self,connection,servers,client,pubpool,flow,putpipe=None,recorder=None,decodepool=None):
+        self.tick = connection.get("tick", AGGREGATE_TICK)
+        PvMqttChan.__init__(self,connection,servers,client,pubpool,flow,putpipe,recorder,decodepool)
+        self.iocs = [servers.ioc(pv) for pv in self.pvs]
+        self.state = AggregateState(self.conv)
+
+    def converter(self):
+        return AggregateConv(self.datatype or "int", len(self.pvs))
+
+    def setConnection(self):
+        if self.closed:
+            return
+        if self.direction=="pm":
+            import cothread
+            import cothread.catools as catools
+            self.monitor = catools.camonitor(self.pvs, self.pushValue)
+            cothread.Spawn(self._ticker)
+            logger.info("(%s, %s) connection set" % (self.pv, self.chan))
+        else:
+            PvMqttChan.setConnection(self)
+
+    def close(self):
+        if self.monitor is not None:
+            for monitor in self.monitor:
+                monitor.close()
+            self.monitor = None
+        PvMqttChan.close(self)
+
+    def _ticker(self):
+        import cothread
+        while not self.closed:
+            cothread.Sleep(self.tick)
+            self.flush()
+
+    # called by camonitor of PV 'index' in cothread
+    def pushValue(self, value, index):
+        logger.debug("ca: received from %s", self.pvs[index])
+        if self.recorder is not None:
+            self.recorder.ca(self.pvs[index], value)
+        self.state.update(index, value)
+
+    # queues a frame of values updated since the previous one
+    def flush(self):
+        frame = self.state.frame()
+        if frame is not None:
+            self.queue.put(frame)
+
+    def updatePv(self, topic, payload):
+        if self.closed:
+            return
+        logger.debug("ca: send to %s", self.pv)
+        self.metrics.received += 1
+        try:
+            frame = self.conv.decode(topic, payload)
+            if not self.last.decoded(frame):
+                logger.debug("ca: %s unchanged after resubscribing", self.pv)
+                return
+            items, updated = frame
+            for index in np.flatnonzero(updated):
+                if self.iocs[index].allow():
+                    self.putpipe.put(self.pvs[index], items[index].item(), partial(self.memberDone, index))
+                else:
+                    self.metrics.skipped += 1
+        except Exception as e:
+            self.metrics.errors += 1
+            logger.error("Trouble in updatePv with %s: %s", self.chan, e, extra={"ratekey": self.chan})
+            logger.debug("Traceback of updatePv with %s", self.chan, exc_info=True, extra={"ratekey": self.chan})
+
+    def memberDone(self, index, ok):
+        if ok:
+            self.iocs[index].success()
+            self.metrics.published += 1
+        else:
+            self.iocs[index].failure()
+            self.metrics.errors += 1
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def _chan(self, direction, pvs, **kw):
+        from pubflow import FlowControl
+        connection = {"mqtt": u"dev/agg", "pv": pvs, "direction": direction}
+        connection.update(kw)
+        self.client = Client()
+        self.putpipe = PutPipe()
+        return make_chan(AggregateChan, connection, self.client, FlowControl(window=4), self.putpipe)
+
+    def test_conv(self):
+        conv = AggregateConv("double", 10)
+        items = np.arange(10)*0.5
+        updated = np.zeros(10, bool)
+        updated[[1, 9]] = True
+        (topic, payload), = conv.encode("t", (items, updated, np.ones(10, bool)))
+        self.assertEqual(len(payload), 12 + 2 + 80)
+        back, mask = conv.decode(topic, bytes(payload))
+        self.assertTrue(np.array_equal(back, items))
+        # first frame has all known items
+        self.assertTrue(mask.all())
+        (topic, payload), = conv.encode("t", (items, updated, np.ones(10, bool)))
+        back, mask = conv.decode(topic, bytes(payload))
+        self.assertEqual(list(np.flatnonzero(mask)), [1, 9])
+
+    def test_conv_err(self):
+        with self.assertRaises(TypeError):
+            AggregateConv("string", 2)
+        conv = AggregateConv("int", 3)
+        with self.assertRaises(ValueError):
+            conv.decode("t", b"\x00"*10)
+        (topic, payload), = AggregateConv("int", 3).encode("t", (np.zeros(3), np.ones(3, bool), np.ones(3, bool)))
+        payload[3] = 4 # count
+        with self.assertRaises(ValueError):
+            conv.decode(topic, bytes(payload))
+
+    def test_pm(self):
+        chan = self._chan(u"pm", [u"A", u"B", u"C"])
+        self.assertEqual((chan.pv, chan.subTopic()), ("A,B,C", "dev/agg"))
+        chan.flush()
+        self.assertEqual(self.client.pubs, [])
+        for i in range(10):
+            chan.pushValue(i, 0)
+        chan.pushValue(7, 2)
+        chan.flush()
+        chan.flush()
+        chan.pushValue(5, 1)
+        chan.flush()
+        self.assertEqual(len(self.client.pubs), 2)
+        rx = AggregateConv("int", 3)
+        items, updated = rx.decode(*self.client.pubs[0])
+        self.assertEqual((list(items), list(updated)), ([9, 0, 7], [True, False, True]))
+        items, updated = rx.decode(*self.client.pubs[1])
+        self.assertEqual((list(items), list(updated)), ([9, 5, 7], [False, True, False]))
+        # restored after reconnect with all known items
+        items, updated = rx.decode(*chan.last.restore(chan.chan)[0])
+        self.assertEqual(list(updated), [True, True, True])
+
+    def test_mp(self):
+        chan = self._chan(u"mp", [u"A", u"FAIL", u"C"], datatype=u"double")
+        tx = AggregateConv("double", 3)
+        updated = np.array([True, True, False])
+        for topic, payload in tx.encode("dev/agg", (np.array([1.5, 2.5, 3.5]), updated, updated)):
+            chan.updatePv(topic, bytes(payload))
+        self.assertEqual(self.putpipe.puts, [("A", 1.5), ("FAIL", 2.5)])
+        self.assertEqual((chan.metrics.published, chan.metrics.errors), (1, 1))
+
+    def test_mp_decodepool(self):
+        # frames are decoded by pool workers in order of arrival
+        from pubpool import PublishPool
+        import threading
+        pool = PublishPool(2)
+        putpipe = PutPipe()
+        threads = set()
+        put = putpipe.put
+        def track(pv, value, callback):
+            threads.add(threading.current_thread())
+            put(pv, value, callback)
+        putpipe.put = track
+        connection = {"mqtt": u"dev/agg", "pv": [u"A", u"B"], "direction": u"mp"}
+        chan = make_chan(AggregateChan, connection, putpipe=putpipe, decodepool=pool)
+        tx = AggregateConv("int", 2)
+        mask = np.array([True, False])
+        for i in range(100):
+            for topic, payload in tx.encode("dev/agg", (np.array([i, 0]), mask, mask)):
+                chan.receive(topic, bytes(payload))
+        self.assertEqual(putpipe.puts, [])
+        pool.start()
+        try:
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertEqual(putpipe.puts, [("A", i) for i in range(100)])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(chan.metrics.values()["received"], 100)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,232 @@
+from threading import Thread, Lock
+import logging
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import unittest
+
+
+# predefined constants
+LOG_QUEUE_SIZE = 10000 # records
+RATE_PERIOD = 10.0 # seconds
+RATE_BURST = 5 # records of one kind passed per period
+
+# argument types that can't change until the record is formatted
+_IMMUTABLE = (str, int, float, bool, type(None))
+try:
+    _IMMUTABLE += (unicode, long)
+except NameError:
+    pass
+
+
+# Asynchronous log handler
+#   puts records into a bounded queue, a background thread passes them
+#   to the target handlers, so logging threads never wait for I/O;
+#   records are dropped and counted when the queue is full
+class AsyncHandler(logging.Handler):
+    def __init__(self, handlers, size=LOG_QUEUE_SIZE, tick=1.0):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = queue.Queue(size)
+        self.tick = tick # seconds between rate limit summaries
+        self.dropped = 0
+        self.thread = Thread(target=self._loop)
+        self.thread.daemon = True
+        self.running = False
+
+    def prepare(self, record):
+        # message is merged here only if its arguments may change later
+        if record.args and not all(isinstance(a, _IMMUTABLE) for a in record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _dispatch(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _summary(self):
+        for f in self.filters:
+            if hasattr(f, "summary"):
+                for record in f.summary():
+                    self._dispatch(record)
+
+    def _loop(self):
+        last = time.time()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.tick)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                if record is self:
+                    return
+                self._dispatch(record)
+            if time.time() - last >= self.tick:
+                last = time.time()
+                self._summary()
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    # writes queued records and stops the thread
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.queue.put(self)
+            self.thread.join()
+            self._summary()
+            for handler in self.handlers:
+                handler.flush()
+
+
+# Rate limit filter
+#   passes at most 'burst' records of one kind per 'period',
+#   the kind is logger, level, message template and optional 'ratekey'
+#   given with extra={"ratekey": ...} (e.g. channel name);
+#   records of level below 'level' are not limited,
+#   summary() makes records reporting suppressed counts of passed periods,
+#   if it is not called in time, the next passed record reports them
+class RateLimitFilter(logging.Filter):
+    def __init__(self, period=RATE_PERIOD, burst=RATE_BURST, level=logging.WARNING, clock=time.time):
+        logging.Filter.__init__(self)
+        self.period = period
+        self.burst = burst
+        self.level = level
+        self.clock = clock
+        self.lock = Lock()
+        self.kinds = {} # kind -> [window start, count, suppressed, last record]
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        kind = (record.name, record.levelno, record.msg, getattr(record, "ratekey", None))
+        now = self.clock()
+        with self.lock:
+            state = self.kinds.get(kind)
+            if state is None or now - state[0] >= self.period:
+                self.kinds[kind] = [now, 1, 0, None]
+                if state is not None and state[2] > 0:
+                    # not reported by summary() yet
+                    record.msg = "%s (%d similar messages suppressed)" % (record.msg, state[2])
+                return True
+            if state[1] < self.burst:
+                state[1] += 1
+                return True
+            state[2] += 1
+            state[3] = record
+            self.suppressed += 1
+            return False
+
+    def summary(self):
+        now = self.clock()
+        records = []
+        with self.lock:
+            for kind, state in list(self.kinds.items()):
+                if now - state[0] < self.period:
+                    continue
+                if state[2] > 0:
+                    last = state[3]
+                    records.append(logging.makeLogRecord({
+                        "name": last.name, "levelno": last.levelno, "levelname": last.levelname,
+                        "msg": "%d similar messages suppressed in %.0f s, last one: %s",
+                        "args": (state[2], now - state[0], last.getMessage()),
+                    }))
+                del self.kinds[kind]
+        return records
+
+
+# Unittests
+class _Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class Test(unittest.TestCase):
+    def _logger(self, handler):
+        logger = logging.getLogger("asynclog.test")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+        logger.addHandler(handler)
+        return logger
+
+    def test_async(self):
+        target = _Handler()
+        handler = AsyncHandler([target])
+        handler.start()
+        logger = self._logger(handler)
+        value = [1]
+        for i in range(100):
+            logger.debug("value %s %d", value, i)
+        value.append(2) # message must be merged before this
+        try:
+            raise RuntimeError("test")
+        except RuntimeError:
+            logger.error("failed", exc_info=True)
+        handler.stop()
+        self.assertEqual(len(target.records), 101)
+        self.assertEqual(target.records[0].getMessage(), "value [1] 0")
+        self.assertIn("RuntimeError: test", target.records[-1].exc_text)
+
+    def test_full(self):
+        target = _Handler()
+        handler = AsyncHandler([target], size=10)
+        logger = self._logger(handler)
+        for i in range(15):
+            logger.info("x %d", i)
+        self.assertEqual(handler.dropped, 5)
+        handler.start()
+        handler.stop()
+        self.assertEqual(len(target.records), 10)
+
+    def test_rate(self):
+        now = [0.0]
+        target = _Handler()
+        rate = RateLimitFilter(period=10.0, burst=2, clock=lambda: now[0])
+        target.addFilter(rate)
+        logger = self._logger(target)
+        for i in range(5):
+            logger.error("Trouble with %s: %s", "a", i, extra={"ratekey": "a"})
+            logger.error("Trouble with %s: %s", "b", i, extra={"ratekey": "b"})
+        logger.debug("not limited")
+        self.assertEqual(len(target.records), 5)
+        self.assertEqual(rate.suppressed, 6)
+        self.assertEqual(rate.summary(), [])
+        now[0] = 10.0
+        summary = rate.summary()
+        self.assertEqual(len(summary), 2)
+        self.assertIn("3 similar messages suppressed in 10 s, last one: Trouble with ", summary[0].getMessage())
+        logger.error("Trouble with %s: %s", "a", 5, extra={"ratekey": "a"})
+        self.assertEqual(len(target.records), 6)
+        for i in range(3):
+            logger.error("Trouble with %s: %s", "a", 6 + i, extra={"ratekey": "a"})
+        now[0] = 20.0
+        logger.error("Trouble with %s: %s", "a", 9, extra={"ratekey": "a"})
+        self.assertEqual(target.records[-1].getMessage(), "Trouble with a: 9 (2 similar messages suppressed)")
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,640 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import resource
+import struct
+import threading
+import time
+import timeit
+
+import numpy as np
+
+import mqttconv
+from mqttroute import TopicRouter
+from pubflow import FlowControl, wire_payload
+from pubpool import PublishPool
+from pvfilter import Downsample, DOWNSAMPLE_MEAN, DOWNSAMPLE_MINMAX, DOWNSAMPLE_STRIDE
+from health import ServerHealth
+from pvchan import PvMqttChan
+from aggregate import AggregateChan
+from wfaccum import WfAccum
+
+
+CONV_CFG = {
+    "segment_size_max": 1208,
+    "segment_index_digits": 3,
+    "waveform_queue_size": 3,
+}
+
+# Benchmark results are lists of records:
+#   {"bench": name, "case": case description, "metrics": {metric: number, ...}}
+def record(bench, case, **metrics):
+    return {"bench": bench, "case": case, "metrics": metrics}
+
+def best(func, number, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat))/number
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+# Routing dispatch benchmark
+#   compares the old linear channel scan with TopicRouter
+#   for a growing number of channels
+
+class _Chan:
+    def __init__(self, chan):
+        self.chan = chan
+
+def _linear_get(chans, channame):
+    for chan in chans:
+        if channame == chan.chan or channame.rstrip("0123456789") == chan.chan:
+            return chan
+    return None
+
+def bench_router(counts=(10, 100, 1000, 10000), number=20000):
+    results = []
+    for n in counts:
+        chans = []
+        router = TopicRouter()
+        for i in range(n):
+            # half scalar channels, half segmented waveform channels
+            if i % 2:
+                chan = _Chan("DEV/%d/scalar" % i)
+                router.add(chan.chan, chan)
+            else:
+                chan = _Chan("DEV/%d/wf/" % i)
+                router.add(chan.chan + "#", chan)
+            chans.append(chan)
+
+        # worst case for the linear scan: the last channels in the list
+        topics = [chans[-1].chan + ("123" if n % 2 else ""), chans[-2].chan + ("" if n % 2 else "123")]
+        for topic in topics:
+            assert router.get(topic) is _linear_get(chans, topic)
+
+        lin = best(lambda: [_linear_get(chans, t) for t in topics], max(number//n, 10))/len(topics)
+        idx = best(lambda: [router.get(t) for t in topics], number)/len(topics)
+        results.append(record("router", "channels=%d" % n, linear_us=1e6*lin, router_us=1e6*idx))
+    return results
+
+
+# Local broker stand-in
+#   imitates paho client publishing through a link with finite bandwidth and latency,
+#   a message is published when it is transmitted and acknowledged,
+#   published messages may be logged as (topic, payload, publish time)
+
+class _LinkInfo:
+    def __init__(self, mid, done):
+        self.mid = mid
+        self.rc = 0
+        self.done = done
+
+    def is_published(self):
+        return time.time() >= self.done
+
+    def wait_for_publish(self):
+        left = self.done - time.time()
+        if left > 0:
+            time.sleep(left)
+
+class LinkClient:
+    def __init__(self, bandwidth, latency, log=False):
+        self.bandwidth = float(bandwidth) # bytes per second
+        self.latency = latency # seconds
+        self.busy = 0.0
+        self.count = 0
+        self.log = [] if log else None
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            now = time.time()
+            self.busy = max(now, self.busy) + (len(topic) + len(payload))/self.bandwidth
+            self.count += 1
+            done = self.busy + self.latency
+            if self.log is not None:
+                self.log.append((topic, payload, done))
+            return _LinkInfo(self.count, done)
+
+
+# Waveform publishing benchmark
+#   sends 16k-sample wfint waveforms through the broker stand-in
+
+def _publish_legacy(client, msgs, delay=0.07):
+    for topic, payload in msgs:
+        client.publish(topic, payload).wait_for_publish()
+        time.sleep(delay)
+
+def _publish_flow(flowcfg):
+    def publish(client, msgs):
+        flow = FlowControl.from_config(flowcfg)
+        for topic, payload in msgs:
+            flow.publish(client, topic, payload)
+        flow.flush()
+    return publish
+
+def bench_publish(bandwidth=10e6, latency=0.001, samples=16384):
+    conv = mqttconv.get("wfint", CONV_CFG)
+    cases = [
+        ("sleep 70 ms", _publish_legacy, 1),
+        ("window 1", _publish_flow({"window": 1}), 10),
+        ("window 16", _publish_flow({"window": 16}), 10),
+        ("window 16, 1 MB/s", _publish_flow({"window": 16, "byte_rate": 1e6}), 4),
+        ("window 16, 500 msg/s", _publish_flow({"window": 16, "msg_rate": 500}), 2),
+    ]
+    results = []
+    for name, publish, count in cases:
+        client = LinkClient(bandwidth, latency)
+        msgs = []
+        for i in range(count):
+            msgs.extend(conv.encode("bench/wf/", np.arange(samples)))
+        start = time.time()
+        publish(client, msgs)
+        results.append(record("publish", "%s, 10 MB/s 1 ms link" % name, segments_s=len(msgs)/(time.time() - start)))
+    return results
+
+
+# Compressed waveform benchmark
+#   compares wfintz with plain wfint on representative 16k-sample waveforms
+
+def _waveforms(samples=16384):
+    t = np.arange(samples)
+    rng = np.random.RandomState(0)
+    return [
+        ("constant", np.full(samples, 12345, dtype=np.int32)),
+        ("ramp", (t*37 - 300000).astype(np.int32)),
+        ("sine+noise", (200000*np.sin(2*np.pi*t/samples) + rng.normal(0, 20, samples)).astype(np.int32)),
+        ("adc noise", rng.normal(0, 2**20, samples).astype(np.int32)),
+    ]
+
+def _roundtrip(conv, value):
+    wf = None
+    for topic, payload in conv.encode("bench/wf/", value):
+        wf = conv.decode(topic, payload.tobytes())
+    return wf
+
+def _decoder(conv, payloads):
+    def decode():
+        for t, p in payloads:
+            conv.decode(t, p)
+    return decode
+
+def bench_compress(levels=(1, 6, 9), number=20):
+    results = []
+    for name, value in _waveforms():
+        mb = value.nbytes/1e6
+        plain = mqttconv.get("wfint", CONV_CFG)
+        plain_segs = len(plain.encode("bench/wf/", value))
+        for level in levels:
+            cfg = dict(CONV_CFG, compress_level=level)
+            conv = mqttconv.get("wfintz", cfg)
+            out = conv.encode("bench/wf/", value)
+            assert np.array_equal(_roundtrip(conv, value), value)
+            ratio = float(value.nbytes)/sum(len(p) for t, p in out)
+            enc = best(lambda: conv.encode("bench/wf/", value), number)
+            payloads = [(t, p.tobytes()) for t, p in conv.encode("bench/wf/", value)]
+            dec = best(_decoder(conv, payloads), number)
+            results.append(record(
+                "compress", "%s, level %d" % (name, level),
+                ratio=ratio, wfint_segments=plain_segs, segments=len(out),
+                encode_mb_s=mb/enc, decode_mb_s=mb/dec,
+            ))
+    return results
+
+
+# Codec benchmark
+#   encode and decode throughput of every registered datatype,
+#   waveform types for several waveform sizes and both protocol versions
+
+_SCALARS = {"int": 123456, "string": "VEPP3/H/status", "wfint1": 42}
+
+def bench_codec(sizes=(256, 4096, 16384, 65536)):
+    results = []
+    for name in mqttconv.types():
+        conv = mqttconv.get(name, CONV_CFG)
+        if not conv.segmented:
+            if name not in _SCALARS:
+                continue
+            value = _SCALARS[name]
+            (topic, payload), = conv.encode("bench/x", value)
+            results.append(record(
+                "codec", name,
+                encode_msg_s=1.0/best(lambda: conv.encode("bench/x", value), 20000),
+                decode_msg_s=1.0/best(lambda: conv.decode(topic, payload), 20000),
+            ))
+            continue
+        for protocol in (1, 2):
+            conv = mqttconv.get(name, dict(CONV_CFG, protocol=protocol))
+            for size in sizes:
+                value = np.arange(size) % 100
+                payloads = [(t, p.tobytes()) for t, p in conv.encode("bench/wf/", value)]
+                wf = _roundtrip(conv, value)
+                assert np.array_equal(wf, value)
+                mb = wf.nbytes/1e6
+                number = max(2, 200000//size)
+                enc = best(lambda: conv.encode("bench/wf/", value), number)
+                dec = best(_decoder(conv, payloads), number)
+                results.append(record(
+                    "codec", "%s%s, %d samples" % (name, " v2" if protocol == 2 else "", size),
+                    segments=len(payloads), encode_mb_s=mb/enc, decode_mb_s=mb/dec,
+                ))
+    return results
+
+
+# Wire encoding benchmark
+#   compares the old per-segment wfint encoding with the one-buffer encoder,
+#   'wire_us' includes the payload copy made by FlowControl for the paho client
+
+def _encode_legacy(conv, topic, value):
+    size = len(value)
+    sds = conv.sds
+    output = []
+    for i in range((size - 1)//sds + 1):
+        meta = struct.pack(">ii", 0, size)
+        data = value[i*sds:(i + 1)*sds].astype(">i4").tobytes()
+        output.append((topic + conv.segidx(i), meta + data))
+    return output
+
+def _encode_wire(conv, topic, value):
+    return [(t, wire_payload(p)) for t, p in conv.encode(topic, value)]
+
+def bench_wire(sizes=(4096, 16384, 65536)):
+    conv = mqttconv.get("wfint", CONV_CFG)
+    results = []
+    for size in sizes:
+        value = np.arange(size, dtype=np.int32)
+        legacy = [p for t, p in _encode_legacy(conv, "bench/wf/", value)]
+        assert [p[8:] for p in legacy] == [p[8:] for t, p in _encode_wire(conv, "bench/wf/", value)]
+        number = max(2, 400000//size)
+        results.append(record(
+            "wire", "wfint, %d samples" % size,
+            legacy_us=1e6*best(lambda: _encode_legacy(conv, "bench/wf/", value), number),
+            encode_us=1e6*best(lambda: conv.encode("bench/wf/", value), number),
+            wire_us=1e6*best(lambda: _encode_wire(conv, "bench/wf/", value), number),
+        ))
+    return results
+
+
+# Downsampling benchmark
+#   throughput of waveform point reduction modes
+
+def bench_downsample(samples=65536, factor=16, number=200):
+    value = (200000*np.sin(np.arange(samples)/100.0)).astype(np.int32)
+    mb = value.nbytes/1e6
+    results = []
+    for mode in (DOWNSAMPLE_MEAN, DOWNSAMPLE_MINMAX, DOWNSAMPLE_STRIDE):
+        down = Downsample(mode, factor=factor)
+        results.append(record(
+            "downsample", "%s, %d samples / %d" % (mode, samples, factor),
+            points=len(down(value)), mb_s=mb/best(lambda: down(value), number),
+        ))
+    return results
+
+# Reassembly benchmark
+#   WfAccum with different segment arrival orders
+
+def _segments(wfid, value, sds):
+    data = np.frombuffer(value.astype(">i4").tobytes(), dtype=">i4")
+    return [(wfid, i, len(value), data[i*sds:(i + 1)*sds]) for i in range((len(value) - 1)//sds + 1)]
+
+def bench_accum(samples=16384, count=50):
+    sds = (CONV_CFG["segment_size_max"] - 8)//4
+    value = np.arange(samples, dtype=np.int32)
+    rng = np.random.RandomState(0)
+    wfs = [_segments(wfid, value, sds) for wfid in range(count)]
+
+    orders = []
+    orders.append(("in order", [s for wf in wfs for s in wf]))
+    orders.append(("reversed", [s for wf in wfs for s in reversed(wf)]))
+    interleaved = []
+    for a, b in zip(wfs[0::2], wfs[1::2]):
+        for sa, sb in zip(a, b):
+            interleaved.extend([sa, sb])
+    orders.append(("interleaved", interleaved))
+    orders.append(("lossy 1%", [s for wf in wfs for s in wf if rng.rand() >= 0.01]))
+
+    results = []
+    for name, segs in orders:
+        def run():
+            accum = WfAccum(CONV_CFG["waveform_queue_size"])
+            done = 0
+            for seg in segs:
+                if accum.push(*seg) is not None:
+                    done += 1
+            return accum, done
+        accum, done = run()
+        t = best(run, 3)
+        results.append(record(
+            "accum", name,
+            completed=done, evicted=accum.evicted,
+            waveforms_s=done/t, mb_s=done*value.nbytes/1e6/t,
+        ))
+    return results
+
+
+# End-to-end benchmark
+#   fake CA monitor source drives pm channels (PvMqttChan) publishing through
+#   the shared pool and flow control into the broker stand-in,
+#   latency is measured from CA callback to publishing of the last message of the value
+
+class FakeCaSource:
+    def __init__(self, chans, values, rate=None):
+        self.chans = chans
+        self.values = values # function (channel index, update number) -> value
+        self.rate = rate # update rounds per second, None for max
+        self.times = [[] for c in chans]
+
+    def run(self, count):
+        start = time.time()
+        for k in range(count):
+            if self.rate is not None:
+                left = start + k/float(self.rate) - time.time()
+                if left > 0:
+                    time.sleep(left)
+            for i, chan in enumerate(self.chans):
+                self.times[i].append(time.time())
+                chan.pushValue(self.values(i, k))
+
+def _e2e(name, wfs, scalars, samples, count, rate, workers=4, window=32, bandwidth=100e6, latency=0.0005):
+    client = LinkClient(bandwidth, latency, log=True)
+    pool = PublishPool(workers)
+    flow = FlowControl(window=window)
+    connections = []
+    for i in range(wfs):
+        connections.append({"mqtt": u"bench/wf/%d/" % i, "pv": u"BENCH_WF%d" % i, "direction": u"pm", "datatype": u"wfint"})
+    for i in range(scalars):
+        connections.append({"mqtt": u"bench/int/%d" % i, "pv": u"BENCH_INT%d" % i, "direction": u"pm", "datatype": u"int"})
+    servers = ServerHealth()
+    chans = [PvMqttChan(c, servers, client, pool, flow) for c in connections]
+
+    wf = np.arange(samples, dtype=np.int32)
+    def values(i, k):
+        return wf + k if i < wfs else k
+
+    source = FakeCaSource(chans, values, rate)
+    pool.start()
+    start = time.time()
+    source.run(count)
+    pool.wait_idle()
+    flow.flush()
+    elapsed = max(t for _, _, t in client.log) - start
+    pool.stop()
+
+    # decode what was published and match complete values with CA updates
+    router = TopicRouter()
+    rx = []
+    for i, chan in enumerate(chans):
+        router.add(chan.subTopic(), i)
+        rx.append(mqttconv.get(chan.datatype, CONV_CFG))
+    done = [[] for c in chans]
+    for topic, payload, t in client.log:
+        i = router.get(topic)
+        if rx[i].decode(topic, payload) is not None:
+            done[i].append(t)
+    lat = []
+    for i in range(len(chans)):
+        assert len(done[i]) == count
+        lat.extend(np.subtract(done[i], source.times[i]))
+    lat = 1e3*np.array(lat)
+
+    return record(
+        "e2e", name,
+        values_s=len(chans)*count/elapsed,
+        messages_s=len(client.log)/elapsed,
+        mb_s=sum(len(p) for _, p, _ in client.log)/1e6/elapsed,
+        latency_p50_ms=np.percentile(lat, 50),
+        latency_p90_ms=np.percentile(lat, 90),
+        latency_p99_ms=np.percentile(lat, 99),
+        latency_max_ms=lat.max(),
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+def bench_e2e():
+    return [
+        _e2e("16 wf x 16k + 64 int, max rate", 16, 64, 16384, 20, None),
+        _e2e("16 wf x 16k + 64 int, 20 Hz", 16, 64, 16384, 20, 20),
+        _e2e("256 int, max rate", 0, 256, 0, 50, None),
+    ]
+
+
+# Inbound benchmark
+#   mp waveform channels fed with bursts of segments as by MQTT client thread
+#   waiting for socket data between them, decoding in the client thread or
+#   in the decode pool; 'receive_*_us' is the time the client thread spends
+#   per segment, the socket is not read meanwhile
+
+class _PutSink:
+    def __init__(self):
+        self.count = 0
+
+    def put(self, pv, value, callback):
+        self.count += 1
+
+def _inbound(name, workers, chans_n=8, samples=65536, count=10, burst=32, wait=0.001):
+    servers = ServerHealth()
+    sink = _PutSink()
+    pool = PublishPool(workers) if workers else None
+    chans = []
+    for i in range(chans_n):
+        connection = {"mqtt": u"bench/wf/%d/" % i, "pv": u"BENCH_WF%d" % i, "direction": u"mp", "datatype": u"wfint"}
+        chans.append(PvMqttChan(connection, servers, None, None, None, sink, decodepool=pool))
+    tx = mqttconv.get("wfint", CONV_CFG)
+    msgs = []
+    for k in range(count):
+        for chan in chans:
+            msgs.extend((chan, t, p.tobytes()) for t, p in tx.encode(chan.chan, np.arange(samples, dtype=np.int32) + k))
+
+    if pool is not None:
+        pool.start()
+    start = time.time()
+    calls = []
+    for i, (chan, topic, payload) in enumerate(msgs):
+        if i % burst == 0:
+            # client thread waits for socket data
+            time.sleep(wait)
+        t = time.time()
+        chan.receive(topic, payload)
+        calls.append(time.time() - t)
+    calls = 1e6*np.array(calls)
+    if pool is not None:
+        pool.wait_idle()
+        pool.stop()
+    elapsed = time.time() - start
+    assert sink.count == chans_n*count
+    return record(
+        "inbound", name,
+        receive_us=calls.mean(),
+        receive_p99_us=np.percentile(calls, 99),
+        receive_max_us=calls.max(),
+        waveforms_s=sink.count/elapsed,
+        mb_s=sink.count*samples*4/1e6/elapsed,
+    )
+
+def bench_inbound():
+    return [
+        _inbound("decode in client thread", 0),
+        _inbound("decode pool, 1 worker", 1),
+        _inbound("decode pool, 2 workers", 2),
+    ]
+
+# Aggregate benchmark
+#   scalar int PVs published as separate channels or as one aggregate channel
+#   with a frame each 'per_tick' update rounds, through the broker stand-in
+
+def _aggregate(name, pvs, rounds, per_tick, bandwidth=100e6, latency=0.0005):
+    client = LinkClient(bandwidth, latency, log=True)
+    pool = PublishPool(4)
+    flow = FlowControl(window=32)
+    servers = ServerHealth()
+    if per_tick:
+        connection = {"mqtt": u"bench/agg", "pv": [u"BENCH_INT%d" % i for i in range(pvs)], "direction": u"pm"}
+        chan = AggregateChan(connection, servers, client, pool, flow)
+        def push(k):
+            for i in range(pvs):
+                chan.pushValue(k, i)
+            if (k + 1) % per_tick == 0:
+                chan.flush()
+    else:
+        chans = []
+        for i in range(pvs):
+            connection = {"mqtt": u"bench/int/%d" % i, "pv": u"BENCH_INT%d" % i, "direction": u"pm", "datatype": u"int"}
+            chans.append(PvMqttChan(connection, servers, client, pool, flow))
+        def push(k):
+            for chan in chans:
+                chan.pushValue(k)
+
+    pool.start()
+    start = time.time()
+    for k in range(rounds):
+        push(k)
+    pool.wait_idle()
+    flow.flush()
+    elapsed = max(t for _, _, t in client.log) - start
+    pool.stop()
+    return record(
+        "aggregate", name,
+        values_s=pvs*rounds/elapsed,
+        messages=len(client.log),
+        bytes=sum(len(t) + len(p) for t, p, _ in client.log),
+    )
+
+def bench_aggregate(pvs=256, rounds=100):
+    return [
+        _aggregate("%d int channels" % pvs, pvs, rounds, 0),
+        _aggregate("%d int aggregate, frame per round" % pvs, pvs, rounds, 1),
+        _aggregate("%d int aggregate, frame per 10 rounds" % pvs, pvs, rounds, 10),
+    ]
+
+
+# Priority benchmark
+#   scalar control channels sharing workers and flow control window
+#   with waveform channels saturating the link, latency of control values
+#   is measured from CA callback to publishing as in the e2e benchmark
+
+def _priority(name, priority, wfs=8, ctls=4, samples=16384, count=20, rate=20, bandwidth=10e6, latency=0.001):
+    client = LinkClient(bandwidth, latency, log=True)
+    pool = PublishPool(4)
+    flow = FlowControl(window=16)
+    servers = ServerHealth()
+    chans = []
+    for i in range(wfs):
+        connection = {"mqtt": u"bench/wf/%d/" % i, "pv": u"BENCH_WF%d" % i, "direction": u"pm", "datatype": u"wfint", "delivery": u"latest"}
+        chans.append(PvMqttChan(connection, servers, client, pool, flow))
+    for i in range(ctls):
+        connection = {"mqtt": u"bench/ctl/%d" % i, "pv": u"BENCH_CTL%d" % i, "direction": u"pm", "datatype": u"int", "priority": priority}
+        chans.append(PvMqttChan(connection, servers, client, pool, flow))
+
+    wf = np.arange(samples, dtype=np.int32)
+    def values(i, k):
+        return wf + k if i < wfs else k
+
+    source = FakeCaSource(chans, values, rate)
+    pool.start()
+    start = time.time()
+    source.run(count)
+    pool.wait_idle()
+    flow.flush()
+    elapsed = max(t for _, _, t in client.log) - start
+    pool.stop()
+
+    done = dict((chan.chan, []) for chan in chans[wfs:])
+    for topic, payload, t in client.log:
+        if topic in done:
+            done[topic].append(t)
+    lat = []
+    for i, chan in enumerate(chans[wfs:], wfs):
+        assert len(done[chan.chan]) == count
+        lat.extend(np.subtract(done[chan.chan], source.times[i]))
+    lat = 1e3*np.array(lat)
+    wf_bytes = sum(len(p) for t, p, _ in client.log if t not in done)
+
+    return record(
+        "priority", name,
+        wf_mb_s=wf_bytes/1e6/elapsed,
+        control_p50_ms=np.percentile(lat, 50),
+        control_p99_ms=np.percentile(lat, 99),
+        control_max_ms=lat.max(),
+    )
+
+def bench_priority():
+    return [
+        _priority("8 wf x 16k at 20 Hz + 4 int, same priority", 0),
+        _priority("8 wf x 16k at 20 Hz + 4 int, control priority 1", 1),
+    ]
+
+
+BENCHES = [
+    ("router", bench_router),
+    ("publish", bench_publish),
+    ("compress", bench_compress),
+    ("codec", bench_codec),
+    ("wire", bench_wire),
+    ("downsample", bench_downsample),
+    ("accum", bench_accum),
+    ("e2e", bench_e2e),
+    ("inbound", bench_inbound),
+    ("aggregate", bench_aggregate),
+    ("priority", bench_priority),
+]
+
+def print_records(records, base=None):
+    # base: records of a previous run to compare with
+    prev = {}
+    for rec in base or []:
+        prev[(rec["bench"], rec["case"])] = rec["metrics"]
+    bench = None
+    for rec in records:
+        if rec["bench"] != bench:
+            bench = rec["bench"]
+            print("\n[%s]" % bench)
+        old = prev.get((rec["bench"], rec["case"]), {})
+        cols = []
+        for key in sorted(rec["metrics"].keys()):
+            value = rec["metrics"][key]
+            col = "%s=%.4g" % (key, value)
+            if old.get(key):
+                col += " (%+.1f%%)" % (100.0*(value - old[key])/old[key])
+            cols.append(col)
+        print("  %s: %s" % (rec["case"], ", ".join(cols)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CA-MQTT gateway benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (%s)" % ", ".join(n for n, f in BENCHES))
+    parser.add_argument("--json", help="write results to file")
+    parser.add_argument("--compare", help="compare with results written by a previous run")
+    args = parser.parse_args()
+
+    records = []
+    for name, run in BENCHES:
+        if not args.names or name in args.names:
+            records.extend(run())
+
+    base = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+    print_records(records, base)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(records, f, indent=1, sort_keys=True)
@@ -1,9 +1,5 @@
 #!/usr/bin/env python
 
-import numpy as np
-from multiprocessing import Queue
-from threading import Thread
-
 import cothread.catools as catools
 import cothread
 from cothread.catools import *
@@ -15,14 +11,28 @@ import json
 import time
 import sys
 import os
-import array
 import paho.mqtt.client as mqtt
-import paho.mqtt.publish as publish
 
 import traceback
 import logging
+import importlib
+import atexit
 
 import mqttconv
+from mqttroute import TopicRouter
+from pubpool import PublishPool
+from pubflow import FlowControl
+from wfaccum import WfBudget
+from metrics import Metrics, MetricsServer, StatusPublisher
+from putpipe import PutPipeline
+from connector import Connector, CONNECT_DEADLINE
+from confdiff import diff_connections, connection_key
+from asynclog import AsyncHandler, RateLimitFilter
+from health import ServerHealth, OPEN
+from trafficlog import TrafficRecorder
+from lvcache import Recovery, REPUBLISH_FLOW
+from aggregate import AggregateChan
+from pvchan import PvMqttChan, unicodeToStr, CONV_CFG, PUBLISH_FLOW
 
 
 script_dir = os.path.dirname(__file__)
@@ -34,139 +44,29 @@ logger.setLevel(logging.DEBUG)
 sh = logging.StreamHandler()
 sh.setLevel(logging.DEBUG)
 sh.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
-logger.addHandler(sh)
 
 fh = logging.FileHandler(os.path.join(script_dir,'info.log'))
 fh.setLevel(logging.INFO)
 fh.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%d-%m-%Y %H:%M:%S'))
-logger.addHandler(fh)
+
+# handlers are written from a background thread, repeated errors are rate limited
+logq = AsyncHandler([sh, fh])
+lograte = RateLimitFilter()
+logq.addFilter(lograte)
+logger.addHandler(logq)
+logq.start()
+atexit.register(logq.stop)
 
 chans = []
+router = TopicRouter()
+metrics = Metrics()
 
 # predefined constants
-CONV_CFG = {
-    "segment_size_max": 1208, # bytes
-    "segment_index_digits": 3, # decimal digits count in segment index
-    "waveform_queue_size": 3, # difference between waveform ids 
-                              # that enough to drop an old incomplete ones
-}
-MQTT_DELAY = 0.07 # seconds
-RECONNECT_ATTEMPTS = 12
-
-class PvMqttChan:
-    def __init__(self,connection,servers,client):
-        self.chan = unicodeToStr(connection["mqtt"])
-        self.pv = unicodeToStr(connection["pv"])
-        if "datatype" in connection:
-            self.datatype = unicodeToStr(connection["datatype"])
-        else:
-            self.datatype = None
-        self.direction = unicodeToStr(connection["direction"])
-        if "qos" in connection:
-            self.qos = connection["qos"]
-        else:
-            self.qos = 0
-        self.retain = False
-        if ("retain" in connection) and connection["retain"] == "true":
-            self.retain = True
-        self.servers = servers
-        self.client = client
-
-        self.conv = mqttconv.get(self.datatype, CONV_CFG)
-
-        self.queue = Queue()
-        self.thread = Thread(target=self.updateChanLoop)
-
-    def setConnection(self):
-        connected = False
-        for i in range(RECONNECT_ATTEMPTS):
-            try:
-                catools.connect(self.pv)
-                if self.direction=="mp":
-                    if self.datatype == "wfint":
-                        self.client.subscribe(self.chan+"#")
-                    else:
-                        self.client.subscribe(self.chan)
-                elif self.direction=="pm":
-                    self.thread.start()
-                    camonitor(self.pv, self.pushValue)
-                logger.info("(%s, %s) connection set" % (self.pv, self.chan))
-                connected = True
-                break
-            except Exception as e:
-                logger.error("Trouble with connection to " + self.pv + " or " + self.chan + ": " + str(e))
-                logger.debug(traceback.format_exc())
-                #cothread.Quit()
-                continue
-        if not connected:
-            logger.error("Unable to connect to " + self.pv + " or " + self.chan + ", giving up")
-
-    def pushValue(self, value):
-        logger.debug("ca: received from %s" % self.pv)
-        self.queue.put(value)
-
-    def updateChanLoop(self):
-        while True:
-            self.updateChan(self.queue.get())
-
-    def updateChan(self, value):
-        logger.debug("mqtt: send to %s" % self.chan)
-        try:
-            for topic, payload in self.conv.encode(self.chan, value):
-                self.client.publish(topic, payload, self.qos, self.retain).wait_for_publish()
-                time.sleep(MQTT_DELAY)
-        except Exception as e:
-            logger.error("Trouble when Publishing to Mqtt with " + self.chan + ": " + str(e))
-            logger.debug(traceback.format_exc())
-            #cothread.Quit()
-
-    def updatePv(self, topic, payload):
-        logger.debug("ca: send to %s" % self.pv)
-        try:
-            value = self.conv.decode(topic, payload)
-            if value is not None:
-                cothread.CallbackResult(caput, self.pv, value)
-        except Exception as e:
-            logger.error("Trouble in updatePv with " + self.pv + ": " + str(e))
-            logger.debug(traceback.format_exc())
-            #cothread.Quit()
-
-    def findServer(self,type,name):
-        result = [x for x in self.servers if x.type == type and x.name == name]
-        if len(result) != 0:
-            return result[0]
-    def isChannelWorkDelayed(self):
-        server = self.findServer("ioc",self.pv.split("_",1)[0])
-        if not server.checkServer():
-            return True
-        server = self.findServer("mqtt",self.chan.split("/",1)[0])
-        if not server.checkServer():
-            return True
-        return False
-    def setServerDelay(self,error):
-        channelname = error.split(' ',1)[0]
-        servername = channelname.split("_",1)[0]
-        server = self.findServer("ioc",servername)
-        if not server:
-            servername = channelname.split("/",1)[0]
-            server = self.findServer("mqtt",servername)
-        if server:
-            server.delayServer()
-            return
-
-class Server:
-    def __init__(self,type,name,timestamp=None):
-        self.type = type
-        self.name = name
-        self.timestamp = timestamp
-    def delayServer(self):
-        self.timestamp = time.time()
-    def checkServer(self):
-        if not self.timestamp:
-            return True
-        if time.time()-self.timestamp>10:
-            return True
-        return False
+WAVEFORM_SHARED_BUDGET = 64*2**20 # max bytes of incomplete waveforms of all channels
+PUBLISH_WORKERS = 4 # default number of threads publishing pm channels
+PRIORITY_WORKERS = 1 # default number of threads publishing pm channels of each priority above 0
+DECODE_WORKERS = 1 # default number of threads decoding mp channels, 0 to decode in MQTT client thread
+STATUS_PERIOD = 10.0 # seconds between metrics status messages
 
 
 def openConfigFile(filename):
@@ -174,30 +74,104 @@ def openConfigFile(filename):
         data = json.load(data_file)
     return data
 
-def unicodeToStr(name):
-    string = name.encode('ascii', 'ignore')
-    return string
-
-
 def getChannel(channame):
-    global chans
-    for chan in chans:
-        if channame == chan.chan or channame.rstrip("0123456789") == chan.chan:
-            return chan
-    return None
+    return router.get(channame)
 
 def on_connect(client, userdata, flags, rc):
-    global chans
     logger.info("mqtt: connected with result code %s" % int(rc))
-    #for channel in chans:
-    #    channel.setConnection()
-
+    if rc == 0:
+        # subscriptions and last values are restored after broker reconnect
+        recovery.connected(list(chans))
+
+
+def addChannel(connection):
+    if isinstance(connection["pv"], list):
+        channel = AggregateChan(connection,servers,client,pubpool,flow,putpipe,recorder,decodepool)
+    else:
+        channel = PvMqttChan(connection,servers,client,pubpool,flow,putpipe,recorder,decodepool)
+    if channel.direction=="mp":
+        router.add(channel.subTopic(), channel)
+    chans.append(channel)
+    metrics.add(channel.metrics)
+    return channel
+
+def removeChannel(channel):
+    channel.close()
+    if channel.direction=="mp":
+        router.remove(channel.subTopic())
+    chans.remove(channel)
+    metrics.remove(channel.metrics)
+    connector.remove(channel)
+
+# applies changes of connections list, other channels keep running
+def reloadConfig():
+    global config_info
+    try:
+        new_info = openConfigFile(config_path)
+        added, removed, retuned, replaced = diff_connections(config_info["connections"], new_info["connections"])
+    except Exception as e:
+        logger.error("config: unable to reload %s: %s" % (config_path, str(e)))
+        return
+    for key in sorted(set(config_info.keys()) | set(new_info.keys())):
+        if key != "connections" and config_info.get(key) != new_info.get(key):
+            logger.warning("config: change of '%s' needs restart" % key)
+
+    bykey = dict((connection_key(channel.connection), channel) for channel in chans)
+    for connection in removed + [old for old, new in replaced]:
+        channel = bykey.get(connection_key(connection))
+        if channel is not None:
+            removeChannel(channel)
+    failed = [] # left out of stored config, so the next reload retries them
+    kept = [] # (new, old) of channels left with old options
+    for old, new in retuned:
+        channel = bykey.get(connection_key(old))
+        if channel is None:
+            failed.append(new)
+            continue
+        try:
+            channel.retune(new)
+        except Exception as e:
+            logger.error("config: unable to retune channel %s: %s" % (connection_key(new), str(e)))
+            try:
+                channel.retune(old)
+                kept.append((new, old))
+            except Exception as e:
+                # channel is in unknown state, the next reload recreates it
+                logger.error("config: unable to restore channel %s: %s" % (connection_key(old), str(e)))
+                removeChannel(channel)
+                failed.append(new)
+    created = []
+    for connection in added + [new for old, new in replaced]:
+        try:
+            created.append(addChannel(connection))
+        except Exception as e:
+            failed.append(connection)
+            logger.error("config: unable to create channel %s: %s" % (connection_key(connection), str(e)))
+    restored = dict((id(new), old) for new, old in kept)
+    new_info["connections"] = [restored.get(id(c), c) for c in new_info["connections"] if not any(c is f for f in failed)]
+    config_info = new_info
+    logger.info("config: %d added, %d removed, %d retuned, %d replaced" % (len(added), len(removed), len(retuned), len(replaced)))
+    connector.start(created)
+
+def watchConfig(period):
+    mtime = os.path.getmtime(config_path)
+    while True:
+        cothread.Sleep(period)
+        try:
+            current = os.path.getmtime(config_path)
+        except OSError:
+            continue
+        if current != mtime:
+            mtime = current
+            reloadConfig()
 
 def on_message(client, userdata, msg):
-    logger.debug("mqtt: received from %s" % msg.topic)
+    logger.debug("mqtt: received from %s", msg.topic)
+    if recorder is not None:
+        recorder.mqtt(msg.topic, msg.payload)
     chan = getChannel(msg.topic)
     if chan is not None:
-        chan.updatePv(msg.topic, msg.payload)
+        chan.receive(msg.topic, msg.payload)
 
 try:
     config_path = os.path.join(script_dir, "gateway_config.json") # default config file
@@ -209,22 +183,77 @@ try:
     qapp = QtCore.QCoreApplication(sys.argv)
     #app = cothread.iqt()#run_exec=False)
 
+    # stdout log level, file gets INFO and above
+    sh.setLevel(config_info.get("log_level", "DEBUG"))
+    logger.setLevel(min(sh.level, fh.level))
+
     logger.info("Start")
 
-    servers = []
-    servers.extend((Server("ioc","VEPP3"),Server("mqtt","VEPP3")))
+    # site modules registering their own datatypes with mqttconv.register()
+    for module in config_info.get("codec_modules", []):
+        importlib.import_module(unicodeToStr(module))
+
+    CONV_CFG["waveform_shared_budget"] = WfBudget(config_info.get("waveform_shared_budget", WAVEFORM_SHARED_BUDGET))
+
+    # circuit breakers of servers, created for PV and topic prefixes of channels
+    servers = ServerHealth.from_config(config_info.get("breaker", {}))
+    metrics.add_global("servers_down", "gauge", "Servers with open circuit breaker", lambda: servers.count(OPEN))
+
+    # all CA updates and MQTT messages are written to a traffic log (see trafficlog.py)
+    recorder = None
+    if "record" in config_info:
+        recorder = TrafficRecorder(config_info["record"])
+        atexit.register(recorder.close)
+        metrics.add_global("recorded_bytes_total", "counter", "Bytes written to traffic log", lambda: recorder.bytes)
 
 
     client = mqtt.Client()
 
+    recovery = Recovery(client, FlowControl.from_config(config_info.get("republish_flow", REPUBLISH_FLOW)))
+    metrics.add_global("mqtt_reconnects_total", "counter", "Reconnects to MQTT broker", lambda: max(0, recovery.connects - 1))
+    metrics.add_global("republished_total", "counter", "Cached messages republished after reconnect", lambda: recovery.republished)
+    metrics.add_global("recovery_seconds", "gauge", "Time of the last recovery after reconnect", lambda: recovery.duration)
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(config_info["mqtt_broker_address"])
 
+    pubpool = PublishPool(config_info.get("publish_workers", PUBLISH_WORKERS), config_info.get("priority_workers", PRIORITY_WORKERS))
+    pubpool.start()
+    # mp messages may be decoded and waveforms joined off MQTT client thread
+    decodepool = None
+    decode_workers = config_info.get("decode_workers", DECODE_WORKERS)
+    if decode_workers > 0:
+        decodepool = PublishPool(decode_workers)
+        decodepool.start()
+    flow = FlowControl.from_config(config_info.get("publish_flow", PUBLISH_FLOW))
+    putpipe = PutPipeline(config_info.get("put_callback", False))
+    metrics.add_global("log_dropped_total", "counter", "Log records dropped by full log queue", lambda: logq.dropped)
+    metrics.add_global("log_suppressed_total", "counter", "Log records suppressed by rate limit", lambda: lograte.suppressed)
+    metrics.add_global("puts_total", "counter", "Values put to CA", lambda: putpipe.puts)
+    metrics.add_global("puts_coalesced_total", "counter", "Values replaced by newer ones before put", lambda: putpipe.coalesced)
+    metrics.add_global("put_batches_total", "counter", "Multi-PV caput calls", lambda: putpipe.batches)
+    metrics.add_global("puts_failed_total", "counter", "Failed puts", lambda: putpipe.failed)
+
     for connection in config_info["connections"]:
-        channel = PvMqttChan(connection,servers,client)
-        channel.setConnection()
-        chans.append(channel)
+        addChannel(connection)
+
+    # all PVs are connected in parallel, unreachable ones are retried in background
+    connector = Connector(config_info.get("connect_deadline", CONNECT_DEADLINE))
+    metrics.add_global("channels_live", "gauge", "Channels connected", lambda: connector.live)
+    metrics.add_global("ready", "gauge", "Startup connection finished", lambda: int(connector.ready))
+    connector.start(chans)
+
+    # metrics are exposed only if configured
+    metrics_cfg = config_info.get("metrics", {})
+    if "http_port" in metrics_cfg:
+        MetricsServer(metrics, metrics_cfg["http_port"], unicodeToStr(metrics_cfg.get("http_address", u"127.0.0.1"))).start()
+    if "status_topic" in metrics_cfg:
+        StatusPublisher(metrics, client, unicodeToStr(metrics_cfg["status_topic"]), metrics_cfg.get("status_period", STATUS_PERIOD)).start()
+
+    # connections are reloaded on SIGHUP or when config file changes
+    signal.signal(signal.SIGHUP, lambda signum, frame: cothread.Callback(reloadConfig))
+    if config_info.get("config_watch"):
+        cothread.Spawn(watchConfig, config_info["config_watch"])
 
     client.loop_start()
 except Exception as e:
@@ -0,0 +1,86 @@
+import unittest
+
+
+# connection fields identifying a channel
+KEY_FIELDS = ["pv", "mqtt", "direction"]
+# connection fields that can be changed in running channel (see PvMqttChan.retune)
+RETUNE_FIELDS = ["qos", "retain", "flow", "deadband", "max_rate", "downsample", "weight"]
+
+def connection_key(connection):
+    # "pv" is a list in aggregate connections
+    return tuple(tuple(v) if isinstance(v, list) else v for v in (connection[field] for field in KEY_FIELDS))
+
+def _index(connections):
+    index = {}
+    for connection in connections:
+        key = connection_key(connection)
+        if key in index:
+            raise ValueError("Duplicate connection %s" % (key,))
+        index[key] = connection
+    return index
+
+# Connections diff
+#   compares old and new connection lists, returns
+#   (added, removed, retuned, replaced) where 'retuned' are (old, new) pairs
+#   differing in RETUNE_FIELDS only and 'replaced' are (old, new) pairs
+#   that need the channel to be recreated
+def diff_connections(old, new):
+    oldidx, newidx = _index(old), _index(new)
+    added, removed, retuned, replaced = [], [], [], []
+    for connection in old:
+        if connection_key(connection) not in newidx:
+            removed.append(connection)
+    for connection in new:
+        key = connection_key(connection)
+        if key not in oldidx:
+            added.append(connection)
+            continue
+        prev = oldidx[key]
+        if prev == connection:
+            continue
+        fields = set(prev.keys()) | set(connection.keys())
+        if all(prev.get(f) == connection.get(f) for f in fields if f not in RETUNE_FIELDS):
+            retuned.append((prev, connection))
+        else:
+            replaced.append((prev, connection))
+    return added, removed, retuned, replaced
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def _conn(self, i, **kw):
+        conn = {"pv": "PV%d" % i, "mqtt": "t/%d" % i, "direction": "pm", "datatype": "int"}
+        conn.update(kw)
+        return conn
+
+    def test_same(self):
+        conns = [self._conn(i) for i in range(3)]
+        self.assertEqual(diff_connections(conns, [dict(c) for c in conns]), ([], [], [], []))
+
+    def test_diff(self):
+        old = [self._conn(0), self._conn(1), self._conn(2), self._conn(3)]
+        new = [self._conn(0), self._conn(1, qos=1), self._conn(2, datatype="string"), self._conn(4)]
+        added, removed, retuned, replaced = diff_connections(old, new)
+        self.assertEqual(added, [self._conn(4)])
+        self.assertEqual(removed, [self._conn(3)])
+        self.assertEqual(retuned, [(self._conn(1), self._conn(1, qos=1))])
+        self.assertEqual(replaced, [(self._conn(2), self._conn(2, datatype="string"))])
+
+    def test_key(self):
+        # changed direction is another channel
+        added, removed, retuned, replaced = diff_connections([self._conn(0)], [self._conn(0, direction="mp")])
+        self.assertEqual((len(added), len(removed)), (1, 1))
+
+    def test_aggregate(self):
+        old = [self._conn(0, pv=["A", "B"])]
+        self.assertEqual(diff_connections(old, [self._conn(0, pv=["A", "B"], qos=1)])[2], [(old[0], self._conn(0, pv=["A", "B"], qos=1))])
+        added, removed, retuned, replaced = diff_connections(old, [self._conn(0, pv=["A", "C"])])
+        self.assertEqual((len(added), len(removed)), (1, 1))
+
+    def test_dup_err(self):
+        with self.assertRaises(ValueError):
+            diff_connections([], [self._conn(0), self._conn(0, qos=1)])
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
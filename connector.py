@@ -0,0 +1,370 @@
+import heapq
+import logging
+import random
+import time
+
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+# predefined constants
+CONNECT_DEADLINE = 5.0 # seconds, startup waits for PVs at most this time
+CONNECT_SETTLE = 1.0 # seconds, startup is ready when no channel went live for this time
+CONNECT_POLL = 0.05 # seconds
+RETRY_TIMEOUT = 2.0 # seconds, connection timeout of retries
+RETRY_DELAY = 1.0 # seconds, first retry delay
+RETRY_DELAY_MAX = 60.0 # seconds
+RETRY_JITTER = 0.5 # part of delay randomized
+RETRY_POLL = 1.0 # seconds, max sleep of retry loop
+
+
+# Exponential backoff
+#   delay of n-th retry is 'delay'*2**n up to 'limit',
+#   reduced by random part up to 'jitter' of it, so retries of many PVs spread
+class Backoff:
+    def __init__(self, delay=RETRY_DELAY, limit=RETRY_DELAY_MAX, jitter=RETRY_JITTER, random=random.random):
+        self.delay = delay
+        self.limit = limit
+        self.jitter = jitter
+        self.random = random
+
+    def __call__(self, attempt):
+        delay = min(self.limit, self.delay*2**min(attempt, 64))
+        return delay*(1.0 - self.jitter*self.random())
+
+
+# Channel connector
+#   connects PVs of all channels in parallel within a deadline,
+#   channel is connected when all its PVs ('pvs') are,
+#   attaches (subscribes or monitors) connected channels,
+#   retries unreachable ones in background with backoff;
+#   runs in cothread
+class Connector:
+    def __init__(self, deadline=CONNECT_DEADLINE, timeout=RETRY_TIMEOUT, backoff=None,
+                 connect=None, spawn=None, sleep=None, clock=time.time, settle=CONNECT_SETTLE):
+        if connect is None:
+            import cothread
+            import cothread.catools as catools
+            connect, spawn, sleep = catools.connect, cothread.Spawn, cothread.Sleep
+        self.deadline = deadline
+        self.settle = settle
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+        self.connect = connect
+        self.spawn = spawn
+        self.sleep = sleep
+        self.clock = clock
+        self.retries = [] # heap of (time, sequence, attempt, channel)
+        self.seq = 0
+        self.connected = set() # live channels
+        self.removed = set() # channels removed while being connected
+        self.running = False
+        self.ready = False
+
+        # counters
+        self.total = 0
+        self.live = 0
+        self.attempts = 0
+
+    def _retry(self, chan, attempt):
+        heapq.heappush(self.retries, (self.clock() + self.backoff(attempt), self.seq, attempt, chan))
+        self.seq += 1
+
+    # connects channels in parallel, returns (attached, not connected) ones,
+    # channels removed meanwhile are in neither
+    def _connect(self, chans, timeout):
+        self.attempts += len(chans)
+        pvs = [pv for chan in chans for pv in chan.pvs]
+        try:
+            results = iter(self.connect(pvs, timeout=timeout, throw=False))
+        except Exception as e:
+            logger.error("Unable to connect %d PVs: %s" % (len(pvs), str(e)))
+            results = None
+        attached = []
+        failed = []
+        for chan in chans:
+            # channel is connected if all its PVs are
+            ok = results is not None and all([next(results).ok for pv in chan.pvs])
+            if chan in self.removed:
+                self.removed.discard(chan)
+                continue
+            if ok:
+                try:
+                    chan.setConnection()
+                    self.connected.add(chan)
+                    self.live += 1
+                    attached.append(chan)
+                    continue
+                except Exception as e:
+                    logger.error("Trouble with connection to " + chan.pv + " or " + chan.chan + ": " + str(e))
+            failed.append(chan)
+        return attached, failed
+
+    # connects each channel in its own cothread within deadline, attaches
+    # channels as their PVs connect, schedules retries of the rest,
+    # returns when all channels are live or no more went live for 'settle' seconds,
+    # slower ones are attached or scheduled in background
+    def start(self, chans):
+        self.total += len(chans)
+        start = self.clock()
+        pending = set(chans)
+        for chan in chans:
+            self.spawn(self._attach, chan, pending)
+        live, last = self.live, start
+        while pending and self.clock() - start < self.deadline:
+            self.sleep(CONNECT_POLL)
+            now = self.clock()
+            if self.live != live:
+                live, last = self.live, now
+            elif now - last >= self.settle:
+                break
+        self.ready = True
+        logger.info("ready: %d of %d channels live in %.1f s" % (self.live, self.total, self.clock() - start))
+        if not self.running:
+            self.running = True
+            self.spawn(self._loop)
+
+    def _attach(self, chan, pending):
+        attached, failed = self._connect([chan], self.deadline)
+        pending.discard(chan)
+        if failed:
+            logger.error("Unable to connect to %s, will retry", chan.pv)
+            self._retry(chan, 0)
+
+    # retries due channels, returns time to the next retry
+    def step(self):
+        now = self.clock()
+        due = []
+        while self.retries and self.retries[0][0] <= now:
+            t, seq, attempt, chan = heapq.heappop(self.retries)
+            due.append((chan, attempt))
+        if due:
+            attached, failed = self._connect([chan for chan, attempt in due], self.timeout)
+            attached, failed = set(attached), set(failed)
+            for chan, attempt in due:
+                if chan in failed:
+                    self._retry(chan, attempt + 1)
+                elif chan in attached:
+                    logger.info("(%s, %s) connected after %d retries" % (chan.pv, chan.chan, attempt + 1))
+        if not self.retries:
+            return None
+        return max(0.0, self.retries[0][0] - self.clock())
+
+    # forgets removed channel
+    def remove(self, chan):
+        if chan in self.connected:
+            self.connected.discard(chan)
+            self.live -= 1
+        else:
+            retries = [r for r in self.retries if r[3] is not chan]
+            if len(retries) < len(self.retries):
+                self.retries = retries
+                heapq.heapify(self.retries)
+            else:
+                # being connected, skipped when connect returns
+                self.removed.add(chan)
+        self.total -= 1
+
+    def _loop(self):
+        while self.running:
+            wait = self.step()
+            self.sleep(RETRY_POLL if wait is None else min(wait, RETRY_POLL))
+
+    def stop(self):
+        self.running = False
+
+
+# Unittests
+class _Result:
+    def __init__(self, ok):
+        self.ok = ok
+
+class _Chan:
+    def __init__(self, pv):
+        self.pv = pv
+        self.pvs = pv.split(",")
+        self.chan = pv.lower()
+        self.attached = 0
+
+    def setConnection(self):
+        self.attached += 1
+
+class _Capture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.reachable = set()
+        self.delays = {} # seconds to connect reachable PVs, 0.1 by default
+        self.calls = []
+        self.loops = []
+        self.tasks = [] # (spawn time, function, args) of connecting cothreads
+
+    def _connect(self, pvs, timeout, throw):
+        self.calls.append((pvs, timeout))
+        return [_Result(pv in self.reachable and self.delays.get(pv, 0.1) <= timeout) for pv in pvs]
+
+    def _spawn(self, func, *args):
+        if args:
+            self.tasks.append((self.now[0], func, args))
+        else:
+            self.loops.append(func)
+
+    # connects of spawned cothreads return when their PVs connect or time out
+    def _sleep(self, t):
+        self.now[0] += t
+        for task in list(self.tasks):
+            spawned, func, args = task
+            chan = args[0]
+            wait = max(self.delays.get(pv, 0.1) if pv in self.reachable else 5.0 for pv in chan.pvs)
+            if self.now[0] >= spawned + min(wait, 5.0):
+                self.tasks.remove(task)
+                func(*args)
+
+    def _connector(self):
+        return Connector(
+            deadline=5.0, timeout=1.0, backoff=Backoff(1.0, 8.0, 0.0), settle=1.0,
+            connect=self._connect, spawn=self._spawn, sleep=self._sleep, clock=lambda: self.now[0],
+        )
+
+    # starts and lets connects of unreachable channels time out
+    def _start(self, conn, chans):
+        logging.disable(logging.CRITICAL)
+        try:
+            conn.start(chans)
+            self.ready = self.now[0]
+            while self.tasks:
+                self._sleep(CONNECT_POLL)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_backoff(self):
+        backoff = Backoff(1.0, 10.0, 0.5, random=lambda: 1.0)
+        self.assertEqual([backoff(n) for n in range(5)], [0.5, 1.0, 2.0, 4.0, 5.0])
+        self.assertEqual(Backoff(1.0, 10.0, 0.0)(1000), 10.0)
+
+    def test_start(self):
+        chans = [_Chan("A"), _Chan("B"), _Chan("C")]
+        self.reachable = set(["A", "C"])
+        conn = self._connector()
+        self._start(conn, chans)
+        # connect of each channel with startup deadline
+        self.assertEqual(sorted(self.calls), [(["A"], 5.0), (["B"], 5.0), (["C"], 5.0)])
+        self.assertEqual([c.attached for c in chans], [1, 0, 1])
+        self.assertTrue(conn.ready)
+        # unreachable channel doesn't delay readiness up to the deadline
+        self.assertLess(self.ready, 2.0)
+        self.assertEqual((conn.live, conn.total), (2, 3))
+        self.assertEqual([r[3] for r in conn.retries], [chans[1]])
+        self.assertEqual(len(self.loops), 1)
+
+    def test_start_live(self):
+        # ready as soon as all channels are live, slow ones attached later
+        chans = [_Chan("A"), _Chan("B"), _Chan("C")]
+        self.reachable = set(["A", "B", "C"])
+        self.delays = {"C": 3.0}
+        conn = self._connector()
+        self._start(conn, chans)
+        self.assertLess(self.ready, 2.0)
+        self.assertEqual([c.attached for c in chans], [1, 1, 1])
+        self.reachable = set(["A", "B"])
+        self.delays = {}
+        self.now[0] = 0.0
+        conn = self._connector()
+        self._start(conn, chans[:2])
+        self.assertAlmostEqual(self.ready, 0.1)
+
+    def test_multi(self):
+        # aggregate channels are connected when all their PVs are
+        chans = [_Chan("A"), _Chan("B,C"), _Chan("D,E")]
+        self.reachable = set(["A", "B", "C", "D"])
+        conn = self._connector()
+        self._start(conn, chans)
+        self.assertEqual([c.attached for c in chans], [1, 1, 0])
+
+    def test_retry(self):
+        chan = _Chan("B")
+        conn = self._connector()
+        self._start(conn, [chan])
+        logging.disable(logging.CRITICAL)
+        try:
+            start = self.now[0]
+            self.assertAlmostEqual(conn.step(), 1.0)
+            self.now[0] = start + 1.0
+            self.assertAlmostEqual(conn.step(), 2.0)
+            self.now[0] = start + 3.0
+            self.assertAlmostEqual(conn.step(), 4.0)
+            self.reachable.add("B")
+            self.now[0] = start + 7.0
+            self.assertIsNone(conn.step())
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(chan.attached, 1)
+        self.assertEqual([t for pvs, t in self.calls], [5.0, 1.0, 1.0, 1.0])
+        self.assertEqual(conn.live, 1)
+
+    def test_remove(self):
+        chans = [_Chan("A"), _Chan("B")]
+        self.reachable = set(["A"])
+        conn = self._connector()
+        self._start(conn, chans)
+        conn.remove(chans[1])
+        self.assertIsNone(conn.step())
+        conn.remove(chans[0])
+        self.assertEqual((conn.live, conn.total), (0, 0))
+
+    def test_remove_starting(self):
+        # channel removed while its startup connect is running is not attached
+        chans = [_Chan("A"), _Chan("B")]
+        self.reachable = set(["A", "B"])
+        self.delays = {"B": 3.0}
+        conn = self._connector()
+        logging.disable(logging.CRITICAL)
+        try:
+            conn.start(chans)
+        finally:
+            logging.disable(logging.NOTSET)
+        conn.remove(chans[1])
+        self._start(conn, [])
+        self.assertEqual([c.attached for c in chans], [1, 0])
+        self.assertEqual((conn.live, conn.total, conn.retries), (1, 1, []))
+
+    def test_remove_connecting(self):
+        # channel removed while its retry is connecting is not attached
+        chans = [_Chan("A"), _Chan("B")]
+        conn = self._connector()
+        self._start(conn, chans)
+        self.reachable = set(["A", "B"])
+        connect = conn.connect
+        def removing(pvs, timeout, throw):
+            conn.remove(chans[0])
+            return connect(pvs, timeout, throw)
+        conn.connect = removing
+        self.now[0] += 1.0
+        capture = _Capture()
+        logger.addHandler(capture)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        try:
+            self.assertIsNone(conn.step())
+        finally:
+            logger.setLevel(logging.NOTSET)
+            logger.propagate = True
+            logger.removeHandler(capture)
+        self.assertEqual([c.attached for c in chans], [0, 1])
+        self.assertEqual((conn.live, conn.total), (1, 1))
+        # removed channel is not reported connected
+        self.assertEqual(capture.messages, ["(B, b) connected after 1 retries"])
+        conn.remove(chans[1])
+        self.assertEqual((conn.live, conn.total, conn.removed), (0, 0, set()))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
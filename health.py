@@ -0,0 +1,158 @@
+from threading import Lock
+import time
+
+import unittest
+
+
+# Breaker states
+CLOSED = "closed" # calls pass
+OPEN = "open" # calls are skipped until retry time
+HALF_OPEN = "half-open" # one probe call passes, its result closes or reopens the breaker
+
+# predefined constants
+BREAKER_THRESHOLD = 3 # consecutive failures opening the breaker
+BREAKER_DELAY = 1.0 # seconds, first open time
+BREAKER_DELAY_MAX = 60.0 # seconds
+
+
+# Circuit breaker
+#   opens after 'threshold' consecutive failures, while open calls are skipped,
+#   after open time one probe is allowed, open time doubles each time
+#   the probe fails up to 'limit' and resets when it succeeds
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, delay=BREAKER_DELAY, limit=BREAKER_DELAY_MAX, clock=time.time):
+        self.threshold = threshold
+        self.base = delay
+        self.limit = limit
+        self.clock = clock
+        self.lock = Lock()
+        self.state = CLOSED
+        self.failures = 0 # consecutive
+        self.delay = delay # current open time
+        self.until = 0.0 # time of the next probe
+
+        # counters
+        self.opened = 0
+        self.skipped = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = self.clock()
+            if now < self.until:
+                self.skipped += 1
+                return False
+            # probe, next one only if this one gives no result in time
+            self.state = HALF_OPEN
+            self.until = now + self.delay
+            return True
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.delay = self.base
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.delay = min(2*self.delay, self.limit)
+            elif self.state == OPEN or self.failures < self.threshold:
+                return
+            self.state = OPEN
+            self.until = self.clock() + self.delay
+            self.opened += 1
+
+
+# Server health
+#   circuit breakers of IOCs and MQTT devices keyed by
+#   PV prefix (before '_') and topic prefix (before '/')
+class ServerHealth:
+    def __init__(self, threshold=BREAKER_THRESHOLD, delay=BREAKER_DELAY, limit=BREAKER_DELAY_MAX):
+        self.params = (threshold, delay, limit)
+        self.breakers = {} # (type, name) -> CircuitBreaker
+        self.lock = Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            threshold=cfg.get("threshold", BREAKER_THRESHOLD),
+            delay=cfg.get("delay", BREAKER_DELAY),
+            limit=cfg.get("limit", BREAKER_DELAY_MAX),
+        )
+
+    def breaker(self, type, name):
+        key = (type, name)
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(*self.params)
+            return self.breakers[key]
+
+    def ioc(self, pv):
+        return self.breaker("ioc", pv.split("_", 1)[0])
+
+    def mqtt(self, topic):
+        return self.breaker("mqtt", topic.split("/", 1)[0])
+
+    def count(self, state):
+        return len([b for b in list(self.breakers.values()) if b.state == state])
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def test_breaker(self):
+        now = [0.0]
+        br = CircuitBreaker(2, 1.0, 4.0, clock=lambda: now[0])
+        br.failure()
+        self.assertTrue(br.allow())
+        br.failure()
+        self.assertEqual(br.state, OPEN)
+        self.assertFalse(br.allow())
+        now[0] = 1.0
+        self.assertTrue(br.allow()) # probe
+        self.assertEqual(br.state, HALF_OPEN)
+        self.assertFalse(br.allow())
+        br.failure()
+        self.assertEqual((br.state, br.delay), (OPEN, 2.0))
+        now[0] = 2.5
+        self.assertFalse(br.allow())
+        now[0] = 3.0
+        self.assertTrue(br.allow())
+        br.success()
+        self.assertEqual((br.state, br.delay, br.opened, br.skipped), (CLOSED, 1.0, 2, 3))
+        self.assertTrue(br.allow())
+
+    def test_breaker_limit(self):
+        now = [0.0]
+        br = CircuitBreaker(1, 1.0, 4.0, clock=lambda: now[0])
+        br.failure()
+        for i in range(5):
+            now[0] = br.until
+            self.assertTrue(br.allow())
+            br.failure()
+        self.assertEqual(br.delay, 4.0)
+
+    def test_probe_lost(self):
+        # probe without result allows the next one after open time
+        now = [0.0]
+        br = CircuitBreaker(1, 1.0, clock=lambda: now[0])
+        br.failure()
+        now[0] = 1.0
+        self.assertTrue(br.allow())
+        now[0] = 2.0
+        self.assertTrue(br.allow())
+
+    def test_health(self):
+        health = ServerHealth()
+        self.assertIs(health.ioc("VEPP3_H_DI-I"), health.ioc("VEPP3_H_DO-SP"))
+        self.assertIsNot(health.ioc("VEPP3_H_DI-I"), health.mqtt("VEPP3/H/DI"))
+        self.assertIs(health.mqtt("VEPP3/H/DI"), health.breaker("mqtt", "VEPP3"))
+        for i in range(BREAKER_THRESHOLD):
+            health.ioc("VEPP3_X").failure()
+        self.assertEqual((health.count(OPEN), health.count(CLOSED)), (1, 1))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
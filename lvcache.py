@@ -0,0 +1,262 @@
+from threading import Thread, Lock
+import logging
+import time
+
+import numpy as np
+
+import unittest
+from testfakes import Client
+
+
+logger = logging.getLogger(__name__)
+
+# predefined constants
+REPUBLISH_FLOW = { # flow control of cached state republished after reconnect
+    "window": 16, # messages in flight
+    "msg_rate": 2000, # messages per second
+    "msg_burst": 100,
+}
+
+
+# Last value of a channel
+#   pm channels keep messages of the last published value or, if the converter
+#   sends patches to previous waveforms (changed segments), the value itself
+#   to be encoded as a full one when restored, values not published
+#   (server down) are kept too and restored instead;
+#   mp channels keep the last decoded value
+class LastValue:
+    def __init__(self, conv):
+        self.conv = conv
+        self.lock = Lock()
+        self.messages = None
+        self.value = None
+        self.pending = None # newer value than published ones
+        self.resync = False # next decoded value may be a retained copy of the last one
+
+    # encodes value for publishing and keeps the result
+    def encode(self, topic, value):
+        with self.lock:
+            messages = self.conv.encode(topic, value)
+            self.pending = None
+            if getattr(self.conv, "changed", False):
+                self.value = value
+            else:
+                self.messages = messages
+            return messages
+
+    # keeps value that was not published
+    def skip(self, value):
+        with self.lock:
+            self.pending = value
+
+    # messages restoring the last state, empty if nothing was published or skipped
+    def restore(self, topic):
+        with self.lock:
+            value, self.pending = self.pending, None
+            changed = getattr(self.conv, "changed", False)
+            if value is None and changed:
+                value = self.value
+            if value is not None:
+                if changed:
+                    # full waveform, following patches are based on it
+                    self.value = value
+                    self.conv.prev = None
+                self.messages = self.conv.encode(topic, value)
+            return list(self.messages or [])
+
+    # keeps decoded value, returns False for the first value after resubscribing
+    # if it is equal to the last one (retained message sent again by broker)
+    def decoded(self, value):
+        with self.lock:
+            resync, self.resync = self.resync, False
+            same = resync and self.value is not None and np.array_equal(value, self.value)
+            self.value = value
+            return not same
+
+
+def _spawn(func, *args):
+    thread = Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+# Broker reconnect recovery
+#   on every connect but the first one restores subscriptions of mp channels
+#   in one subscribe call and republishes last values of pm channels
+#   through rate-limited flow control in background;
+#   called from MQTT client thread
+class Recovery:
+    def __init__(self, client, flow, spawn=_spawn, clock=time.time):
+        self.client = client
+        self.flow = flow
+        self.spawn = spawn
+        self.clock = clock
+        self.generation = 0 # republishing of older reconnects stops
+        self.lock = Lock()
+
+        # counters
+        self.connects = 0
+        self.republished = 0 # messages
+        self.failed = 0
+        self.duration = 0.0 # seconds, time of the last recovery
+
+    def connected(self, chans):
+        self.connects += 1
+        if self.connects == 1:
+            return
+        start = self.clock()
+        subs = []
+        for chan in chans:
+            if chan.direction == "mp" and chan.subscribed and not chan.closed:
+                subs.append((chan.subTopic(), 0))
+                chan.last.resync = True
+        if subs:
+            self.client.subscribe(subs)
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        pm = [chan for chan in chans if chan.direction == "pm"]
+        logger.info("mqtt: reconnected, %d topics subscribed, republishing %d channels" % (len(subs), len(pm)))
+        self.spawn(self._republish, pm, generation, start)
+
+    def _republish(self, chans, generation, start):
+        count = 0
+        for chan in chans:
+            if generation != self.generation:
+                return
+            if chan.closed:
+                continue
+            try:
+                for topic, payload in chan.last.restore(chan.chan):
+                    self.flow.publish(self.client, topic, payload, chan.qos, chan.retain)
+                    self.republished += 1
+                    count += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Unable to republish %s: %s", chan.chan, e, extra={"ratekey": chan.chan})
+        self.duration = self.clock() - start
+        logger.info("mqtt: %d messages republished in %.3f s" % (count, self.duration))
+
+
+# Unittests
+class _Conv:
+    def __init__(self, changed=False):
+        self.changed = changed
+        self.prev = None
+
+    def encode(self, topic, value):
+        if self.changed and self.prev is not None:
+            return [(topic + "/patch", value)]
+        self.prev = value
+        return [(topic, value)]
+
+class _Chan:
+    def __init__(self, chan, direction, conv=None):
+        self.chan = chan
+        self.direction = direction
+        self.subscribed = direction == "mp"
+        self.closed = False
+        self.qos = 1
+        self.retain = False
+        self.last = LastValue(conv or _Conv())
+
+    def subTopic(self):
+        return self.chan + "/#"
+
+class _Flow:
+    def __init__(self):
+        self.qos = []
+
+    def publish(self, client, topic, payload, qos=0, retain=False):
+        if payload == "fail":
+            raise RuntimeError("test")
+        self.qos.append(qos)
+        return client.publish(topic, payload, qos, retain)
+
+class Test(unittest.TestCase):
+    def test_last_value(self):
+        last = LastValue(_Conv())
+        self.assertEqual(last.restore("t"), [])
+        last.encode("t", 1)
+        last.encode("t", 2)
+        self.assertEqual(last.restore("t"), [("t", 2)])
+
+    def test_last_patched(self):
+        conv = _Conv(changed=True)
+        last = LastValue(conv)
+        last.encode("t", 1)
+        self.assertEqual(last.encode("t", 2), [("t/patch", 2)])
+        # restored as full value, next one is a patch to it
+        self.assertEqual(last.restore("t"), [("t", 2)])
+        self.assertEqual(last.encode("t", 3), [("t/patch", 3)])
+
+    def test_last_skipped(self):
+        last = LastValue(_Conv())
+        last.encode("t", 1)
+        last.skip(2)
+        last.skip(3)
+        self.assertEqual(last.restore("t"), [("t", 3)])
+        self.assertEqual(last.restore("t"), [("t", 3)])
+        last.skip(4)
+        last.encode("t", 5)
+        self.assertEqual(last.restore("t"), [("t", 5)])
+        # patched value is restored as full one
+        last = LastValue(_Conv(changed=True))
+        last.encode("t", 1)
+        last.skip(2)
+        self.assertEqual(last.restore("t"), [("t", 2)])
+        self.assertEqual(last.encode("t", 3), [("t/patch", 3)])
+
+    def test_decoded(self):
+        last = LastValue(_Conv())
+        self.assertTrue(last.decoded(np.arange(3)))
+        self.assertTrue(last.decoded(np.arange(3)))
+        last.resync = True
+        self.assertFalse(last.decoded(np.arange(3)))
+        self.assertTrue(last.decoded(np.arange(3)))
+        last.resync = True
+        self.assertTrue(last.decoded(np.arange(4)))
+
+    def test_recovery(self):
+        client, flow = Client(), _Flow()
+        spawned = []
+        rec = Recovery(client, flow, spawn=lambda f, *a: spawned.append((f, a)))
+        a, b, c = _Chan("a", "pm"), _Chan("b", "mp"), _Chan("c", "pm")
+        c.closed = True
+        chans = [a, b, c, _Chan("d", "pm")]
+        a.last.encode("a", 5)
+        c.last.encode("c", 6)
+        logging.disable(logging.CRITICAL)
+        try:
+            rec.connected(chans)
+            self.assertEqual((client.subs, spawned), ([], []))
+            rec.connected(chans)
+            self.assertEqual(client.subs, [[("b/#", 0)]])
+            self.assertTrue(b.last.resync)
+            f, args = spawned[0]
+            f(*args)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual((client.pubs, flow.qos), ([("a", 5)], [1]))
+        self.assertEqual((rec.republished, rec.failed), (1, 0))
+
+    def test_recovery_restart(self):
+        # republishing stops when broker reconnects again
+        client = Client()
+        spawned = []
+        rec = Recovery(client, _Flow(), spawn=lambda f, *a: spawned.append((f, a)))
+        a = _Chan("a", "pm")
+        a.last.encode("a", "fail")
+        logging.disable(logging.CRITICAL)
+        try:
+            rec.connected([a])
+            rec.connected([a])
+            rec.connected([a])
+            for f, args in spawned:
+                f(*args)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual((rec.republished, rec.failed), (0, 1))
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
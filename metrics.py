@@ -0,0 +1,335 @@
+from threading import Thread
+import bisect
+import json
+import logging
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import unittest
+from testfakes import Client
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "ca_mqtt_gw_"
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+
+# Histogram
+#   counts observed values by bucket upper bounds,
+#   updated by one thread at a time, so no locking is done
+class Histogram:
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = sorted(bounds)
+        self.counts = [0]*(len(self.bounds) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # cumulative counts as [(upper bound, count), ...] ending with +Inf
+    def buckets(self):
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+# Channel metrics
+#   counters of one gateway channel, the channel updates them
+#   from the thread handling it; publish queue, deadband and decimation filters and
+#   waveform accumulator counters are read from the objects themselves
+class ChanMetrics:
+    def __init__(self, chan, pv, direction):
+        self.labels = (("chan", chan), ("pv", pv), ("direction", direction))
+        self.received = 0 # mp only, pm ones are counted by the queue
+        self.published = 0 # values sent to MQTT (pm) or put to CA (mp)
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.skipped = 0 # values not sent while server is down
+        self.latency = Histogram() # CA callback to publish (pm)
+        self.assembly = Histogram() # first to last waveform segment (mp)
+        self.queue = None
+        self.deadband = None
+        self.decimation = None
+        self.accum = None
+
+    def sent(self, payload):
+        self.messages += 1
+        self.bytes += len(payload)
+
+    def values(self):
+        values = {
+            "received": self.received,
+            "published": self.published,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "dropped": 0,
+            "coalesced": 0,
+            "filtered": 0,
+            "queue_depth": 0,
+            "evicted": 0,
+        }
+        if self.queue is not None:
+            values["received"] = self.queue.received
+            values["dropped"] = self.queue.dropped
+            values["coalesced"] = self.queue.coalesced
+            values["queue_depth"] = len(self.queue)
+        if self.deadband is not None:
+            values["filtered"] = self.deadband.suppressed
+        if self.decimation is not None:
+            values["filtered"] += self.decimation.suppressed
+        if self.accum is not None:
+            values["evicted"] = self.accum.evicted
+        return values
+
+
+# name, type, help, ChanMetrics.values() key
+COUNTERS = [
+    ("updates_received_total", "counter", "Values received from CA (pm) or MQTT messages received (mp)", "received"),
+    ("updates_published_total", "counter", "Values published to MQTT (pm) or put to CA (mp)", "published"),
+    ("updates_dropped_total", "counter", "Values dropped by bounded delivery queue", "dropped"),
+    ("updates_coalesced_total", "counter", "Values replaced by newer ones in latest delivery queue", "coalesced"),
+    ("updates_filtered_total", "counter", "Values suppressed by deadband filter or max rate", "filtered"),
+    ("errors_total", "counter", "Values failed to publish or put", "errors"),
+    ("updates_skipped_total", "counter", "Values not sent while circuit breaker of server is open", "skipped"),
+    ("messages_sent_total", "counter", "MQTT messages sent", "messages"),
+    ("bytes_sent_total", "counter", "MQTT payload bytes sent", "bytes"),
+    ("queue_depth", "gauge", "Values waiting in publish queue", "queue_depth"),
+    ("waveforms_evicted_total", "counter", "Incomplete waveforms dropped", "evicted"),
+]
+HISTOGRAMS = [
+    ("publish_latency_seconds", "Time from CA callback to MQTT publish", "latency"),
+    ("waveform_assembly_seconds", "Time from first to last segment of received waveform", "assembly"),
+]
+
+def format_labels(labels, extra=()):
+    pairs = []
+    for name, value in tuple(labels) + tuple(extra):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append("%s=\"%s\"" % (name, value))
+    return "{" + ",".join(pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+# Gateway metrics
+#   collection of channel metrics, rendered in Prometheus text format
+#   or as JSON status
+class Metrics:
+    def __init__(self):
+        self.chans = []
+        self.globals = [] # (name, type, help, function returning value)
+        self.start = time.time()
+
+    def add(self, chanmetrics):
+        self.chans.append(chanmetrics)
+        return chanmetrics
+
+    def remove(self, chanmetrics):
+        self.chans.remove(chanmetrics)
+
+    # adds gateway-wide metric read with 'func' when rendered
+    def add_global(self, name, type, help, func):
+        self.globals.append((name, type, help, func))
+
+    def prometheus(self):
+        chans = [(m, m.values()) for m in list(self.chans)]
+        lines = []
+        for name, type, help, key in COUNTERS:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, type))
+            for m, values in chans:
+                lines.append("%s%s%s %s" % (PREFIX, name, format_labels(m.labels), values[key]))
+        for name, help, attr in HISTOGRAMS:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+            for m, values in chans:
+                hist = getattr(m, attr)
+                if hist.count == 0:
+                    continue
+                for bound, count in hist.buckets():
+                    lines.append("%s%s_bucket%s %d" % (PREFIX, name, format_labels(m.labels, [("le", _number(bound))]), count))
+                lines.append("%s%s_sum%s %s" % (PREFIX, name, format_labels(m.labels), _number(hist.sum)))
+                lines.append("%s%s_count%s %d" % (PREFIX, name, format_labels(m.labels), hist.count))
+        for name, type, help, func in self.globals:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, type))
+            lines.append("%s%s %s" % (PREFIX, name, _number(func())))
+        lines.append("# HELP %suptime_seconds Time since gateway start" % PREFIX)
+        lines.append("# TYPE %suptime_seconds gauge" % PREFIX)
+        lines.append("%suptime_seconds %s" % (PREFIX, _number(time.time() - self.start)))
+        return "\n".join(lines) + "\n"
+
+    def status(self):
+        chans = []
+        for m in list(self.chans):
+            chan = dict(m.labels)
+            chan.update(m.values())
+            for name, help, attr in HISTOGRAMS:
+                hist = getattr(m, attr)
+                if hist.count:
+                    chan[attr + "_avg"] = hist.sum/hist.count
+            chans.append(chan)
+        status = {"time": time.time(), "uptime": time.time() - self.start, "channels": chans}
+        for name, type, help, func in self.globals:
+            status[name] = func()
+        return status
+
+
+# Metrics HTTP endpoint
+#   serves Prometheus text format on /metrics from a daemon thread
+class MetricsServer:
+    def __init__(self, metrics, port, address="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format % args)
+
+        self.httpd = HTTPServer((address, port), Handler)
+        self.thread = Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Metrics status publisher
+#   periodically publishes JSON status to MQTT topic
+class StatusPublisher:
+    def __init__(self, metrics, client, topic, period=10.0):
+        self.metrics = metrics
+        self.client = client
+        self.topic = topic
+        self.period = period
+        self.running = False
+        self.thread = Thread(target=self._loop)
+        self.thread.daemon = True
+
+    def publish(self):
+        self.client.publish(self.topic, json.dumps(self.metrics.status(), sort_keys=True))
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def _loop(self):
+        while self.running:
+            time.sleep(self.period)
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("Unable to publish status to %s" % self.topic)
+
+
+# Unittests
+class _Queue:
+    def __init__(self):
+        self.received = 5
+        self.dropped = 1
+        self.coalesced = 2
+
+    def __len__(self):
+        return 3
+
+class Test(unittest.TestCase):
+    def test_histogram(self):
+        hist = Histogram([1, 2, 4])
+        for v in [0.5, 1, 1.5, 3, 10]:
+            hist.observe(v)
+        self.assertEqual(hist.buckets(), [(1, 2), (2, 3), (4, 4), (float("inf"), 5)])
+        self.assertEqual(hist.sum, 16.0)
+        self.assertEqual(hist.count, 5)
+
+    def test_values(self):
+        m = ChanMetrics("a/b", "A_B", "pm")
+        m.queue = _Queue()
+        m.sent(b"abc")
+        m.published += 1
+        values = m.values()
+        self.assertEqual(values["received"], 5)
+        self.assertEqual(values["queue_depth"], 3)
+        self.assertEqual((values["dropped"], values["coalesced"]), (1, 2))
+        self.assertEqual((values["messages"], values["bytes"]), (1, 3))
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        m = metrics.add(ChanMetrics("a/\"b\"", "A_B", "pm"))
+        m.published = 7
+        m.latency.observe(0.003)
+        text = metrics.prometheus()
+        self.assertIn("# TYPE ca_mqtt_gw_updates_published_total counter\n", text)
+        self.assertIn("ca_mqtt_gw_updates_published_total{chan=\"a/\\\"b\\\"\",pv=\"A_B\",direction=\"pm\"} 7\n", text)
+        self.assertIn("ca_mqtt_gw_publish_latency_seconds_bucket{chan=\"a/\\\"b\\\"\",pv=\"A_B\",direction=\"pm\",le=\"0.0025\"} 0\n", text)
+        self.assertIn("ca_mqtt_gw_publish_latency_seconds_bucket{chan=\"a/\\\"b\\\"\",pv=\"A_B\",direction=\"pm\",le=\"+Inf\"} 1\n", text)
+        self.assertNotIn("ca_mqtt_gw_waveform_assembly_seconds_bucket", text)
+
+    def test_global(self):
+        metrics = Metrics()
+        metrics.add_global("puts_failed_total", "counter", "Failed puts", lambda: 3)
+        self.assertIn("# TYPE ca_mqtt_gw_puts_failed_total counter\nca_mqtt_gw_puts_failed_total 3\n", metrics.prometheus())
+        self.assertEqual(metrics.status()["puts_failed_total"], 3)
+
+    def test_status(self):
+        metrics = Metrics()
+        m = metrics.add(ChanMetrics("a", "A", "mp"))
+        m.received = 2
+        m.assembly.observe(0.5)
+        client = Client()
+        StatusPublisher(metrics, client, "gw/status").publish()
+        topic, payload = client.pubs[0]
+        self.assertEqual(topic, "gw/status")
+        chan = json.loads(payload)["channels"][0]
+        self.assertEqual((chan["chan"], chan["received"], chan["assembly_avg"]), ("a", 2, 0.5))
+
+    def test_http(self):
+        try:
+            from urllib2 import urlopen, HTTPError
+        except ImportError:
+            from urllib.request import urlopen
+            from urllib.error import HTTPError
+        metrics = Metrics()
+        metrics.add(ChanMetrics("a", "A", "pm"))
+        server = MetricsServer(metrics, 0)
+        server.start()
+        try:
+            url = "http://127.0.0.1:%d" % server.httpd.server_port
+            text = urlopen(url + "/metrics").read().decode("utf-8")
+            self.assertIn("ca_mqtt_gw_queue_depth{chan=\"a\",pv=\"A\",direction=\"pm\"} 0\n", text)
+            with self.assertRaises(HTTPError):
+                urlopen(url + "/abc")
+        finally:
+            server.stop()
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,12 +1,22 @@
 import numpy as np
 import struct
+import zlib
+import time
 
 from wfaccum import WfAccum
 
 import unittest
 
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
 # MQTT data converter base class
 class MqttConv:
+    segmented = False # value is sent as several messages to '<topic>/<segment index>'
+
     def __init__(self, convcfg):
         pass
 
@@ -55,76 +65,362 @@ class MqttConvWfInt1(MqttConv): # TODO: remove this type from proto
         return struct.unpack(">iii", payload)[2]
 
 
-class MqttConvWfInt(MqttConv):
-    def __init__(self, convcfg):
+# Segmented waveform converter
+#   v1 segment is (wfid: int32, size: int32, data: array of 'dtype'), all big-endian,
+#   segment position is given by its index in topic only
+#   in changed segments mode only changed parts of the waveform are sent as a patch
+#   to the previous one, v1 patch segment is
+#   (wfid: int32, -size: int32, base wfid: int32, segment count: int32, offset: int32, data),
+#   full waveform is sent at least once per refresh period
+#   v2 segment (see V2_HEADER) carries its element offset and count, value timestamp
+#   and CRC32 of header and data, full and patch segments differ by base wfid only;
+#   'protocol' sets the version sent, both versions are received
+V2_MAGIC = 0xFF574632 # "\xffWF2", v1 wfid can be equal to it only after int32 wraparound
+V2_HEADER = ">Iiiiiiid" # magic, wfid, base wfid, size, offset, count, segment count, time
+V2_CRC = struct.calcsize(V2_HEADER) # offset of crc
+V2_SIZE = V2_CRC + 4 # v2 metainfo size
+
+class MqttConvWf(MqttConv):
+    segmented = True
+
+    def __init__(self, convcfg, dtype):
         MqttConv.__init__(self, convcfg)
         self.wfidcnt = 0
 
+        self.dtype = np.dtype(dtype).newbyteorder(">") # wire item type
+        isize = self.dtype.itemsize
         self.segsize = convcfg["segment_size_max"]
+        self.protocol = convcfg.get("protocol", 1)
+        if self.protocol not in (1, 2):
+            raise ValueError("Unknown waveform protocol version %s" % self.protocol)
         self.misize = 2*4 # metainfo size
-        if self.segsize - self.misize < 4:
-            raise ValueError("Too small segment max size (%s), must be %s at least" % (self.segsize, self.misize + 4))
+        if self.segsize - (self.misize if self.protocol == 1 else V2_SIZE) < isize:
+            raise ValueError("Too small segment max size (%s), must be %s at least" % (
+                self.segsize, (self.misize if self.protocol == 1 else V2_SIZE) + isize
+            ))
+        self.sds2 = (self.segsize - V2_SIZE)//isize # v2 segment data size in items
+        self.stamp = None # timestamp of the last received v2 waveform
+        self.corrupted = 0 # received segments failed checks
+
+        self.sds = (self.segsize - self.misize)//isize # segment data size in items
+        self.segdtype = self.segment_dtype(self.sds)
+
+        self.changed = convcfg.get("changed_segments", False)
+        self.refresh = convcfg.get("refresh_period", 10.0) # seconds
+        self.pmisize = 5*4 # patch metainfo size
+        self.psds = (self.segsize - self.pmisize)//isize # patch segment data size
+        if self.changed and self.psds < 1:
+            raise ValueError("Too small segment max size (%s) for changed segments, must be %s at least" % (self.segsize, self.pmisize + isize))
+        self.prev = None # last sent waveform (wfid, array, time of last full one)
 
         self.si_dig = convcfg["segment_index_digits"]
         self.si_mod = 10**self.si_dig
+        self.segtopics = {} # cached segment topics for each waveform topic
 
-        self.wfaccum = WfAccum(convcfg["waveform_queue_size"])
+        self.wfaccum = WfAccum(
+            convcfg["waveform_queue_size"],
+            convcfg.get("waveform_budget"),
+            convcfg.get("waveform_shared_budget"),
+        )
 
     def wfid_next(self):
         wfid = self.wfidcnt;
-        self.wfidcnt += 1
+        self.wfidlast = wfid
+        # wrap around as int32
+        self.wfidcnt = wfid + 1 if wfid < 0x7FFFFFFF else -0x80000000
         return wfid
 
+    def segment_dtype(self, count):
+        return np.dtype([("wfid", ">i4"), ("size", ">i4"), ("data", self.dtype, (count,))])
+
+    def segment2_dtype(self, count):
+        return np.dtype([
+            ("magic", ">u4"), ("wfid", ">i4"), ("base", ">i4"), ("size", ">i4"),
+            ("offset", ">i4"), ("count", ">i4"), ("segs", ">i4"), ("time", ">f8"), ("crc", ">u4"),
+            ("data", self.dtype, (count,)),
+        ])
+
+    def patch_dtype(self, count):
+        return np.dtype([
+            ("wfid", ">i4"), ("size", ">i4"), ("base", ">i4"), ("count", ">i4"), ("offset", ">i4"),
+            ("data", self.dtype, (count,)),
+        ])
+
     def segidx(self, num):
         if num >= self.si_mod:
             raise ValueError("Segment index is greater than allowed max value (%d > %d)" % (num, self.si_mod - 1))
         return str(num).zfill(self.si_dig)
 
-    def encode(self, topic, value):
+    def segtopic_list(self, topic, count):
+        topics = self.segtopics.get(topic)
+        if topics is None:
+            topics = []
+            self.segtopics[topic] = topics
+        if len(topics) < count:
+            base = topic if topic.endswith("/") else topic + "/"
+            for i in range(len(topics), count):
+                topics.append(base + self.segidx(i))
+        return topics
+
+    def encode(self, topic, value, stamp=None):
+        if stamp is None:
+            # CA values have their timestamp
+            stamp = getattr(value, "timestamp", None) or time.time()
+        if not self.changed:
+            return self.encode_full(topic, value, stamp)
+
+        array = np.asarray(value).astype(self.dtype.newbyteorder("="))
+        now = time.time()
+        if self.prev is None or len(self.prev[1]) != len(array) or now - self.prev[2] >= self.refresh:
+            base = now
+            output = self.encode_full(topic, array, stamp)
+        else:
+            base = self.prev[2]
+            output = self.encode_patch(topic, array, self.prev[0], self.prev[1], stamp)
+            if not output:
+                return output
+        self.prev = (self.wfidlast, array, base)
+        return output
+
+    # converts the whole waveform into one buffer with segment headers interleaved,
+    # payloads are memoryview slices of this buffer
+    def encode_full(self, topic, value, stamp=0.0):
+        array = np.asarray(value)
+        size = len(array)
+        if self.protocol == 2:
+            return self.encode_v2(topic, array, np.arange(0, size, self.sds2), None, stamp)
+
         wfid = self.wfid_next()
-    
-        if not topic.endswith("/"):
-            topic += "/"
+        sds = self.sds
+        segcnt = (size - 1)//sds + 1
+        topics = self.segtopic_list(topic, segcnt)
+
+        buf = bytearray(segcnt*self.misize + size*self.dtype.itemsize)
+
+        full = size//sds # number of full segments
+        if full > 0:
+            segs = np.frombuffer(buf, dtype=self.segdtype, count=full)
+            segs["wfid"] = wfid
+            segs["size"] = size
+            segs["data"] = array[:full*sds].reshape(full, sds)
+        if full < segcnt:
+            rest = size - full*sds
+            seg = np.frombuffer(buf, dtype=self.segment_dtype(rest), offset=full*self.segdtype.itemsize)
+            seg["wfid"] = wfid
+            seg["size"] = size
+            seg["data"] = array[full*sds:]
+
+        view = memoryview(buf)
+        step = self.segdtype.itemsize
+        return [(topics[i], view[i*step:(i + 1)*step]) for i in range(segcnt)]
+
+    # encodes blocks of 'array' that differ from 'prev' as a patch to waveform 'base'
+    def encode_patch(self, topic, array, base, prev, stamp=0.0):
+        size = len(array)
+        psds = self.psds if self.protocol == 1 else self.sds2
+        changed = np.flatnonzero(np.logical_or.reduceat(array != prev, np.arange(0, size, psds)))
+        if len(changed) == 0:
+            return []
+        if self.protocol == 2:
+            return self.encode_v2(topic, array, changed*psds, base, stamp)
 
-        array = value
+        wfid = self.wfid_next()
+        segcnt = len(changed)
+        topics = self.segtopic_list(topic, segcnt)
+        tail = changed[-1]*psds + psds > size # last changed block is shorter
+        full = segcnt - 1 if tail else segcnt
+
+        pdtype = self.patch_dtype(psds)
+        rest = size - changed[-1]*psds
+        buf = bytearray(full*pdtype.itemsize + (self.patch_dtype(rest).itemsize if tail else 0))
+        parts = []
+        if full > 0:
+            segs = np.frombuffer(buf, dtype=pdtype, count=full)
+            segs["offset"] = changed[:full]*psds
+            segs["data"] = array[:size - size%psds].reshape(-1, psds)[changed[:full]]
+            parts.append(segs)
+        if tail:
+            seg = np.frombuffer(buf, dtype=self.patch_dtype(rest), offset=full*pdtype.itemsize)
+            seg["offset"] = changed[-1]*psds
+            seg["data"] = array[changed[-1]*psds:]
+            parts.append(seg)
+        for part in parts:
+            part["wfid"] = wfid
+            part["size"] = -size
+            part["base"] = base
+            part["count"] = segcnt
+
+        view = memoryview(buf)
+        step = pdtype.itemsize
+        return [(topics[i], view[i*step:(i + 1)*step]) for i in range(segcnt)]
+
+    # encodes blocks of 'array' starting at 'offsets' as v2 segments,
+    # the whole waveform if 'base' is None or a patch to waveform 'base'
+    def encode_v2(self, topic, array, offsets, base, stamp):
         size = len(array)
+        if size == 0:
+            return []
+        wfid = self.wfid_next()
+        sds = self.sds2
+        segcnt = len(offsets)
+        topics = self.segtopic_list(topic, segcnt)
+        tail = offsets[-1] + sds > size # last block is shorter
+        full = segcnt - 1 if tail else segcnt
+
+        sdtype = self.segment2_dtype(sds)
+        rest = size - offsets[-1]
+        buf = bytearray(full*sdtype.itemsize + (self.segment2_dtype(rest).itemsize if tail else 0))
+        parts = []
+        if full > 0:
+            segs = np.frombuffer(buf, dtype=sdtype, count=full)
+            segs["count"] = sds
+            if base is None:
+                segs["data"] = array[:full*sds].reshape(full, sds)
+            else:
+                segs["data"] = array[:size - size%sds].reshape(-1, sds)[offsets[:full]//sds]
+            parts.append(segs)
+        if tail:
+            seg = np.frombuffer(buf, dtype=self.segment2_dtype(rest), offset=full*sdtype.itemsize)
+            seg["count"] = rest
+            seg["data"] = array[offsets[-1]:]
+            parts.append(seg)
+        for part in parts:
+            part["magic"] = V2_MAGIC
+            part["wfid"] = wfid
+            part["base"] = wfid if base is None else base
+            part["size"] = size
+            part["segs"] = segcnt
+            part["time"] = stamp
+        if full > 0:
+            segs["offset"] = offsets[:full]
+        if tail:
+            seg["offset"] = offsets[-1]
+
+        view = memoryview(buf)
+        step = sdtype.itemsize
+        bounds = [i*step for i in range(segcnt)] + [len(buf)]
         output = []
-        sds = (self.segsize - self.misize)//4 # segment data size // sizeof(int)
-
-        for i in range((size - 1)//sds + 1):
-            meta = struct.pack(">ii", wfid, size)
-            data = array[i*sds:(i+1)*sds].astype(">i4").tobytes()
-            output.append((
-                topic + self.segidx(i),
-                meta + data,
-            ))
-
+        for i in range(segcnt):
+            start, end = bounds[i], bounds[i + 1]
+            crc = zlib.crc32(_buffer(buf, start + V2_SIZE, end - start - V2_SIZE), zlib.crc32(_buffer(buf, start, V2_CRC)))
+            struct.pack_into(">I", buf, start + V2_CRC, crc & 0xFFFFFFFF)
+            output.append((topics[i], view[start:end]))
         return output
 
+    def decode_v2(self, segidx, payload):
+        if len(payload) < V2_SIZE:
+            self.corrupted += 1
+            raise ValueError("Segment is shorter than v2 header (%d bytes)" % len(payload))
+        magic, wfid, base, size, offset, count, segcnt, stamp = struct.unpack_from(V2_HEADER, payload)
+        crc, = struct.unpack_from(">I", payload, V2_CRC)
+        data = len(payload) - V2_SIZE
+        if data != count*self.dtype.itemsize:
+            self.corrupted += 1
+            raise ValueError("Segment data size mismatch (%d bytes, %d items of %d bytes expected)" % (data, count, self.dtype.itemsize))
+        if crc != zlib.crc32(_buffer(payload, V2_SIZE, data), zlib.crc32(_buffer(payload, 0, V2_CRC))) & 0xFFFFFFFF:
+            self.corrupted += 1
+            raise ValueError("Segment %d of waveform %d has wrong CRC" % (segidx, wfid))
+
+        array = np.frombuffer(payload, dtype=self.dtype, offset=V2_SIZE)
+        if base == wfid:
+            wf = self.wfaccum.push(wfid, segidx, size, array, offset)
+        else:
+            wf = self.wfaccum.push_patch(wfid, segidx, size, base, segcnt, offset, array)
+        if wf is not None:
+            self.stamp = stamp
+        return wf
+
     def decode(self, topic, payload):
         segidx = int(topic.split("/")[-1])
-        meta, data = payload[:self.misize], payload[self.misize:]
-        wfid, size = struct.unpack(">ii", meta)
-        array = np.ndarray(shape=(-1,), dtype='>i4', buffer=data).astype(np.int32)
-
-        wf = self.wfaccum.push(wfid, segidx, size, array)
+        if len(payload) >= 4 and struct.unpack_from(">I", payload)[0] == V2_MAGIC:
+            wf = self.decode_v2(segidx, payload)
+            return wf[1] if wf is not None else None
+
+        wfid, size = struct.unpack_from(">ii", payload)
+        if size < 0:
+            base, count, offset = struct.unpack_from(">iii", payload, self.misize)
+            array = np.frombuffer(payload, dtype=self.dtype, offset=self.pmisize)
+            wf = self.wfaccum.push_patch(wfid, segidx, -size, base, count, offset, array)
+        else:
+            # big-endian view of payload, converted by the accumulator
+            array = np.frombuffer(payload, dtype=self.dtype, offset=self.misize)
+            wf = self.wfaccum.push(wfid, segidx, size, array)
 
         if wf is not None:
             return wf[1]
         else:
             return None
 
+class MqttConvWfInt(MqttConvWf):
+    def __init__(self, convcfg):
+        MqttConvWf.__init__(self, convcfg, ">i4")
+
+
+# Compressed waveform converter
+#   integer waveform is delta encoded and compressed with zlib,
+#   compressed bytes are sent as a segmented waveform of bytes
+class MqttConvWfZ(MqttConvWf):
+    def __init__(self, convcfg, dtype):
+        MqttConvWf.__init__(self, convcfg, ">u1")
+        self.changed = False # compressed stream can't be patched
+        self.itype = np.dtype(dtype).newbyteorder("=") # waveform item type
+        self.level = convcfg.get("compress_level", 6)
+        self.limit = convcfg.get("waveform_budget") or 0 # max decompressed size
+
+    def encode(self, topic, value):
+        array = np.asarray(value).astype(self.itype)
+        delta = np.empty_like(array)
+        if len(array) > 0:
+            delta[0] = array[0]
+            np.subtract(array[1:], array[:-1], out=delta[1:])
+        data = zlib.compress(delta.astype(self.itype.newbyteorder(">")).tobytes(), self.level)
+        stamp = getattr(value, "timestamp", None) or time.time()
+        return MqttConvWf.encode(self, topic, np.frombuffer(data, dtype=np.uint8), stamp)
+
+    def decode(self, topic, payload):
+        data = MqttConvWf.decode(self, topic, payload)
+        if data is None:
+            return None
+        dec = zlib.decompressobj()
+        raw = dec.decompress(data.tobytes(), self.limit)
+        if dec.unconsumed_tail:
+            raise ValueError("Decompressed waveform is larger than %d bytes" % self.limit)
+        delta = np.frombuffer(raw, dtype=self.itype.newbyteorder(">"))
+        return np.cumsum(delta, dtype=self.itype)
+
+
+# Converter registry
+#   maps datatype names to converter factories, factory(convcfg) -> MqttConv
+_registry = {}
+
+def register(name, factory):
+    _registry[name] = factory
+
+def register_waveform(name, dtype):
+    register(name, lambda convcfg: MqttConvWf(convcfg, dtype))
+
+def types():
+    return sorted(_registry.keys())
+
 def get(dtype, convcfg):
-    if dtype == "int":
-        return MqttConvInt(convcfg)
-    elif dtype == "string":
-        return MqttConvString(convcfg)
-    elif dtype == "wfint1":
-        return MqttConvWfInt1(convcfg)
-    elif dtype == "wfint":
-        return MqttConvWfInt(convcfg)
-    else:
+    factory = _registry.get(dtype)
+    if factory is None:
         raise TypeError("Unknown type '%s'" % dtype)
+    return factory(convcfg)
+
+register("int", MqttConvInt)
+register("string", MqttConvString)
+register("wfint1", MqttConvWfInt1)
+register("wfint", MqttConvWfInt)
+register_waveform("wfchar", ">i1")
+register_waveform("wfuchar", ">u1")
+register_waveform("wfshort", ">i2")
+register_waveform("wfushort", ">u2")
+register_waveform("wfuint", ">u4")
+register_waveform("wffloat", ">f4")
+register_waveform("wfdouble", ">f8")
+register("wfshortz", lambda convcfg: MqttConvWfZ(convcfg, ">i2"))
+register("wfintz", lambda convcfg: MqttConvWfZ(convcfg, ">i4"))
 
 
 class Test(unittest.TestCase):
@@ -191,6 +487,33 @@ class Test(unittest.TestCase):
             for om, rm in zip(out, ref):
                 self.assertEqual(om, rm)
 
+    def test_wfint_enc_view(self):
+        conv = get("wfint", {
+            "segment_size_max": 4*4,
+            "segment_index_digits": 1,
+            "waveform_queue_size": 1,
+        })
+        value = np.array([0.5, -1.5, 2e6, 7.0])
+        out = conv.encode("a/", value)
+        self.assertEqual([t for t, p in out], ["a/0", "a/1"])
+        for t, p in out:
+            self.assertIsInstance(p, memoryview)
+        self.assertEqual(b"".join([p.tobytes() for t, p in out]), np.concatenate([
+            np.array([0, 4]), value[:2].astype(np.int32),
+            np.array([0, 4]), value[2:].astype(np.int32),
+        ]).astype(">i4").tobytes())
+        self.assertEqual(conv.encode("a/", np.arange(0)), [])
+
+    def test_wfint_wfid_wrap(self):
+        conv = get("wfint", {
+            "segment_size_max": 3*4,
+            "segment_index_digits": 1,
+            "waveform_queue_size": 1,
+        })
+        conv.wfidcnt = 0x7FFFFFFF
+        self.assertEqual(struct.unpack_from(">i", conv.encode("a", [1])[0][1])[0], 0x7FFFFFFF)
+        self.assertEqual(struct.unpack_from(">i", conv.encode("a", [1])[0][1])[0], -0x80000000)
+
     def test_wfint_dec(self):
         conv = get("wfint", {
             "segment_size_max": 3*4,
@@ -221,6 +544,256 @@ class Test(unittest.TestCase):
                 "waveform_queue_size": 1,
             })
 
+    def test_wf_types(self):
+        cfg = {
+            "segment_size_max": 8 + 16,
+            "segment_index_digits": 2,
+            "waveform_queue_size": 1,
+        }
+        for name, dtype, sds in [
+            ("wfchar", np.int8, 16),
+            ("wfuchar", np.uint8, 16),
+            ("wfshort", np.int16, 8),
+            ("wfushort", np.uint16, 8),
+            ("wfint", np.int32, 4),
+            ("wfuint", np.uint32, 4),
+            ("wffloat", np.float32, 4),
+            ("wfdouble", np.float64, 2),
+        ]:
+            conv = get(name, cfg)
+            value = (np.arange(37)*3 - 20).astype(dtype)
+            out = conv.encode("a", value)
+            self.assertEqual(len(out), (37 - 1)//sds + 1)
+            for topic, payload in out:
+                self.assertLessEqual(len(payload), cfg["segment_size_max"])
+            self.assertEqual(
+                out[1][1].tobytes(),
+                struct.pack(">ii", 0, 37) + value[sds:2*sds].astype(np.dtype(dtype).newbyteorder(">")).tobytes()
+            )
+            wf = None
+            for topic, payload in reversed(out):
+                self.assertIsNone(wf)
+                wf = conv.decode(topic, payload.tobytes())
+            self.assertEqual(wf.dtype, np.dtype(dtype))
+            self.assertTrue(np.array_equal(wf, value))
+
+    def test_wfintz(self):
+        conv = get("wfintz", {
+            "segment_size_max": 8 + 16,
+            "segment_index_digits": 3,
+            "waveform_queue_size": 1,
+            "compress_level": 9,
+        })
+        imax = 0x7FFFFFFF
+        for value in [
+            np.arange(1000)//7,
+            (1000*np.sin(np.arange(4096)/100.0)).astype(np.int32),
+            np.array([imax, -imax - 1, imax, 0, -1, -imax - 1]),
+            np.array([5]),
+            np.array([], dtype=np.int32),
+        ]:
+            out = conv.encode("a", value)
+            wf = None
+            for topic, payload in out:
+                self.assertIsNone(wf)
+                wf = conv.decode(topic, payload.tobytes())
+            self.assertEqual(wf.dtype, np.int32)
+            self.assertTrue(np.array_equal(wf, value))
+        self.assertLess(len(conv.encode("a", np.arange(1000)//7)), 1000*4//16)
+
+    def test_wfintz_limit(self):
+        cfg = {
+            "segment_size_max": 1208,
+            "segment_index_digits": 3,
+            "waveform_queue_size": 1,
+            "waveform_budget": 1000,
+        }
+        conv = get("wfintz", cfg)
+        out = conv.encode("a", np.zeros(1000, dtype=np.int32))
+        self.assertEqual(len(out), 1)
+        with self.assertRaises(ValueError):
+            conv.decode(out[0][0], out[0][1].tobytes())
+
+    def test_wf_changed(self):
+        cfg = {
+            "segment_size_max": 2*4 + 8*4,
+            "segment_index_digits": 2,
+            "waveform_queue_size": 1,
+            "changed_segments": True,
+            "refresh_period": 1000.0,
+        }
+        tx = get("wfint", cfg)
+        rx = get("wfint", cfg)
+        def send(value):
+            out = tx.encode("a", value)
+            wf = None
+            for topic, payload in out:
+                self.assertIsNone(wf)
+                wf = rx.decode(topic, payload.tobytes())
+            if out:
+                self.assertTrue(np.array_equal(wf, value))
+            return out
+
+        value = np.arange(27)
+        self.assertEqual(len(send(value)), 4) # full, 8 items per segment
+        self.assertEqual(send(value), [])
+        value[5] = 100
+        value[26] = 200
+        out = send(value)
+        self.assertEqual(len(out), 2) # 5 items per patch segment
+        self.assertEqual(struct.unpack_from(">iiiii", out[0][1]), (1, -27, 0, 2, 5))
+        self.assertEqual(struct.unpack_from(">iiiii", out[1][1]), (1, -27, 0, 2, 25))
+        self.assertEqual(len(out[0][1]), 5*4 + 5*4)
+        self.assertEqual(len(out[1][1]), 5*4 + 2*4)
+        value[0:16] = -1
+        self.assertEqual(len(send(value)), 4)
+        # length changed
+        self.assertEqual(len(send(np.arange(10))), 2)
+        # refresh
+        tx.refresh = 0.0
+        self.assertEqual(len(send(np.arange(10))), 2)
+
+    def test_wf_changed_lost(self):
+        cfg = {
+            "segment_size_max": 2*4 + 8*4,
+            "segment_index_digits": 2,
+            "waveform_queue_size": 1,
+            "changed_segments": True,
+            "refresh_period": 1000.0,
+        }
+        tx = get("wfint", cfg)
+        rx = get("wfint", cfg)
+        for topic, payload in tx.encode("a", np.arange(8)):
+            wf = rx.decode(topic, payload.tobytes())
+        tx.encode("a", np.arange(8) + 1) # lost
+        for topic, payload in tx.encode("a", np.arange(8) + 2):
+            self.assertIsNone(rx.decode(topic, payload.tobytes()))
+        self.assertEqual(rx.wfaccum.unbased, 1)
+
+    def _v2cfg(self, **kw):
+        cfg = {
+            "segment_size_max": V2_SIZE + 8*4,
+            "segment_index_digits": 2,
+            "waveform_queue_size": 1,
+            "protocol": 2,
+        }
+        cfg.update(kw)
+        return cfg
+
+    def test_wf_v2(self):
+        tx = get("wfint", self._v2cfg())
+        rx = get("wfint", self._v2cfg())
+        value = np.arange(27)*3 - 40
+        out = tx.encode("a", value, 1234.5)
+        self.assertEqual(len(out), 4)
+        self.assertEqual(
+            struct.unpack_from(V2_HEADER, out[3][1].tobytes()),
+            (V2_MAGIC, 0, 0, 27, 24, 3, 4, 1234.5),
+        )
+        self.assertEqual(len(out[0][1]), V2_SIZE + 8*4)
+        self.assertEqual(len(out[3][1]), V2_SIZE + 3*4)
+        wf = None
+        for i in [2, 0, 3, 1]:
+            self.assertIsNone(wf)
+            topic, payload = out[i]
+            wf = rx.decode(topic, payload.tobytes())
+        self.assertTrue(np.array_equal(wf, value))
+        self.assertEqual(rx.stamp, 1234.5)
+
+    def test_wf_v2_corrupted(self):
+        tx = get("wfint", self._v2cfg())
+        rx = get("wfint", self._v2cfg())
+        out = tx.encode("a", np.arange(10))
+        payload = bytearray(out[0][1].tobytes())
+        payload[-1] ^= 0x01
+        with self.assertRaises(ValueError):
+            rx.decode(out[0][0], bytes(payload))
+        with self.assertRaises(ValueError):
+            rx.decode(out[0][0], out[0][1].tobytes()[:-4])
+        self.assertEqual(rx.corrupted, 2)
+        for topic, payload in out:
+            wf = rx.decode(topic, payload.tobytes())
+        self.assertTrue(np.array_equal(wf, np.arange(10)))
+
+    def test_wf_v2_overlap(self):
+        # segment of a different index covering received data is rejected
+        tx = get("wfint", self._v2cfg())
+        rx = get("wfint", self._v2cfg())
+        out = tx.encode("a", np.arange(20))
+        payload = bytearray(out[1][1].tobytes())
+        struct.pack_into(">i", payload, 16, 4) # offset
+        crc = zlib.crc32(_buffer(payload, V2_SIZE, len(payload) - V2_SIZE), zlib.crc32(_buffer(payload, 0, V2_CRC)))
+        struct.pack_into(">I", payload, V2_CRC, crc & 0xFFFFFFFF)
+        self.assertIsNone(rx.decode(out[0][0], out[0][1].tobytes()))
+        with self.assertRaises(ValueError):
+            rx.decode(out[1][0], bytes(payload))
+        for topic, payload in out[1:]:
+            wf = rx.decode(topic, payload.tobytes())
+        self.assertTrue(np.array_equal(wf, np.arange(20)))
+
+    def test_wf_v1_compat(self):
+        # v2 receiver accepts v1 segments
+        tx = get("wfint", self._v2cfg(protocol=1, segment_size_max=8 + 8*4))
+        rx = get("wfint", self._v2cfg())
+        wf = None
+        for topic, payload in tx.encode("a", np.arange(20)):
+            wf = rx.decode(topic, payload.tobytes())
+        self.assertTrue(np.array_equal(wf, np.arange(20)))
+        self.assertIsNone(rx.stamp)
+
+    def test_wf_v2_changed(self):
+        cfg = self._v2cfg(changed_segments=True, refresh_period=1000.0)
+        tx = get("wfint", cfg)
+        rx = get("wfint", cfg)
+        value = np.arange(27)
+        for topic, payload in tx.encode("a", value):
+            rx.decode(topic, payload.tobytes())
+        value[5] = 100
+        value[26] = 200
+        out = tx.encode("a", value)
+        self.assertEqual(len(out), 2)
+        self.assertEqual(struct.unpack_from(V2_HEADER, out[1][1].tobytes())[1:7], (1, 0, 27, 24, 3, 2))
+        wf = None
+        for topic, payload in reversed(out):
+            wf = rx.decode(topic, payload.tobytes())
+        self.assertTrue(np.array_equal(wf, value))
+
+    def test_wf_v2_types(self):
+        for name in ["wfchar", "wfushort", "wfuint", "wfdouble", "wfshortz", "wfintz"]:
+            conv = get(name, self._v2cfg(segment_size_max=V2_SIZE + 16))
+            value = np.arange(100)//3
+            wf = None
+            for topic, payload in conv.encode("a", value):
+                self.assertLessEqual(len(payload), V2_SIZE + 16)
+                wf = conv.decode(topic, payload.tobytes())
+            self.assertTrue(np.array_equal(wf, value))
+
+    def test_wf_v2_err(self):
+        with self.assertRaises(ValueError):
+            get("wfint", self._v2cfg(protocol=3))
+        with self.assertRaises(ValueError):
+            get("wfint", self._v2cfg(segment_size_max=V2_SIZE + 3))
+
+    def test_register(self):
+        class Conv(MqttConv):
+            def __init__(self, convcfg):
+                MqttConv.__init__(self, convcfg)
+                self.cfg = convcfg
+        register("test_custom", Conv)
+        register_waveform("test_wfint64", ">i8")
+        try:
+            self.assertEqual(get("test_custom", {"x": 1}).cfg, {"x": 1})
+            self.assertIn("test_custom", types())
+            conv = get("test_wfint64", {
+                "segment_size_max": 8 + 8,
+                "segment_index_digits": 1,
+                "waveform_queue_size": 1,
+            })
+            self.assertEqual(conv.sds, 1)
+        finally:
+            del _registry["test_custom"]
+            del _registry["test_wfint64"]
+
     def test_get_err(self):
         with self.assertRaises(TypeError):
             get("abcxyz", {})
@@ -0,0 +1,162 @@
+import unittest
+
+
+# Topic filter trie node
+class _Node:
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+# Topic router
+#   maps incoming topics to channels in time independent of channel count
+#   plain topics are looked up in a hash map,
+#   filters with '+' and '#' wildcards are stored in a level trie
+class TopicRouter:
+    def __init__(self):
+        self.exact = {}
+        self.root = _Node()
+
+    @staticmethod
+    def is_filter(topic):
+        return "+" in topic or "#" in topic
+
+    @staticmethod
+    def check_filter(topic):
+        levels = topic.split("/")
+        for i, level in enumerate(levels):
+            if ("+" in level or "#" in level) and len(level) != 1:
+                raise ValueError("Wildcard must occupy the whole topic level ('%s')" % topic)
+            if level == "#" and i != len(levels) - 1:
+                raise ValueError("'#' wildcard must be the last topic level ('%s')" % topic)
+
+    def add(self, topic, value):
+        if not self.is_filter(topic):
+            self.exact[topic] = value
+            return
+        self.check_filter(topic)
+        node = self.root
+        for level in topic.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.value = value
+
+    def remove(self, topic):
+        if not self.is_filter(topic):
+            self.exact.pop(topic, None)
+            return
+        path = [self.root]
+        levels = topic.split("/")
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].value = None
+        # prune empty branches
+        for i in reversed(range(len(levels))):
+            node = path[i + 1]
+            if node.value is not None or node.children:
+                break
+            del path[i].children[levels[i]]
+
+    def _match(self, node, levels, i):
+        if i == len(levels):
+            if node.value is not None:
+                return node.value
+            # 'a/#' also matches 'a'
+            hashnode = node.children.get("#")
+            if hashnode is not None:
+                return hashnode.value
+            return None
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            value = self._match(child, levels, i + 1)
+            if value is not None:
+                return value
+
+        child = node.children.get("+")
+        if child is not None:
+            value = self._match(child, levels, i + 1)
+            if value is not None:
+                return value
+
+        child = node.children.get("#")
+        if child is not None:
+            return child.value
+        return None
+
+    # returns value of the most specific matching route or None
+    def get(self, topic):
+        value = self.exact.get(topic)
+        if value is not None:
+            return value
+        if not self.root.children:
+            return None
+        return self._match(self.root, topic.split("/"), 0)
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def test_exact(self):
+        router = TopicRouter()
+        router.add("a/b", 1)
+        router.add("a/c", 2)
+        self.assertEqual(router.get("a/b"), 1)
+        self.assertEqual(router.get("a/c"), 2)
+        self.assertIsNone(router.get("a"))
+        self.assertIsNone(router.get("a/b/c"))
+
+    def test_hash(self):
+        router = TopicRouter()
+        router.add("a/b/#", 1)
+        self.assertEqual(router.get("a/b/000"), 1)
+        self.assertEqual(router.get("a/b/001/x"), 1)
+        self.assertEqual(router.get("a/b"), 1)
+        self.assertIsNone(router.get("a/c/000"))
+
+    def test_plus(self):
+        router = TopicRouter()
+        router.add("a/+/c", 1)
+        self.assertEqual(router.get("a/b/c"), 1)
+        self.assertEqual(router.get("a//c"), 1)
+        self.assertIsNone(router.get("a/b/d"))
+        self.assertIsNone(router.get("a/b/c/d"))
+
+    def test_priority(self):
+        router = TopicRouter()
+        router.add("a/#", 1)
+        router.add("a/+/c", 2)
+        router.add("a/b/c", 3)
+        router.add("a/b/+", 4)
+        self.assertEqual(router.get("a/b/c"), 3)
+        self.assertEqual(router.get("a/b/d"), 4)
+        self.assertEqual(router.get("a/x/c"), 2)
+        self.assertEqual(router.get("a/x/d"), 1)
+
+    def test_remove(self):
+        router = TopicRouter()
+        router.add("a/b", 1)
+        router.add("a/b/#", 2)
+        router.add("a/+/c", 3)
+        router.remove("a/b")
+        router.remove("a/b/#")
+        self.assertIsNone(router.get("a/b"))
+        self.assertIsNone(router.get("a/b/000"))
+        self.assertEqual(router.get("a/b/c"), 3)
+        router.remove("a/+/c")
+        self.assertEqual(router.root.children, {})
+        router.remove("x/+")
+
+    def test_filter_err(self):
+        router = TopicRouter()
+        with self.assertRaises(ValueError):
+            router.add("a/b#", 1)
+        with self.assertRaises(ValueError):
+            router.add("a/#/b", 1)
+        with self.assertRaises(ValueError):
+            router.add("a/x+/b", 1)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,264 @@
+from collections import deque
+from threading import Lock, Condition
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import unittest
+from testfakes import Client
+
+
+# Token bucket
+#   refills with 'rate' tokens per second up to 'burst' tokens,
+#   may go into debt, so a single request can be larger than the burst
+class TokenBucket:
+    def __init__(self, rate, burst=1, clock=time.time):
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive (%s given)" % rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = Lock()
+
+    # takes tokens, returns time to wait before they are actually available
+    def take(self, n=1):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens/self.rate
+
+
+# Publish lane of a channel
+#   when publishers wait for flow control, messages of higher 'priority' lanes
+#   go first, lanes of equal priority share the link in proportion to 'weight'
+#   (by bytes), so a scalar is sent between segments of a bulk waveform
+class Lane:
+    def __init__(self, priority=0, weight=1.0):
+        if weight <= 0:
+            raise ValueError("Lane weight must be positive (%s given)" % weight)
+        self.priority = priority
+        self.weight = float(weight)
+        self.vtime = 0.0 # virtual finish time of the last message sent
+
+    @classmethod
+    def from_config(cls, connection):
+        return cls(connection.get("priority", 0), connection.get("weight", 1.0))
+
+
+# Payload for paho client
+#   paho accepts only str and bytearray payloads and copies a payload into its
+#   packet anyway, so a memoryview segment of an encoded waveform is copied once here;
+#   a bytearray per segment avoids this copy but costs more than it for segmented waveforms
+def wire_payload(payload):
+    if isinstance(payload, memoryview):
+        return payload.tobytes()
+    return payload
+
+
+# Publish flow control
+#   keeps at most 'window' messages in flight (not yet published by the client)
+#   and optionally limits message and byte rate with token buckets,
+#   may be shared by several channels publishing through the same broker,
+#   waiting publishers are served by their lanes (see Lane)
+class FlowControl:
+    POLL = 0.001 # seconds
+
+    def __init__(self, window=1, msg_rate=None, byte_rate=None, msg_burst=1, byte_burst=None, timeout=10.0):
+        if window < 1:
+            raise ValueError("Publish window must be at least 1 (%s given)" % window)
+        self.window = window
+        self.timeout = timeout
+        self.msgs = None
+        if msg_rate:
+            self.msgs = TokenBucket(msg_rate, msg_burst)
+        self.bytes = None
+        if byte_rate:
+            self.bytes = TokenBucket(byte_rate, byte_burst or byte_rate/10.0)
+        self.cond = Condition()
+        self.inflight = deque() # (info, start time)
+        self.reserved = 0
+        self.lane = Lane() # of publishers without one
+        self.waiting = [] # [priority, virtual start time, sequence] of publishers
+        self.seq = 0
+        self.vclock = 0.0 # virtual time of the last message sent
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            window=cfg.get("window", 1),
+            msg_rate=cfg.get("msg_rate"),
+            byte_rate=cfg.get("byte_rate"),
+            msg_burst=cfg.get("msg_burst", 1),
+            byte_burst=cfg.get("byte_burst"),
+            timeout=cfg.get("timeout", 10.0),
+        )
+
+    def _collect(self):
+        while self.inflight and self.inflight[0][0].is_published():
+            self.inflight.popleft()
+
+    def _reserve(self, lane, size):
+        with self.cond:
+            entry = [-lane.priority, max(lane.vtime, self.vclock), self.seq]
+            self.seq += 1
+            self.waiting.append(entry)
+            try:
+                while True:
+                    self._collect()
+                    full = len(self.inflight) + self.reserved >= self.window
+                    if not full and min(self.waiting) is entry:
+                        self.reserved += 1
+                        self.vclock = entry[1]
+                        lane.vtime = entry[1] + size/lane.weight
+                        return
+                    if full and self.inflight:
+                        info, start = self.inflight[0]
+                        if time.time() - start > self.timeout:
+                            self.inflight.popleft()
+                            raise RuntimeError("Message %s was not published in %s s" % (info.mid, self.timeout))
+                    # reservations are released with notify, published messages are polled
+                    self.cond.wait(self.POLL if self.inflight else None)
+            finally:
+                self.waiting.remove(entry)
+                self.cond.notify_all()
+
+    def publish(self, client, topic, payload, qos=0, retain=False, lane=None):
+        payload = wire_payload(payload)
+
+        # rate limits are taken by the publisher whose turn it is
+        self._reserve(lane or self.lane, len(payload))
+        info = None
+        try:
+            delay = 0.0
+            if self.msgs is not None:
+                delay = self.msgs.take(1)
+            if self.bytes is not None:
+                delay = max(delay, self.bytes.take(len(payload)))
+            if delay > 0:
+                time.sleep(delay)
+            info = client.publish(topic, payload, qos, retain)
+        finally:
+            # reservation becomes a message in flight at once, so waiters never overshoot the window
+            with self.cond:
+                self.reserved -= 1
+                dropped = info is None or info.rc == mqtt.MQTT_ERR_QUEUE_SIZE or (info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0)
+                if not dropped:
+                    self.inflight.append((info, time.time()))
+                self.cond.notify_all()
+        if dropped:
+            # message is dropped by the client
+            raise RuntimeError("Unable to publish to %s: %s" % (topic, mqtt.error_string(info.rc)))
+        return info
+
+    # waits until all messages in flight are published
+    def flush(self):
+        with self.cond:
+            while self.inflight:
+                self._collect()
+                if self.inflight:
+                    self.cond.wait(self.POLL)
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def test_bucket(self):
+        now = [0.0]
+        bucket = TokenBucket(10, 2, clock=lambda: now[0])
+        self.assertEqual(bucket.take(), 0.0)
+        self.assertEqual(bucket.take(), 0.0)
+        self.assertAlmostEqual(bucket.take(), 0.1)
+        now[0] = 1.0
+        self.assertEqual(bucket.take(), 0.0)
+        # larger than burst
+        self.assertAlmostEqual(bucket.take(4), 0.3)
+
+    def test_bucket_err(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+    def test_window(self):
+        client = Client(hold=True)
+        flow = FlowControl(window=2, timeout=0.05)
+        flow.publish(client, "a", b"x")
+        flow.publish(client, "a", b"x")
+        self.assertEqual(len(flow.inflight), 2)
+        client.infos[0].published = True
+        flow.publish(client, "a", b"x")
+        self.assertEqual(len(flow.inflight), 2)
+        with self.assertRaises(RuntimeError):
+            flow.publish(client, "a", b"x")
+        for info in client.infos:
+            info.published = True
+        flow.flush()
+        self.assertEqual(len(flow.inflight), 0)
+
+    def test_rate(self):
+        client = Client(hold=True)
+        flow = FlowControl(window=100, msg_rate=200)
+        start = time.time()
+        for i in range(5):
+            flow.publish(client, "a", b"x")
+        self.assertGreaterEqual(time.time() - start, 0.015)
+
+    def _contend(self, flow, client, publishers):
+        # publishers wait for one window slot in order of arrival,
+        # slot is released one message at a time, returns publishing order
+        flow.publish(client, "hold", b"x")
+        held = len(client.infos)
+        threads = []
+        for name, lane in publishers:
+            thread = threading.Thread(target=flow.publish, args=(client, name, b"x"*100), kwargs={"lane": lane})
+            thread.start()
+            threads.append(thread)
+            while len(flow.waiting) < len(threads):
+                time.sleep(0.001)
+        for i in range(len(publishers)):
+            client.infos[-1].published = True
+            while len(client.infos) < held + i + 1:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        return [topic for topic, payload in client.pubs[held:]]
+
+    def test_priority(self):
+        bulk, ctl = Lane(), Lane(priority=1)
+        order = self._contend(FlowControl(window=1), Client(hold=True), [("bulk", bulk), ("bulk", bulk), ("ctl", ctl), ("ctl", ctl)])
+        self.assertEqual(order, ["ctl", "ctl", "bulk", "bulk"])
+
+    def test_weight(self):
+        # lane with larger weight has sent less virtual time for the same bytes
+        flow, client = FlowControl(window=1), Client(hold=True)
+        a, b = Lane(weight=3), Lane()
+        for lane in [a, b]:
+            flow.publish(client, "pre", b"x"*100, lane=lane)
+            client.infos[-1].published = True
+        self.assertAlmostEqual(b.vtime - a.vtime, 100 - 100/3.0)
+        self.assertEqual(self._contend(flow, client, [("b", b), ("a", a)]), ["a", "b"])
+
+    def test_lane_err(self):
+        with self.assertRaises(ValueError):
+            Lane(weight=0)
+
+    def test_rc_err(self):
+        flow = FlowControl()
+        with self.assertRaises(RuntimeError):
+            flow.publish(Client(rc=mqtt.MQTT_ERR_NO_CONN), "a", b"x", 0)
+        flow.publish(Client(rc=mqtt.MQTT_ERR_NO_CONN), "a", b"x", 1)
+        self.assertEqual(len(flow.inflight), 1)
+
+    def test_config(self):
+        flow = FlowControl.from_config({"window": 4, "byte_rate": 1000})
+        self.assertEqual(flow.window, 4)
+        self.assertIsNone(flow.msgs)
+        self.assertEqual(flow.bytes.rate, 1000)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,337 @@
+from collections import deque
+from threading import Thread, Lock, Condition
+import logging
+import time
+
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+
+# Delivery policies
+DELIVERY_ALL = "all" # handle every value
+DELIVERY_LATEST = "latest" # coalesce pending values to the newest one
+DELIVERY_BOUNDED = "bounded" # keep at most 'size' pending values, drop the oldest
+
+# Publish queue
+#   in-process queue of one channel, values are handled
+#   by the pool workers strictly in order of arrival,
+#   with 'batch' set the handler gets lists of up to 'batch' pending values
+class PublishQueue:
+    def __init__(self, pool, handler, policy=DELIVERY_ALL, size=None, batch=None, priority=0):
+        if policy == DELIVERY_ALL:
+            self.maxlen = None
+        elif policy == DELIVERY_LATEST:
+            self.maxlen = 1
+        elif policy == DELIVERY_BOUNDED:
+            if size is None or size < 1:
+                raise ValueError("Bounded delivery queue size must be at least 1 (%s given)" % size)
+            self.maxlen = size
+        else:
+            raise ValueError("Unknown delivery policy '%s'" % policy)
+        if batch is not None and batch < 1:
+            raise ValueError("Queue batch size must be at least 1 (%s given)" % batch)
+        self.batch = batch
+        self.priority = priority
+        self.policy = policy
+        self.pool = pool
+        self.handler = handler
+        self.items = deque()
+        self.scheduled = False # queue is in pool ready list or being handled
+
+        # counters
+        self.received = 0
+        self.dropped = 0 # values discarded by bounded policy
+        self.coalesced = 0 # values replaced by newer ones by latest policy
+
+    def put(self, value):
+        self.pool._put(self, value)
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Publish pool
+#   fixed number of worker threads shared by all channels
+#   a channel is handled by at most one worker at a time,
+#   so per-channel ordering is preserved;
+#   channels of each nonzero priority get their own lane of 'lane_workers'
+#   threads, so they never wait for workers busy with other lanes
+class PublishPool:
+    def __init__(self, workers, lane_workers=1):
+        if workers < 1:
+            raise ValueError("Publish pool must have at least one worker (%d given)" % workers)
+        self.lock = Lock()
+        self.cond = Condition(self.lock) # pending changes
+        self.lanes = {} # priority -> (ready queues, condition)
+        self.lane_workers = lane_workers
+        self.pending = 0 # values put but not handled yet
+        self.running = False
+        self.threads = []
+        self._lane(0, workers)
+
+    def _lane(self, priority, workers):
+        self.lanes[priority] = (deque(), Condition(self.lock))
+        threads = [Thread(target=self._loop, args=(priority,)) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            if self.running:
+                thread.start()
+        self.threads.extend(threads)
+
+    def queue(self, handler, policy=DELIVERY_ALL, size=None, batch=None, priority=0):
+        with self.lock:
+            if priority not in self.lanes:
+                self._lane(priority, self.lane_workers)
+        return PublishQueue(self, handler, policy, size, batch, priority)
+
+    def start(self):
+        with self.lock:
+            self.running = True
+            for thread in self.threads:
+                thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            for ready, cond in self.lanes.values():
+                cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    # waits until all values put are handled
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.pending > 0:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return False
+                    self.cond.wait(left)
+        return True
+
+    def _put(self, queue, value):
+        with self.cond:
+            queue.received += 1
+            if queue.maxlen is not None and len(queue.items) >= queue.maxlen:
+                queue.items.popleft()
+                self.pending -= 1
+                if queue.policy == DELIVERY_LATEST:
+                    queue.coalesced += 1
+                else:
+                    queue.dropped += 1
+            queue.items.append(value)
+            self.pending += 1
+            if not queue.scheduled:
+                queue.scheduled = True
+                ready, cond = self.lanes[queue.priority]
+                ready.append(queue)
+                cond.notify()
+
+    def _loop(self, priority):
+        ready, cond = self.lanes[priority]
+        while True:
+            with self.lock:
+                while self.running and not ready:
+                    cond.wait()
+                if not self.running:
+                    return
+                queue = ready.popleft()
+                if queue.batch is None:
+                    value = queue.items.popleft()
+                    count = 1
+                else:
+                    count = min(queue.batch, len(queue.items))
+                    value = [queue.items.popleft() for i in range(count)]
+
+            try:
+                queue.handler(value)
+            except Exception:
+                logger.exception("Unhandled error in publish handler")
+
+            with self.lock:
+                self.pending -= count
+                if queue.items:
+                    # let other channels go first
+                    ready.append(queue)
+                    cond.notify()
+                else:
+                    queue.scheduled = False
+                if self.pending == 0:
+                    self.cond.notify_all()
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def test_order(self):
+        pool = PublishPool(4)
+        out = [[] for i in range(16)]
+        queues = [pool.queue(out[i].append) for i in range(16)]
+        pool.start()
+        try:
+            for j in range(100):
+                for q in queues:
+                    q.put(j)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        for o in out:
+            self.assertEqual(o, list(range(100)))
+
+    def test_serial(self):
+        # one channel must never be handled by two workers at once
+        pool = PublishPool(4)
+        state = {"active": 0, "overlap": False}
+        def handler(value):
+            state["active"] += 1
+            if state["active"] > 1:
+                state["overlap"] = True
+            time.sleep(0.001)
+            state["active"] -= 1
+        queue = pool.queue(handler)
+        pool.start()
+        try:
+            for j in range(20):
+                queue.put(j)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertFalse(state["overlap"])
+
+    def test_batch(self):
+        pool = PublishPool(1)
+        out = []
+        queue = pool.queue(out.append, batch=4)
+        for j in range(10):
+            queue.put(j)
+        pool.start()
+        try:
+            self.assertTrue(pool.wait_idle(10))
+            queue.put(10)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertEqual(out, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9], [10]])
+        with self.assertRaises(ValueError):
+            pool.queue(out.append, batch=0)
+
+    def test_lanes(self):
+        # priority channel is handled while default lane is busy
+        pool = PublishPool(1)
+        started = []
+        out = []
+        def slow(value):
+            started.append(value)
+            time.sleep(0.2)
+        bulk = pool.queue(slow)
+        control = pool.queue(out.append, priority=1)
+        pool.start()
+        try:
+            bulk.put(0)
+            bulk.put(1)
+            while not started:
+                time.sleep(0.001)
+            start = time.time()
+            control.put(5)
+            while not out:
+                time.sleep(0.001)
+            self.assertLess(time.time() - start, 0.1)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertEqual(len(pool.threads), 2)
+        # lane created while running
+        pool = PublishPool(1)
+        pool.start()
+        try:
+            pool.queue(out.append, priority=2).put(6)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertEqual(out, [5, 6])
+
+    def test_threads(self):
+        pool = PublishPool(2)
+        for i in range(1000):
+            pool.queue(lambda v: None)
+        self.assertEqual(len(pool.threads), 2)
+
+    def test_handler_err(self):
+        pool = PublishPool(1)
+        out = []
+        def handler(value):
+            if value == 1:
+                raise RuntimeError("test")
+            out.append(value)
+        queue = pool.queue(handler)
+        pool.start()
+        logging.disable(logging.CRITICAL)
+        try:
+            for j in range(3):
+                queue.put(j)
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            logging.disable(logging.NOTSET)
+            pool.stop()
+        self.assertEqual(out, [0, 2])
+
+    def _fill(self, policy, size=None):
+        # fills the queue while its worker is busy with the first value
+        pool = PublishPool(1)
+        out = []
+        busy = Condition()
+        state = {"go": False}
+        def handler(value):
+            with busy:
+                while not state["go"]:
+                    busy.wait()
+            out.append(value)
+        queue = pool.queue(handler, policy, size)
+        pool.start()
+        try:
+            queue.put(0)
+            while len(queue):
+                time.sleep(0.001)
+            for j in range(1, 10):
+                queue.put(j)
+            with busy:
+                state["go"] = True
+                busy.notify_all()
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        return queue, out
+
+    def test_policy_all(self):
+        queue, out = self._fill(DELIVERY_ALL)
+        self.assertEqual(out, list(range(10)))
+        self.assertEqual((queue.received, queue.dropped, queue.coalesced), (10, 0, 0))
+
+    def test_policy_latest(self):
+        queue, out = self._fill(DELIVERY_LATEST)
+        self.assertEqual(out, [0, 9])
+        self.assertEqual((queue.received, queue.dropped, queue.coalesced), (10, 0, 8))
+
+    def test_policy_bounded(self):
+        queue, out = self._fill(DELIVERY_BOUNDED, 3)
+        self.assertEqual(out, [0, 7, 8, 9])
+        self.assertEqual((queue.received, queue.dropped, queue.coalesced), (10, 6, 0))
+
+    def test_policy_err(self):
+        pool = PublishPool(1)
+        with self.assertRaises(ValueError):
+            pool.queue(None, "abcxyz")
+        with self.assertRaises(ValueError):
+            pool.queue(None, DELIVERY_BOUNDED)
+
+    def test_workers_err(self):
+        with self.assertRaises(ValueError):
+            PublishPool(0)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
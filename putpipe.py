@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+
+# CA put pipeline
+#   takes decoded values from any thread without blocking it,
+#   values put before the cothread side gets to them are sent as one
+#   multi-PV caput, only the latest value of each PV is sent,
+#   optionally waits for put callbacks to report completion
+class PutPipeline:
+    def __init__(self, track=False, timeout=5.0, caput=None, callback=None, spawn=None):
+        if caput is None:
+            import cothread
+            import cothread.catools as catools
+            caput, callback, spawn = catools.caput, cothread.Callback, cothread.Spawn
+        self.caput = caput
+        self.callback = callback # runs function in cothread from other thread
+        self.spawn = spawn # starts cothread
+        self.track = track # report completion from put callback
+        self.timeout = timeout
+        self.lock = Lock()
+        self.pending = OrderedDict() # pv -> (value, done)
+        self.scheduled = False
+
+        # counters
+        self.puts = 0
+        self.coalesced = 0 # values replaced by newer ones before sent
+        self.batches = 0
+        self.completed = 0
+        self.failed = 0
+
+    # 'done(ok)' is called in cothread when the put succeeds or fails
+    def put(self, pv, value, done=None):
+        with self.lock:
+            self.puts += 1
+            if pv in self.pending:
+                del self.pending[pv]
+                self.coalesced += 1
+            self.pending[pv] = (value, done)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.callback(self._flush)
+
+    def _flush(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = OrderedDict()
+            self.scheduled = False
+        if batch:
+            self.batches += 1
+            # caput waits for connections, so let other callbacks go on
+            self.spawn(self._send, batch)
+
+    def _finish(self, batch, pv, ok):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        done = batch[pv][1]
+        if done is not None:
+            try:
+                done(ok)
+            except Exception:
+                logger.exception("Unhandled error in put completion of %s" % pv)
+
+    def _send(self, batch):
+        pvs = list(batch.keys())
+        values = [batch[pv][0] for pv in pvs]
+        kargs = {"timeout": self.timeout, "throw": False}
+        if self.track:
+            kargs["callback"] = lambda result: self._finish(batch, result.name, result.ok)
+        try:
+            results = self.caput(pvs, values, **kargs)
+        except Exception as e:
+            logger.error("Unable to put %d values: %s" % (len(pvs), str(e)))
+            results = None
+        for i, pv in enumerate(pvs):
+            if results is None or not results[i].ok:
+                logger.error("Unable to put to %s", pv, extra={"ratekey": pv})
+                self._finish(batch, pv, False)
+            elif not self.track:
+                self._finish(batch, pv, True)
+
+
+# Unittests
+class _Result:
+    def __init__(self, name, ok=True):
+        self.name = name
+        self.ok = ok
+
+class _Ca:
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.calls = []
+        self.callbacks = []
+        self.scheduled = []
+
+    def caput(self, pvs, values, timeout, throw, callback=None):
+        self.calls.append((pvs, values))
+        results = [_Result(pv, pv not in self.fail) for pv in pvs]
+        if callback is not None:
+            self.callbacks.extend((callback, r) for r in results if r.ok)
+        return results
+
+    def pipeline(self, track=False):
+        return PutPipeline(track, caput=self.caput, callback=self.scheduled.append, spawn=lambda f, *a: f(*a))
+
+    def tick(self):
+        scheduled = list(self.scheduled)
+        del self.scheduled[:]
+        for func in scheduled:
+            func()
+
+class Test(unittest.TestCase):
+    def test_batch(self):
+        ca = _Ca()
+        pipe = ca.pipeline()
+        pipe.put("A", 1)
+        pipe.put("B", 2)
+        pipe.put("A", 3)
+        self.assertEqual(len(ca.scheduled), 1)
+        ca.tick()
+        self.assertEqual(ca.calls, [(["B", "A"], [2, 3])])
+        self.assertEqual((pipe.puts, pipe.coalesced, pipe.batches, pipe.completed), (3, 1, 1, 2))
+        pipe.put("A", 4)
+        ca.tick()
+        self.assertEqual(ca.calls[1], (["A"], [4]))
+
+    def test_fail(self):
+        ca = _Ca(fail=["B"])
+        pipe = ca.pipeline()
+        out = []
+        pipe.put("A", 1, out.append)
+        pipe.put("B", 2, out.append)
+        logging.disable(logging.CRITICAL)
+        try:
+            ca.tick()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(out, [True, False])
+        self.assertEqual((pipe.completed, pipe.failed), (1, 1))
+
+    def test_track(self):
+        ca = _Ca()
+        pipe = ca.pipeline(track=True)
+        out = []
+        pipe.put("A", 1, lambda ok: out.append(("A", ok)))
+        ca.tick()
+        self.assertEqual(out, [])
+        for callback, result in ca.callbacks:
+            callback(result)
+        self.assertEqual(out, [("A", True)])
+        self.assertEqual(pipe.completed, 1)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
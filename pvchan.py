@@ -0,0 +1,353 @@
+from threading import Lock
+import time
+import logging
+
+import mqttconv
+from pubflow import FlowControl, Lane
+from pubpool import DELIVERY_BOUNDED
+from pvfilter import Deadband, Decimation, Downsample
+from metrics import ChanMetrics
+from lvcache import LastValue
+
+import numpy as np
+
+import unittest
+from testfakes import Client, PutPipe, make_chan
+
+
+logger = logging.getLogger(__name__)
+
+# predefined constants
+CONV_CFG = {
+    "segment_size_max": 1208, # bytes
+    "segment_index_digits": 3, # decimal digits count in segment index
+    "waveform_queue_size": 3, # difference between waveform ids 
+                              # that enough to drop an old incomplete ones
+    "waveform_budget": 4*2**20, # max bytes of incomplete waveforms per channel
+    "compress_level": 6, # zlib level of compressed waveforms
+    "changed_segments": False, # send only changed parts of waveforms
+    "refresh_period": 10.0, # seconds, max time between full updates
+    "protocol": 1, # waveform segment format sent, both are received
+}
+CONV_CHAN_KEYS = [ # CONV_CFG keys that connection may override
+    "segment_size_max", "protocol", "waveform_budget", "compress_level", "changed_segments", "refresh_period",
+]
+MQTT_DELAY = 0.07 # seconds
+DECODE_BATCH = 64 # max messages of a channel decoded by a worker at once
+DECODE_QUEUE_SIZE = 1024 # default max messages of a channel waiting for decoding, oldest are dropped
+PUBLISH_FLOW = { # default publish flow control, one message per MQTT_DELAY
+    "window": 1, # messages in flight
+    "msg_rate": 1.0/MQTT_DELAY, # messages per second
+}
+
+# Gateway channel
+#   connects PV with MQTT topic in one direction
+#   CA side (cothread) is imported only where it is used,
+#   so pm channels can be driven without CA context (see bench.py)
+class PvMqttChan:
+    def __init__(self,connection,servers,client,pubpool,flow,putpipe=None,recorder=None,decodepool=None):
+        self.chan = unicodeToStr(connection["mqtt"])
+        # list of PVs for aggregate channels (see aggregate.py)
+        if isinstance(connection["pv"], list):
+            self.pvs = [unicodeToStr(pv) for pv in connection["pv"]]
+        else:
+            self.pvs = [unicodeToStr(connection["pv"])]
+        self.pv = ",".join(self.pvs)
+        if "datatype" in connection:
+            self.datatype = unicodeToStr(connection["datatype"])
+        else:
+            self.datatype = None
+        self.direction = unicodeToStr(connection["direction"])
+        self.servers = servers # ServerHealth
+        self.ioc = servers.ioc(self.pvs[0])
+        self.mqtt = servers.mqtt(self.chan)
+        self.client = client
+        self.putpipe = putpipe # PutPipeline of mp channels
+        self.recorder = recorder # TrafficRecorder of CA updates
+        self.sharedflow = flow
+        self.monitor = None
+        self.closed = False
+        self.decoding = Lock() # decoding of mp messages and closing
+
+        self.convcfg = dict(CONV_CFG)
+        for key in CONV_CHAN_KEYS:
+            if key in connection:
+                self.convcfg[key] = connection[key]
+        self.conv = self.converter()
+        self.last = LastValue(self.conv) # restored after broker reconnect
+        self.subscribed = False
+
+        self.queue = None
+        if self.direction=="pm":
+            # what to do with values arriving faster than they are published
+            delivery = unicodeToStr(connection.get("delivery", u"all"))
+            # channels of higher priority have their own workers (see pubpool.py)
+            priority = Lane.from_config(connection).priority
+            self.queue = pubpool.queue(self.updateChan, delivery, connection.get("queue_size"), priority=priority)
+        elif decodepool is not None:
+            # messages are decoded by pool workers, not by MQTT client thread,
+            # queue is bounded since the client keeps reading socket meanwhile
+            size = connection.get("decode_queue_size", DECODE_QUEUE_SIZE)
+            self.queue = decodepool.queue(self.updatePvBatch, DELIVERY_BOUNDED, size, batch=DECODE_BATCH)
+
+        self.metrics = ChanMetrics(self.chan, self.pv, self.direction)
+        self.metrics.queue = self.queue
+        self.metrics.accum = getattr(self.conv, "wfaccum", None)
+        self.retune(connection)
+
+    def converter(self):
+        return mqttconv.get(self.datatype, self.convcfg)
+
+    # applies options that can be changed without recreating the channel
+    def retune(self, connection):
+        self.connection = connection
+        if "qos" in connection:
+            self.qos = connection["qos"]
+        else:
+            self.qos = 0
+        self.retain = False
+        if ("retain" in connection) and connection["retain"] == "true":
+            self.retain = True
+        if "flow" in connection:
+            # channel has its own publish limits
+            self.flow = FlowControl.from_config(connection["flow"])
+        else:
+            self.flow = self.sharedflow
+        # order of waiting for flow control window
+        self.lane = Lane.from_config(connection)
+        self.deadband = None
+        if "deadband" in connection:
+            self.deadband = Deadband(connection["deadband"], self.convcfg["refresh_period"])
+        self.metrics.deadband = self.deadband
+        self.decimation = None
+        if "max_rate" in connection:
+            # values per second
+            self.decimation = Decimation(connection["max_rate"])
+        self.metrics.decimation = self.decimation
+        self.downsample = None
+        if "downsample" in connection:
+            self.downsample = Downsample.from_config(connection["downsample"])
+
+    # subscribes or monitors, PV is connected by Connector
+    def setConnection(self):
+        if self.closed:
+            return
+        if self.direction=="mp":
+            self.client.subscribe(self.subTopic())
+            self.subscribed = True
+        elif self.direction=="pm":
+            import cothread.catools as catools
+            self.monitor = catools.camonitor(self.pv, self.pushValue)
+        logger.info("(%s, %s) connection set" % (self.pv, self.chan))
+
+    # unsubscribes or stops monitoring, values still queued are dropped
+    def close(self):
+        with self.decoding:
+            self.closed = True
+            # incomplete waveforms give their bytes back to the shared budget
+            accum = getattr(self.conv, "wfaccum", None)
+            if accum is not None:
+                accum.reset()
+        if self.direction=="mp":
+            self.client.unsubscribe(self.subTopic())
+            self.subscribed = False
+        elif self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+        logger.info("(%s, %s) connection closed" % (self.pv, self.chan))
+
+    def subTopic(self):
+        return subTopic(self.chan, self.conv)
+
+    def pushValue(self, value):
+        logger.debug("ca: received from %s", self.pv)
+        if self.recorder is not None:
+            self.recorder.ca(self.pv, value)
+        self.queue.put((time.time(), value))
+
+    def updateChan(self, item):
+        received, value = item
+        if self.closed:
+            return
+        if self.decimation is not None and not self.decimation.due():
+            return
+        if self.downsample is not None:
+            value = self.downsample(value)
+        if self.deadband is not None and not self.deadband.changed(value):
+            return
+        if not self.mqtt.allow():
+            # server is known to be down, value is republished after reconnect
+            self.last.skip(value)
+            self.metrics.skipped += 1
+            return
+        logger.debug("mqtt: send to %s", self.chan)
+        try:
+            messages = self.last.encode(self.chan, value)
+        except Exception as e:
+            # bad value of this channel, server breaker is not affected
+            self.metrics.errors += 1
+            logger.error("Unable to encode value of %s: %s", self.chan, e, extra={"ratekey": self.chan})
+            logger.debug("Traceback of encoding value of %s", self.chan, exc_info=True, extra={"ratekey": self.chan})
+            return
+        try:
+            for topic, payload in messages:
+                self.flow.publish(self.client, topic, payload, self.qos, self.retain, self.lane)
+                self.metrics.sent(payload)
+            self.mqtt.success()
+            if self.decimation is not None:
+                self.decimation.sent()
+            if self.deadband is not None:
+                self.deadband.commit(value)
+            self.metrics.published += 1
+            self.metrics.latency.observe(time.time() - received)
+        except Exception as e:
+            self.mqtt.failure()
+            self.metrics.errors += 1
+            logger.error("Trouble when Publishing to Mqtt with %s: %s", self.chan, e, extra={"ratekey": self.chan})
+            logger.debug("Traceback of publishing to %s", self.chan, exc_info=True, extra={"ratekey": self.chan})
+            #cothread.Quit()
+
+    # called by MQTT client thread
+    def receive(self, topic, payload):
+        if self.queue is not None:
+            self.queue.put((topic, payload))
+        else:
+            self.updatePv(topic, payload)
+
+    def updatePvBatch(self, messages):
+        for topic, payload in messages:
+            self.updatePv(topic, payload)
+
+    def updatePv(self, topic, payload):
+        if self.closed:
+            return
+        logger.debug("ca: send to %s", self.pv)
+        self.metrics.received += 1
+        try:
+            with self.decoding:
+                if self.closed:
+                    return
+                value = self.conv.decode(topic, payload)
+            if value is not None:
+                if self.metrics.accum is not None:
+                    self.metrics.assembly.observe(self.metrics.accum.assembly)
+                if not self.last.decoded(value):
+                    logger.debug("ca: %s unchanged after resubscribing", self.pv)
+                    return
+                if self.ioc.allow():
+                    self.putpipe.put(self.pv, value, self.putDone)
+                else:
+                    self.metrics.skipped += 1
+        except Exception as e:
+            self.metrics.errors += 1
+            logger.error("Trouble in updatePv with %s: %s", self.pv, e, extra={"ratekey": self.pv})
+            logger.debug("Traceback of updatePv with %s", self.pv, exc_info=True, extra={"ratekey": self.pv})
+            #cothread.Quit()
+
+    def putDone(self, ok):
+        if ok:
+            self.ioc.success()
+            self.metrics.published += 1
+        else:
+            self.ioc.failure()
+            self.metrics.errors += 1
+
+
+def subTopic(chan, conv):
+    if conv.segmented:
+        # waveform segments are published to '<chan>/<segment index>'
+        if not chan.endswith("/"):
+            return chan + "/#"
+        return chan + "#"
+    return chan
+
+def unicodeToStr(name):
+    string = name.encode('ascii', 'ignore')
+    return string
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def _chan(self, connection, client=None, **kw):
+        self.client = client or Client()
+        return make_chan(PvMqttChan, connection, self.client, **kw)
+
+    def test_encode_err(self):
+        # errors of bad values don't open breaker of the server
+        chan = self._chan({"mqtt": u"dev/int", "pv": u"INT", "direction": u"pm", "datatype": u"int"})
+        logging.disable(logging.CRITICAL)
+        try:
+            for i in range(10):
+                chan.pushValue(2**40)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(chan.mqtt.state, "closed")
+        chan.pushValue(1)
+        self.assertEqual((len(self.client.pubs), chan.metrics.errors), (1, 10))
+
+    def test_close_budget(self):
+        # removed channel gives bytes of incomplete waveforms back
+        from wfaccum import WfBudget
+        shared = WfBudget(2**20)
+        CONV_CFG["waveform_shared_budget"] = shared
+        try:
+            chan = self._chan({"mqtt": u"dev/wf/", "pv": u"WF", "direction": u"mp", "datatype": u"wfint"})
+        finally:
+            del CONV_CFG["waveform_shared_budget"]
+        tx = mqttconv.get("wfint", CONV_CFG)
+        topic, payload = tx.encode("dev/wf/", np.arange(1000, dtype=np.int32))[0]
+        chan.setConnection()
+        chan.receive(topic, payload.tobytes())
+        self.assertGreater(shared.used, 0)
+        chan.close()
+        self.assertEqual(shared.used, 0)
+        chan.receive(topic, payload.tobytes())
+        self.assertEqual(shared.used, 0)
+
+    def test_skipped(self):
+        # value skipped while server is down is restored
+        chan = self._chan({"mqtt": u"dev/int", "pv": u"INT", "direction": u"pm", "datatype": u"int"}, Client(fail=True))
+        logging.disable(logging.CRITICAL)
+        try:
+            for i in range(5):
+                chan.pushValue(i)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual((chan.mqtt.state, chan.metrics.skipped), ("open", 2))
+        self.assertEqual(chan.last.restore(chan.chan), [("dev/int", mqttconv.get("int", CONV_CFG).encode("dev/int", 4)[0][1])])
+
+    def test_deadband_failed(self):
+        # value failed to publish is not suppressed by deadband
+        chan = self._chan({"mqtt": u"dev/int", "pv": u"INT", "direction": u"pm", "datatype": u"int", "deadband": 2}, Client(fail=True))
+        logging.disable(logging.CRITICAL)
+        try:
+            chan.pushValue(10)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.client.fail = False
+        chan.mqtt.success()
+        chan.pushValue(10)
+        chan.pushValue(11)
+        self.assertEqual(len(self.client.pubs), 1)
+
+    def test_decode_queue(self):
+        # messages waiting for decoding are bounded, oldest are dropped
+        from pubpool import PublishPool
+        pool = PublishPool(1)
+        putpipe = PutPipe()
+        connection = {"mqtt": u"dev/int", "pv": u"INT", "direction": u"mp", "datatype": u"int", "decode_queue_size": 4}
+        chan = self._chan(connection, putpipe=putpipe, decodepool=pool)
+        conv = mqttconv.get("int", CONV_CFG)
+        for i in range(10):
+            chan.receive(*conv.encode("dev/int", i)[0])
+        pool.start()
+        try:
+            self.assertTrue(pool.wait_idle(10))
+        finally:
+            pool.stop()
+        self.assertEqual([value for pv, value in putpipe.puts], [6, 7, 8, 9])
+        self.assertEqual(chan.metrics.values()["dropped"], 6)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
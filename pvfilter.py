@@ -0,0 +1,214 @@
+import numpy as np
+import time
+
+import unittest
+
+
+# Deadband filter
+#   passes a value only if it differs from the last passed one by more than 'deadband'
+#   (any item for waveforms) or if 'refresh' seconds passed since then;
+#   changed() checks a value, commit() is called when it is actually published,
+#   so a value failed to publish is not suppressed
+class Deadband:
+    def __init__(self, deadband, refresh=None, clock=time.time):
+        self.deadband = deadband
+        self.refresh = refresh
+        self.clock = clock
+        self.last = None
+        self.time = None
+        self.suppressed = 0
+
+    def differs(self, value):
+        if self.last is None:
+            return True
+        if np.shape(value) != np.shape(self.last):
+            return True
+        return bool(np.any(np.abs(np.subtract(value, self.last, dtype=np.float64)) > self.deadband))
+
+    def changed(self, value):
+        if self.differs(value) or (self.refresh is not None and self.clock() - self.time >= self.refresh):
+            return True
+        self.suppressed += 1
+        return False
+
+    def commit(self, value):
+        self.last = np.copy(value)
+        self.time = self.clock()
+
+
+# Decimation
+#   limits channel to 'rate' values per second, values arriving sooner
+#   after the last sent one are dropped;
+#   due() checks a value, sent() is called when it is actually published,
+#   so values suppressed by other filters don't delay the next ones
+class Decimation:
+    def __init__(self, rate, clock=time.time):
+        if rate <= 0:
+            raise ValueError("Max publish rate must be positive (%s given)" % rate)
+        self.period = 1.0/rate
+        self.clock = clock
+        self.time = None
+        self.suppressed = 0
+
+    def due(self):
+        if self.time is None or self.clock() - self.time >= self.period:
+            return True
+        self.suppressed += 1
+        return False
+
+    def sent(self):
+        self.time = self.clock()
+
+
+# Waveform downsampling modes
+DOWNSAMPLE_MEAN = "mean" # block averages
+DOWNSAMPLE_MINMAX = "minmax" # min and max of each block, interleaved
+DOWNSAMPLE_STRIDE = "stride" # first item of each block
+
+# Downsampling
+#   reduces waveform to blocks of 'factor' items or, if 'points' is given,
+#   to at most 'points' items, the last block may be shorter;
+#   integer waveforms stay integer (block averages are rounded)
+class Downsample:
+    def __init__(self, mode=DOWNSAMPLE_MEAN, factor=None, points=None):
+        if mode not in (DOWNSAMPLE_MEAN, DOWNSAMPLE_MINMAX, DOWNSAMPLE_STRIDE):
+            raise ValueError("Unknown downsampling mode '%s'" % mode)
+        if (factor is None) == (points is None):
+            raise ValueError("Downsampling needs either factor or points")
+        if (factor is not None and factor < 1) or (points is not None and points < (2 if mode == DOWNSAMPLE_MINMAX else 1)):
+            raise ValueError("Too small downsampling factor or points (%s, %s)" % (factor, points))
+        self.mode = mode
+        self.factor = factor
+        self.points = points
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(cfg.get("mode", DOWNSAMPLE_MEAN), cfg.get("factor"), cfg.get("points"))
+
+    def block(self, size):
+        if self.factor is not None:
+            return self.factor
+        blocks = self.points//2 if self.mode == DOWNSAMPLE_MINMAX else self.points
+        return max(1, -(-size//blocks))
+
+    def __call__(self, value):
+        array = np.asarray(value)
+        if array.ndim != 1:
+            return value
+        size = len(array)
+        block = self.block(size)
+        if block == 1 and self.mode != DOWNSAMPLE_MINMAX:
+            return array
+        if self.mode == DOWNSAMPLE_STRIDE:
+            return array[::block]
+        starts = np.arange(0, size, block)
+        if self.mode == DOWNSAMPLE_MINMAX:
+            out = np.empty(2*len(starts), array.dtype)
+            out[0::2] = np.minimum.reduceat(array, starts)
+            out[1::2] = np.maximum.reduceat(array, starts)
+            return out
+        sums = np.add.reduceat(array, starts, dtype=np.float64)
+        means = sums/np.diff(np.append(starts, size))
+        if array.dtype.kind in "iu":
+            return np.rint(means).astype(array.dtype)
+        return means.astype(array.dtype)
+
+
+# Unittests
+def _accept(db, value):
+    if db.changed(value):
+        db.commit(value)
+        return True
+    return False
+
+class Test(unittest.TestCase):
+    def test_deadband(self):
+        now = [0.0]
+        db = Deadband(2, clock=lambda: now[0])
+        self.assertTrue(_accept(db, 10))
+        self.assertFalse(_accept(db, 11))
+        self.assertFalse(_accept(db, 8))
+        self.assertTrue(_accept(db, 13))
+        self.assertFalse(_accept(db, 11))
+        self.assertEqual(db.suppressed, 3)
+
+    def test_deadband_commit(self):
+        # value not published passes again
+        db = Deadband(2)
+        self.assertTrue(db.changed(10))
+        self.assertTrue(db.changed(10))
+        db.commit(10)
+        self.assertFalse(db.changed(11))
+
+    def test_deadband_refresh(self):
+        now = [0.0]
+        db = Deadband(2, refresh=10.0, clock=lambda: now[0])
+        self.assertTrue(_accept(db, 10))
+        now[0] = 5.0
+        self.assertFalse(_accept(db, 10))
+        now[0] = 10.0
+        self.assertTrue(_accept(db, 10))
+
+    def test_deadband_wf(self):
+        db = Deadband(0)
+        self.assertTrue(_accept(db, np.arange(4)))
+        self.assertFalse(_accept(db, np.arange(4)))
+        self.assertTrue(_accept(db, np.array([0, 1, 2, 4])))
+        self.assertTrue(_accept(db, np.arange(5)))
+
+    def test_deadband_int32(self):
+        # difference must not overflow
+        db = Deadband(1)
+        self.assertTrue(_accept(db, np.array([-0x80000000], dtype=np.int32)))
+        self.assertTrue(_accept(db, np.array([0x7FFFFFFF], dtype=np.int32)))
+
+    def test_decimation(self):
+        now = [0.0]
+        dec = Decimation(4, clock=lambda: now[0])
+        self.assertTrue(dec.due())
+        dec.sent()
+        now[0] = 0.2
+        self.assertFalse(dec.due())
+        # not sent (e.g. deadband), next one is still due
+        now[0] = 0.25
+        self.assertTrue(dec.due())
+        now[0] = 0.3
+        self.assertTrue(dec.due())
+        dec.sent()
+        now[0] = 0.5
+        self.assertFalse(dec.due())
+        self.assertEqual(dec.suppressed, 2)
+        with self.assertRaises(ValueError):
+            Decimation(0)
+
+    def test_downsample(self):
+        wf = np.array([1, 3, 2, 8, -4, 0, 7], dtype=np.int32)
+        mean = Downsample("mean", factor=2)(wf)
+        self.assertEqual((mean.dtype, list(mean)), (wf.dtype, [2, 5, -2, 7]))
+        self.assertEqual(list(Downsample("minmax", factor=3)(wf)), [1, 3, -4, 8, 7, 7])
+        self.assertEqual(list(Downsample("stride", factor=3)(wf)), [1, 8, 7])
+        self.assertEqual(list(Downsample("stride", factor=1)(wf)), list(wf))
+        self.assertTrue(np.allclose(Downsample("mean", factor=4)(wf.astype(float)), [3.5, 1.0]))
+        # scalars pass
+        self.assertEqual(Downsample("mean", factor=2)(5), 5)
+
+    def test_downsample_points(self):
+        wf = np.arange(1000)
+        self.assertEqual(len(Downsample("mean", points=300)(wf)), 250)
+        self.assertEqual(len(Downsample("minmax", points=300)(wf)), 286) # blocks of 7
+        self.assertEqual(len(Downsample("stride", points=2000)(wf)), 1000)
+        self.assertEqual(list(Downsample("minmax", points=2)(wf)), [0, 999])
+
+    def test_downsample_err(self):
+        with self.assertRaises(ValueError):
+            Downsample("median", factor=2)
+        with self.assertRaises(ValueError):
+            Downsample("mean")
+        with self.assertRaises(ValueError):
+            Downsample("mean", factor=2, points=10)
+        with self.assertRaises(ValueError):
+            Downsample("minmax", points=1)
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+    unittest.TextTestRunner(verbosity=2).run(suite)
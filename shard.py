@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+from threading import Lock
+import copy
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from metrics import MetricsServer, PREFIX, format_labels
+
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# predefined constants
+RESTART_DELAY = 1.0 # seconds, doubled on each quick crash
+RESTART_DELAY_MAX = 30.0 # seconds, also uptime after which worker is considered healthy
+SCRAPE_TIMEOUT = 2.0 # seconds
+POLL = 0.5 # seconds between worker checks
+
+
+# Sharding
+#   connections are spread over shards by a stable hash of their PV name
+#   or MQTT topic ('by'), optionally of the first 'prefix' name components only,
+#   so related channels stay in one process
+def shard_key(connection, by="pv", prefix=None):
+    if by == "pv":
+        name, sep = connection["pv"], "_"
+        if isinstance(name, list):
+            # aggregate connection
+            name = name[0]
+    elif by == "mqtt":
+        name, sep = connection["mqtt"], "/"
+    else:
+        raise ValueError("Unknown shard key '%s'" % by)
+    if prefix:
+        name = sep.join(name.split(sep)[:prefix])
+    return name
+
+def shard_of(key, shards):
+    # zlib.crc32 is the same in all processes unlike hash()
+    return (zlib.crc32(key.encode("utf-8")) & 0xFFFFFFFF) % shards
+
+def split_config(config, shards):
+    by = config.get("shard_by", "pv")
+    prefix = config.get("shard_prefix")
+    configs = []
+    for i in range(shards):
+        cfg = copy.deepcopy(config)
+        for key in ["shards", "shard_by", "shard_prefix"]:
+            cfg.pop(key, None)
+        cfg["connections"] = []
+        metrics = cfg.get("metrics", {})
+        if "http_port" in metrics:
+            # supervisor serves the configured port, workers the following ones
+            metrics["http_port"] = metrics["http_port"] + 1 + i
+            metrics["http_address"] = "127.0.0.1"
+        if "status_topic" in metrics:
+            metrics["status_topic"] = "%s/%d" % (metrics["status_topic"], i)
+        if "record" in cfg:
+            cfg["record"] = "%s.%d" % (cfg["record"], i)
+        configs.append(cfg)
+    for connection in config["connections"]:
+        configs[shard_of(shard_key(connection, by, prefix), shards)]["connections"].append(connection)
+    return configs
+
+# joins Prometheus texts of workers adding 'shard' label to each sample
+def merge_metrics(texts):
+    families = OrderedDict() # name -> [help and type lines, samples]
+    for shard, text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                family = families.setdefault(line.split(" ", 3)[2], [[], []])
+                if line not in family[0]:
+                    family[0].append(line)
+                continue
+            name, value = line.rsplit(" ", 1)
+            label = format_labels([("shard", shard)])
+            if name.endswith("}"):
+                name = name[:-1] + "," + label[1:]
+            else:
+                name = name + label
+            if family is None:
+                family = families.setdefault(name.split("{", 1)[0], [[], []])
+            family[1].append("%s %s" % (name, value))
+    lines = []
+    for meta, samples in families.values():
+        lines.extend(meta)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# Shard worker
+#   one gateway process serving part of connections
+class Worker:
+    def __init__(self, shard, config_path, port=None):
+        self.shard = shard
+        self.config_path = config_path
+        self.port = port # worker metrics port
+        self.proc = None
+        self.started = None
+        self.delay = RESTART_DELAY
+        self.next_start = 0.0
+        self.restarts = 0
+
+    def command(self):
+        return [sys.executable, os.path.join(script_dir, "ca_mqtt_gw.py"), self.config_path]
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.command())
+        self.started = time.time()
+        logger.info("shard %d: started worker %d" % (self.shard, self.proc.pid))
+
+    def stop(self):
+        if self.alive():
+            self.proc.terminate()
+            self.proc.wait()
+
+    def scrape(self):
+        return urlopen("http://127.0.0.1:%d/metrics" % self.port, timeout=SCRAPE_TIMEOUT).read().decode("utf-8")
+
+
+# Shard supervisor
+#   runs a worker process for each shard and restarts crashed ones
+#   with growing delay, serves merged metrics of all workers
+class Supervisor:
+    def __init__(self, config, workdir=None):
+        shards = config["shards"]
+        if shards < 1:
+            raise ValueError("Number of shards must be at least 1 (%s given)" % shards)
+        self.workdir = workdir or tempfile.mkdtemp(prefix="ca_mqtt_gw_")
+        self.lock = Lock()
+        self.running = False
+        self.reload_pending = None # config set by SIGHUP handler, applied by run()
+        self.shards = shards
+        self.workers = []
+        for i, cfg in enumerate(self._write(config)):
+            self.workers.append(Worker(i, self._path(i), cfg.get("metrics", {}).get("http_port")))
+
+    def _path(self, shard):
+        return os.path.join(self.workdir, "shard_%d.json" % shard)
+
+    def _write(self, config):
+        cfgs = split_config(config, self.shards)
+        for i, cfg in enumerate(cfgs):
+            path = self._path(i)
+            with open(path + ".tmp", "w") as f:
+                json.dump(cfg, f, indent=4)
+            os.rename(path + ".tmp", path)
+            logger.info("shard %d: %d connections" % (i, len(cfg["connections"])))
+        return cfgs
+
+    # rewrites worker configs and makes workers reload them,
+    # connections stay in their shards, so only changed ones are touched
+    def reload(self, config):
+        if config.get("shards") != self.shards:
+            logger.error("Number of shards can't be changed without restart")
+            return
+        with self.lock:
+            self._write(config)
+            for worker in self.workers:
+                if worker.alive():
+                    worker.proc.send_signal(signal.SIGHUP)
+
+    # reloads config set by signal handler, which can't take the lock itself
+    # since it interrupts the main thread possibly holding it in check()
+    def apply_reload(self):
+        config, self.reload_pending = self.reload_pending, None
+        if config is not None:
+            self.reload(config)
+
+    # starts exited workers, returns number of them
+    def check(self):
+        count = 0
+        now = time.time()
+        with self.lock:
+            for worker in self.workers:
+                if worker.alive() or now < worker.next_start:
+                    continue
+                if worker.proc is not None:
+                    if worker.next_start == 0.0:
+                        # just found exited, schedule restart
+                        logger.error("shard %d: worker exited with code %s" % (worker.shard, worker.proc.returncode))
+                        if now - worker.started > RESTART_DELAY_MAX:
+                            worker.delay = RESTART_DELAY
+                        worker.next_start = now + worker.delay
+                        worker.delay = min(2*worker.delay, RESTART_DELAY_MAX)
+                        continue
+                    worker.restarts += 1
+                worker.next_start = 0.0
+                worker.start()
+                count += 1
+        return count
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                self.apply_reload()
+                self.check()
+                time.sleep(POLL)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def prometheus(self):
+        texts = []
+        for worker in self.workers:
+            if worker.port is None or not worker.alive():
+                continue
+            try:
+                texts.append((worker.shard, worker.scrape()))
+            except Exception as e:
+                logger.debug("shard %d: unable to get metrics: %s" % (worker.shard, str(e)))
+        lines = [
+            "# HELP %sshard_up Worker process is running" % PREFIX,
+            "# TYPE %sshard_up gauge" % PREFIX,
+        ]
+        for worker in self.workers:
+            lines.append("%sshard_up%s %d" % (PREFIX, format_labels([("shard", worker.shard)]), worker.alive()))
+        lines.append("# HELP %sshard_restarts_total Worker process restarts" % PREFIX)
+        lines.append("# TYPE %sshard_restarts_total counter" % PREFIX)
+        for worker in self.workers:
+            lines.append("%sshard_restarts_total%s %d" % (PREFIX, format_labels([("shard", worker.shard)]), worker.restarts))
+        return merge_metrics(texts) + "\n".join(lines) + "\n"
+
+
+# Unittests
+class _Worker(Worker):
+    def __init__(self, shard, code):
+        Worker.__init__(self, shard, None)
+        self.code = code
+
+    def command(self):
+        return [sys.executable, "-c", "import sys; sys.exit(%d)" % self.code]
+
+class Test(unittest.TestCase):
+    def _config(self):
+        return {
+            "shards": 3,
+            "connections": [{"pv": "DEV%d_X_%d" % (i//10, i), "mqtt": "dev/%d/x/%d" % (i//10, i)} for i in range(60)],
+            "metrics": {"http_port": 9000, "status_topic": "gw/status"},
+            "record": "traffic.rec",
+        }
+
+    def test_split(self):
+        cfgs = split_config(self._config(), 3)
+        self.assertEqual(sum(len(c["connections"]) for c in cfgs), 60)
+        self.assertTrue(all(c["connections"] for c in cfgs))
+        self.assertEqual([c["metrics"]["http_port"] for c in cfgs], [9001, 9002, 9003])
+        self.assertEqual(cfgs[2]["metrics"]["status_topic"], "gw/status/2")
+        self.assertEqual(cfgs[1]["record"], "traffic.rec.1")
+        self.assertNotIn("shards", cfgs[0])
+        # stable between runs
+        self.assertEqual(cfgs, split_config(self._config(), 3))
+
+    def test_split_prefix(self):
+        config = self._config()
+        config["shard_by"] = "mqtt"
+        config["shard_prefix"] = 2
+        for cfg in split_config(config, 3):
+            devs = set(c["mqtt"].split("/")[1] for c in cfg["connections"])
+            for dev in devs:
+                self.assertEqual(len([c for c in cfg["connections"] if c["mqtt"].split("/")[1] == dev]), 10)
+
+    def test_shard_key_aggregate(self):
+        self.assertEqual(shard_key({"pv": ["DEV1_X_1", "DEV1_Y_2"]}, "pv", 1), "DEV1")
+
+    def test_shard_key_err(self):
+        with self.assertRaises(ValueError):
+            shard_key({"pv": "A"}, "abc")
+
+    def test_merge(self):
+        a = "# HELP x_total X\n# TYPE x_total counter\nx_total{chan=\"a\"} 1\n# TYPE up gauge\nup 5.0\n"
+        b = "# HELP x_total X\n# TYPE x_total counter\nx_total{chan=\"b\"} 2\n# TYPE up gauge\nup 6.0\n"
+        self.assertEqual(merge_metrics([(0, a), (1, b)]), "\n".join([
+            "# HELP x_total X",
+            "# TYPE x_total counter",
+            "x_total{chan=\"a\",shard=\"0\"} 1",
+            "x_total{chan=\"b\",shard=\"1\"} 2",
+            "# TYPE up gauge",
+            "up{shard=\"0\"} 5.0",
+            "up{shard=\"1\"} 6.0",
+        ]) + "\n")
+
+    def test_reload(self):
+        sup = Supervisor(self._config())
+        try:
+            config = self._config()
+            config["connections"].append({"pv": "NEW_X", "mqtt": "new/x"})
+            sup.reload(config)
+            cfgs = []
+            for i in range(3):
+                with open(sup._path(i)) as f:
+                    cfgs.append(json.load(f))
+            self.assertEqual(sum(len(c["connections"]) for c in cfgs), 61)
+        finally:
+            sup.stop()
+
+    def test_reload_pending(self):
+        sup = Supervisor(self._config())
+        try:
+            config = self._config()
+            del config["connections"][0]
+            sup.reload_pending = config
+            sup.apply_reload()
+            self.assertIsNone(sup.reload_pending)
+            cfgs = []
+            for i in range(3):
+                with open(sup._path(i)) as f:
+                    cfgs.append(json.load(f))
+            self.assertEqual(sum(len(c["connections"]) for c in cfgs), 59)
+        finally:
+            sup.stop()
+
+    def test_restart(self):
+        config = self._config()
+        config["shards"] = 1
+        sup = Supervisor(config)
+        sup.workers = [_Worker(0, 1)]
+        logging.disable(logging.CRITICAL)
+        try:
+            sup.workers[0].delay = 0.0
+            self.assertEqual(sup.check(), 1)
+            sup.workers[0].proc.wait()
+            self.assertEqual(sup.check(), 0) # restart scheduled
+            self.assertEqual(sup.check(), 1)
+            self.assertEqual(sup.workers[0].restarts, 1)
+            self.assertIn("ca_mqtt_gw_shard_restarts_total{shard=\"0\"} 1\n", sup.prometheus())
+        finally:
+            logging.disable(logging.NOTSET)
+            sup.stop()
+        self.assertFalse(os.path.exists(sup.workdir))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # supervisor mode: shard.py gateway_config.json
+        logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+        with open(sys.argv[1]) as f:
+            config = json.load(f)
+        supervisor = Supervisor(config)
+        if "http_port" in config.get("metrics", {}):
+            MetricsServer(supervisor, config["metrics"]["http_port"], str(config["metrics"].get("http_address", "127.0.0.1"))).start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(supervisor, "running", False))
+        def reload(signum, frame):
+            try:
+                with open(sys.argv[1]) as f:
+                    supervisor.reload_pending = json.load(f)
+            except Exception as e:
+                logger.error("Unable to reload %s: %s" % (sys.argv[1], str(e)))
+        signal.signal(signal.SIGHUP, reload)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+        unittest.TextTestRunner(verbosity=2).run(suite)
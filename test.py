@@ -4,11 +4,26 @@ import unittest
 
 import wfaccum
 import mqttconv
+import mqttroute
+import pubpool
+import pubflow
+import pvfilter
+import metrics
+import putpipe
+import shard
+import connector
+import confdiff
+import asynclog
+import health
+import trafficlog
+import lvcache
+import aggregate
+import pvchan
 
 
 if __name__ == '__main__':
     suite = unittest.TestSuite()
-    for mod in [wfaccum, mqttconv]:
+    for mod in [wfaccum, mqttconv, mqttroute, pubpool, pubflow, pvfilter, metrics, putpipe, shard, connector, confdiff, asynclog, health, trafficlog, lvcache, aggregate, pvchan]:
         suite.addTest(unittest.TestLoader().loadTestsFromModule(mod))
     runner = unittest.TextTestRunner(verbosity=2)
     result = runner.run(suite)
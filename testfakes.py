@@ -0,0 +1,74 @@
+# Test fakes
+#   stand-ins of MQTT client, publish pool and put pipe shared by unittests of the modules
+
+
+# Result of publishing by the client
+class Info:
+    def __init__(self, mid=0, rc=0, published=True):
+        self.mid = mid
+        self.rc = rc
+        self.published = published
+
+    def is_published(self):
+        return self.published
+
+# MQTT client
+#   records subscriptions and published messages with their results,
+#   publishing raises if 'fail' is set, messages stay in flight if 'hold' is set
+#   until a test marks them published
+class Client:
+    def __init__(self, fail=False, rc=0, hold=False):
+        self.fail = fail
+        self.rc = rc
+        self.hold = hold
+        self.subs = []
+        self.pubs = []
+        self.infos = []
+
+    def subscribe(self, topic, qos=0):
+        self.subs.append(topic)
+
+    def unsubscribe(self, topic):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.fail:
+            raise RuntimeError("test")
+        info = Info(len(self.infos), self.rc, not self.hold)
+        self.pubs.append((topic, payload))
+        self.infos.append(info)
+        return info
+
+# Publish pool
+#   handles items at once in the caller thread
+class Pool:
+    def queue(self, handler, policy, size, priority=0, batch=None):
+        return Queue(handler)
+
+class Queue:
+    def __init__(self, handler):
+        self.handler = handler
+        self.received = self.dropped = self.coalesced = 0
+
+    def put(self, item):
+        self.received += 1
+        self.handler(item)
+
+    def __len__(self):
+        return 0
+
+# CA put pipe
+#   records puts, a put to "FAIL" pv fails
+class PutPipe:
+    def __init__(self):
+        self.puts = []
+
+    def put(self, pv, value, callback):
+        self.puts.append((pv, value))
+        callback(pv != "FAIL")
+
+# makes channel of class 'cls' publishing with the fakes
+def make_chan(cls, connection, client=None, flow=None, putpipe=None, **kw):
+    from health import ServerHealth
+    from pubflow import FlowControl
+    return cls(connection, ServerHealth(), client or Client(), Pool(), flow or FlowControl(), putpipe, **kw)
@@ -0,0 +1,432 @@
+#!/usr/bin/python
+
+from threading import Lock
+import argparse
+import importlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+import mqttconv
+from mqttroute import TopicRouter
+from pvchan import CONV_CFG, CONV_CHAN_KEYS, subTopic, unicodeToStr
+from aggregate import AggregateConv, AggregateState
+
+import unittest
+
+
+# Traffic log file
+#   header (FILE_HEADER) is followed by records appended in arrival order,
+#   record is RECORD_HEADER, name (PV or topic) and payload;
+#   time is seconds since the start of recording, never decreasing;
+#   MQTT payload is written as received, CA value as (ndim: uint8,
+#   dtype length: uint8, numpy dtype string, data), see encode_value
+FILE_MAGIC = b"CAMQTRF1"
+FILE_HEADER = ">8sd" # magic, start time
+FILE_SIZE = struct.calcsize(FILE_HEADER)
+RECORD_HEADER = ">BdHI" # kind, time, name length, payload length
+RECORD_SIZE = struct.calcsize(RECORD_HEADER)
+
+# record kinds
+CA = 1 # PV update received by pm channel
+MQTT = 2 # message received from broker
+
+WRITE_BUFFER = 2**16 # bytes
+
+
+def _bytes(name):
+    if isinstance(name, bytes):
+        return name
+    return name.encode("utf-8")
+
+def _str(data):
+    if str is bytes:
+        return data
+    return data.decode("utf-8")
+
+def encode_value(value):
+    array = np.asarray(value)
+    if array.ndim > 1:
+        array = array.ravel()
+    dtype = _bytes(array.dtype.str)
+    return struct.pack(">BB", array.ndim, len(dtype)) + dtype + array.tobytes()
+
+# returns python scalar or read-only numpy array
+def decode_value(payload):
+    ndim, size = struct.unpack_from(">BB", payload)
+    dtype = np.dtype(_str(payload[2:2 + size]))
+    if len(payload) == 2 + size:
+        array = np.zeros(0, dtype)
+    else:
+        array = np.frombuffer(payload, dtype, offset=2 + size)
+    if ndim == 0:
+        return array[0].item()
+    return array
+
+
+# Traffic recorder
+#   appends CA updates and MQTT messages to a traffic log,
+#   called from CA and MQTT threads
+class TrafficRecorder:
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        self.lock = Lock()
+        self.start = clock()
+        self.last = 0.0
+        self.file = open(path, "wb", WRITE_BUFFER)
+        self.file.write(struct.pack(FILE_HEADER, FILE_MAGIC, self.start))
+
+        # counters
+        self.records = 0
+        self.bytes = FILE_SIZE
+
+    def _write(self, kind, name, payload):
+        name = _bytes(name)
+        with self.lock:
+            if self.file is None:
+                return
+            self.last = max(self.last, self.clock() - self.start)
+            self.file.write(struct.pack(RECORD_HEADER, kind, self.last, len(name), len(payload)))
+            self.file.write(name)
+            self.file.write(payload)
+            self.records += 1
+            self.bytes += RECORD_SIZE + len(name) + len(payload)
+
+    def ca(self, pv, value):
+        self._write(CA, pv, encode_value(value))
+
+    def mqtt(self, topic, payload):
+        self._write(MQTT, topic, payload)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Traffic log reader
+#   memory-maps the log, iteration gives (kind, time, name, payload),
+#   a record cut by a crash of the recording process ends the log
+class TrafficLog:
+    def __init__(self, path):
+        if os.path.getsize(path) < FILE_SIZE:
+            raise ValueError("%s is not a traffic log" % path)
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.start = struct.unpack_from(FILE_HEADER, self.map)
+        if magic != FILE_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a traffic log" % path)
+        self.truncated = False
+
+    def __iter__(self):
+        data = self.map
+        end = len(data)
+        pos = FILE_SIZE
+        while pos + RECORD_SIZE <= end:
+            kind, t, nsize, psize = struct.unpack_from(RECORD_HEADER, data, pos)
+            name = pos + RECORD_SIZE
+            payload = name + nsize
+            if payload + psize > end:
+                break
+            pos = payload + psize
+            yield kind, t, _str(data[name:payload]), data[payload:pos]
+        self.truncated = pos != end
+
+    def close(self):
+        self.map.close()
+
+
+# yields records of the log paced to their recorded times divided by 'speed',
+# speed 0 yields them as fast as possible
+def replay(records, speed=1.0, sleep=time.sleep, clock=time.time):
+    start = clock()
+    for record in records:
+        if speed:
+            left = record[1]/speed - (clock() - start)
+            if left > 0:
+                sleep(left)
+        yield record
+
+
+# Traffic replayer
+#   feeds CA updates to encoders of pm connections (publishing the messages
+#   to 'client' through 'flow' if given) and MQTT messages to decoders
+#   of mp connections, so waveforms are reassembled by WfAccum
+class Replayer:
+    def __init__(self, connections, client=None, flow=None, convcfg=CONV_CFG):
+        self.client = client
+        self.flow = flow
+        self.pvs = {} # pv -> [(topic, conv, aggregate state, item index), ...]
+        self.router = TopicRouter()
+        for connection in connections:
+            cfg = dict(convcfg)
+            for key in CONV_CHAN_KEYS:
+                if key in connection:
+                    cfg[key] = connection[key]
+            datatype = None
+            if "datatype" in connection:
+                datatype = unicodeToStr(connection["datatype"])
+            if isinstance(connection["pv"], list):
+                conv = AggregateConv(datatype or "int", len(connection["pv"]))
+                state = AggregateState(conv)
+                pvs = connection["pv"]
+            else:
+                conv = mqttconv.get(datatype, cfg)
+                state = None
+                pvs = [connection["pv"]]
+            chan = unicodeToStr(connection["mqtt"])
+            if unicodeToStr(connection["direction"]) == "pm":
+                for index, pv in enumerate(pvs):
+                    self.pvs.setdefault(unicodeToStr(pv), []).append((chan, conv, state, index))
+            else:
+                self.router.add(subTopic(chan, conv), conv)
+
+        # counters
+        self.records = 0
+        self.bytes = 0
+        self.values = 0 # values encoded or completely decoded
+        self.messages = 0 # messages encoded
+        self.unrouted = 0 # records of PVs and topics without connection
+        self.errors = 0
+
+    def _publish(self, topic, payload):
+        if self.flow is not None:
+            self.flow.publish(self.client, topic, payload)
+        else:
+            self.client.publish(topic, payload)
+
+    def feed(self, kind, name, payload):
+        self.records += 1
+        self.bytes += len(payload)
+        try:
+            if kind == CA:
+                targets = self.pvs.get(name)
+                if not targets:
+                    self.unrouted += 1
+                    return
+                value = decode_value(payload)
+                for chan, conv, state, index in targets:
+                    out = value
+                    if state is not None:
+                        # aggregate frame of each update, replay has no ticks
+                        state.update(index, value)
+                        out = state.frame()[1]
+                    for topic, msg in conv.encode(chan, out):
+                        self.messages += 1
+                        if self.client is not None:
+                            self._publish(topic, msg)
+                    self.values += 1
+            else:
+                conv = self.router.get(name)
+                if conv is None:
+                    self.unrouted += 1
+                    return
+                if conv.decode(name, payload) is not None:
+                    self.values += 1
+        except Exception:
+            self.errors += 1
+
+    def run(self, records):
+        for kind, t, name, payload in records:
+            self.feed(kind, name, payload)
+
+
+# Unittests
+class Test(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp(suffix=".rec")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _wfconn(self, direction, **kw):
+        conn = {"mqtt": u"t/wf/", "pv": u"WF", "direction": direction, "datatype": u"wfint"}
+        conn.update(kw)
+        return conn
+
+    def test_value(self):
+        for value in [5, -7.25, "abc", "", np.arange(10, dtype=np.int32), np.zeros(0, ">f8")]:
+            back = decode_value(encode_value(value))
+            if isinstance(value, np.ndarray):
+                self.assertEqual(back.dtype, value.dtype)
+                self.assertTrue(np.array_equal(back, value))
+            else:
+                self.assertEqual((type(back), back), (type(value), value))
+
+    def test_log(self):
+        now = [100.0]
+        rec = TrafficRecorder(self.path, clock=lambda: now[0])
+        now[0] = 100.5
+        rec.ca("PV1", 3)
+        now[0] = 100.25 # clock stepped back
+        rec.mqtt("t/1", b"\x00\x01")
+        now[0] = 101.0
+        rec.ca("WF", np.arange(4, dtype=np.int16))
+        rec.close()
+        rec.mqtt("t/1", b"lost")
+        self.assertEqual(rec.records, 3)
+        self.assertEqual(rec.bytes, os.path.getsize(self.path))
+
+        log = TrafficLog(self.path)
+        records = list(log)
+        log.close()
+        self.assertEqual(log.start, 100.0)
+        self.assertFalse(log.truncated)
+        self.assertEqual([(k, t, n) for k, t, n, p in records], [(CA, 0.5, "PV1"), (MQTT, 0.5, "t/1"), (CA, 1.0, "WF")])
+        self.assertEqual(records[1][3], b"\x00\x01")
+        self.assertTrue(np.array_equal(decode_value(records[2][3]), [0, 1, 2, 3]))
+
+    def test_truncated(self):
+        rec = TrafficRecorder(self.path)
+        rec.mqtt("t/1", b"x"*10)
+        rec.mqtt("t/2", b"y"*10)
+        rec.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        log = TrafficLog(self.path)
+        self.assertEqual([n for k, t, n, p in log], ["t/1"])
+        self.assertTrue(log.truncated)
+        log.close()
+
+    def test_not_log(self):
+        with open(self.path, "wb") as f:
+            f.write(b"x"*100)
+        with self.assertRaises(ValueError):
+            TrafficLog(self.path)
+
+    def test_replay_speed(self):
+        now = [0.0]
+        slept = []
+        def sleep(t):
+            slept.append(t)
+            now[0] += t
+        records = [(MQTT, t, "t", b"") for t in [0.0, 1.0, 1.0, 3.0]]
+        self.assertEqual(len(list(replay(records, 2.0, sleep, lambda: now[0]))), 4)
+        self.assertEqual(slept, [0.5, 1.0])
+        self.assertEqual(len(list(replay(records, 0, sleep, lambda: now[0]))), 4)
+        self.assertEqual(len(slept), 2)
+
+    def test_replayer(self):
+        cfg = dict(CONV_CFG, segment_size_max=64)
+        value = np.arange(100, dtype=np.int32)
+        tx = mqttconv.get("wfint", cfg)
+        rec = TrafficRecorder(self.path)
+        rec.ca("WF", value)
+        rec.ca("OTHER", 1)
+        for topic, payload in tx.encode("t/wf/", value):
+            rec.mqtt(topic, payload.tobytes())
+        rec.mqtt("t/other", b"")
+        rec.close()
+
+        published = []
+        class Client:
+            def publish(self, topic, payload):
+                published.append(topic)
+        log = TrafficLog(self.path)
+        rp = Replayer([self._wfconn(u"pm"), self._wfconn(u"mp")], Client(), convcfg=cfg)
+        rp.run(replay(log, 0))
+        log.close()
+        segs = len(tx.encode("t/wf/", value))
+        self.assertEqual(published, ["t/wf/%03d" % i for i in range(segs)])
+        self.assertEqual((rp.records, rp.values, rp.messages, rp.unrouted, rp.errors), (segs + 3, 2, segs, 2, 0))
+
+    def test_replayer_aggregate(self):
+        conn = {"mqtt": u"t/agg", "pv": [u"A", u"B"], "direction": u"pm"}
+        rec = TrafficRecorder(self.path)
+        rec.ca("A", 1)
+        rec.ca("B", 2)
+        frame = (np.array([1, 2]), np.ones(2, bool), np.ones(2, bool))
+        (topic, payload), = AggregateConv("int", 2).encode("t/agg", frame)
+        rec.mqtt(topic, bytes(payload))
+        rec.close()
+        log = TrafficLog(self.path)
+        rp = Replayer([conn, dict(conn, direction=u"mp")])
+        rp.run(log)
+        log.close()
+        self.assertEqual((rp.records, rp.values, rp.messages, rp.errors), (3, 3, 2, 0))
+
+    def test_replayer_mixed(self):
+        # PV of an aggregate and of a plain connection
+        conns = [
+            {"mqtt": u"t/agg", "pv": [u"A", u"B"], "direction": u"pm"},
+            {"mqtt": u"t/a", "pv": u"A", "direction": u"pm", "datatype": u"int"},
+        ]
+        rec = TrafficRecorder(self.path)
+        rec.ca("A", 7)
+        rec.close()
+        published = []
+        class Client:
+            def publish(self, topic, payload):
+                published.append((topic, bytes(payload)))
+        log = TrafficLog(self.path)
+        Replayer(conns, Client()).run(log)
+        log.close()
+        self.assertEqual(published[1], ("t/a", mqttconv.get("int", CONV_CFG).encode("t/a", 7)[0][1]))
+        items, updated = AggregateConv("int", 2).decode(*published[0])
+        self.assertEqual(list(items), [7, 0])
+
+# replays a log through connections of the config, prints results like bench.py
+def main(argv):
+    from bench import LinkClient, record, print_records
+    from pubflow import FlowControl
+
+    parser = argparse.ArgumentParser(description="CA-MQTT gateway traffic replay")
+    parser.add_argument("log", help="traffic log written with \"record\" config option")
+    parser.add_argument("config", nargs="?", default=os.path.join(os.path.dirname(__file__), "gateway_config.json"))
+    parser.add_argument("--speed", type=float, default=0, help="times recorded speed, 0 for maximum (default)")
+    parser.add_argument("--link", type=float, help="publish pm messages to broker stand-in with this bandwidth, MB/s")
+    parser.add_argument("--json", help="write results to file")
+    parser.add_argument("--compare", help="compare with results written by a previous run")
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    for module in config.get("codec_modules", []):
+        importlib.import_module(unicodeToStr(module))
+    client = flow = None
+    if args.link:
+        client = LinkClient(args.link*1e6, 0.0005, log=True)
+        flow = FlowControl(window=32)
+    replayer = Replayer(config["connections"], client, flow)
+    log = TrafficLog(args.log)
+    start = time.time()
+    replayer.run(replay(log, args.speed))
+    if flow is not None:
+        flow.flush()
+    end = time.time()
+    if client is not None and client.log:
+        end = max(end, max(t for _, _, t in client.log))
+    if log.truncated:
+        print("%s: last record is truncated" % args.log)
+    log.close()
+
+    elapsed = end - start
+    records = [record(
+        "replay", "%s, speed %s" % (os.path.basename(args.log), args.speed or "max"),
+        records_s=replayer.records/elapsed, mb_s=replayer.bytes/1e6/elapsed, values_s=replayer.values/elapsed,
+        messages=replayer.messages, unrouted=replayer.unrouted, errors=replayer.errors,
+    )]
+    base = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+    print_records(records, base)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(records, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        suite = unittest.TestLoader().loadTestsFromTestCase(Test)
+        unittest.TextTestRunner(verbosity=2).run(suite)
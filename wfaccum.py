@@ -1,73 +1,340 @@
 import numpy as np
+from threading import Lock
+from bisect import bisect_right
+import time
 
 import unittest
 
 
+# predefined constants
+RESTART_SEGMENTS = 3 # consecutive segments far behind the newest id treated as sender restart
+
 # Waveform concatenator
-#   joins segments of one waveform
+#   joins segments of one waveform in place
+#   the whole waveform buffer is allocated when the first segment arrives,
+#   segments are converted directly into their slots as soon as
+#   all previous segments are received, out-of-order ones wait until then
 class WfCat:
     def __init__(self, size):
         self.size = size
-        self.segs = {}
+        self.data = None
+        self.mask = 0 # bitmap of received segment indices
+        self.next = 0 # index of the first segment not written to data
+        self.pos = 0 # data offset of this segment
+        self.pending = {} # out-of-order segments
         self.dc = 0 # data counter
+        self.starts = [] # sorted offsets of segments written by add_at
+        self.ends = [] # their ends
+
+    def _write(self, seg):
+        self.data[self.pos:self.pos + len(seg)] = seg
+        self.pos += len(seg)
+        self.next += 1
 
     def add(self, idx, seg):
         if len(seg) <= 0:
             raise ValueError("Segment must have length > 0")
 
+        if (self.mask >> idx) & 1:
+            raise ValueError("Duplicate segment with index %d" % idx)
+
         if self.dc + len(seg) > self.size:
             raise ValueError("Total length of segments (%d) larger than waveform size (%d)" % (self.dc, self.size))
 
-        self.segs[idx] = seg
+        if self.data is None:
+            self.data = np.empty(self.size, dtype=seg.dtype.newbyteorder("="))
+
+        self.mask |= 1 << idx
         self.dc += len(seg)
+        if idx == self.next:
+            self._write(seg)
+            while self.next in self.pending:
+                self._write(self.pending.pop(self.next))
+        else:
+            self.pending[idx] = seg
+
         if self.dc == self.size:
             return True
         else:
             return False
 
+    # writes segment with known element offset directly to its place
+    def add_at(self, idx, offset, seg):
+        if len(seg) <= 0:
+            raise ValueError("Segment must have length > 0")
+        if (self.mask >> idx) & 1:
+            raise ValueError("Duplicate segment with index %d" % idx)
+        if offset < 0 or offset + len(seg) > self.size:
+            raise ValueError("Segment [%d, %d) is out of waveform size (%d)" % (offset, offset + len(seg), self.size))
+
+        # overlapping segments would leave parts of the buffer unwritten when counter is full
+        end = offset + len(seg)
+        i = bisect_right(self.starts, offset)
+        if (i > 0 and self.ends[i - 1] > offset) or (i < len(self.starts) and self.starts[i] < end):
+            raise ValueError("Segment [%d, %d) overlaps received ones" % (offset, end))
+
+        if self.data is None:
+            self.data = np.empty(self.size, dtype=seg.dtype.newbyteorder("="))
+        self.mask |= 1 << idx
+        self.starts.insert(i, offset)
+        self.ends.insert(i, end)
+        self.data[offset:end] = seg
+        self.dc += len(seg)
+        return self.dc == self.size
+
     def join(self):
         if self.dc != self.size:
             raise ValueError("Total length of segments (%d) is not equal waveform size (%d)" % (self.dc, self.size))
-        seqlen = max(self.segs.keys()) + 1
-        seq = []
-        for i in range(seqlen):
-            if i not in self.segs:
-                raise IndexError("Segments must have continuous indexing (missing index %s of %s)" % (i, seqlen))
-            seq.append(self.segs[i])
-        return np.concatenate(seq)
+        if self.pending:
+            seqlen = max(self.pending.keys()) + 1
+            raise IndexError("Segments must have continuous indexing (missing index %s of %s)" % (self.next, seqlen))
+        return self.data
+
+
+# Waveform patch
+#   changed parts of a waveform with explicit offsets,
+#   applied to a copy of the previous complete waveform
+class WfPatch:
+    def __init__(self, size, base, count):
+        if count <= 0:
+            raise ValueError("Patch must have at least one segment (%d given)" % count)
+        self.size = size
+        self.base = base # id of patched waveform
+        self.count = count # number of segments
+        self.mask = 0 # bitmap of received segment indices
+        self.segs = []
+
+    def add(self, idx, offset, seg):
+        if len(seg) <= 0:
+            raise ValueError("Segment must have length > 0")
+        if idx < 0 or idx >= self.count:
+            raise IndexError("Patch segment index %d out of range (%d segments)" % (idx, self.count))
+        if (self.mask >> idx) & 1:
+            raise ValueError("Duplicate segment with index %d" % idx)
+        if offset < 0 or offset + len(seg) > self.size:
+            raise ValueError("Patch segment [%d, %d) is out of waveform size (%d)" % (offset, offset + len(seg), self.size))
+        self.mask |= 1 << idx
+        self.segs.append((offset, seg))
+        return len(self.segs) == self.count
+
+    def apply(self, wf):
+        wf = wf.copy()
+        for offset, seg in self.segs:
+            wf[offset:offset + len(seg)] = seg
+        return wf
+
+
+# Waveform id difference
+#   waveform ids are int32 counters that wrap around
+def wfid_diff(a, b):
+    return ((a - b + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+# Waveform byte budget
+#   limits memory of incomplete waveforms shared by several accumulators
+class WfBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = Lock()
+
+    def take(self, n):
+        with self.lock:
+            if self.used + n > self.limit:
+                return False
+            self.used += n
+            return True
+
+    def give(self, n):
+        with self.lock:
+            self.used -= n
 
 
 # Waveform accumulator
 #   collects different wavefrom segments, drops outdated waveforms
 #   returns waveform when it is complete
+#   incomplete waveforms are kept in a ring of slots indexed by waveform id,
+#   only ids not older than 'wfdd' from the newest one are accepted
 class WfAccum:
-    def __init__(self, wfdd):
+    def __init__(self, wfdd, budget=None, shared=None, clock=time.time):
         self.wfdd = wfdd # waveform id drop distance
-        self.wfs = {}
+        self.window = 1 # power of two, so slot indexing is continuous over id wraparound
+        while self.window < wfdd + 1:
+            self.window *= 2
+        self.slots = [None]*self.window # [wfid, cat, nbytes, time of first segment]
+        self.resync = 4*self.window # forward id distance treated as loss of sync
+
+        self.budget = budget # max bytes of incomplete waveforms of this accumulator
+        self.shared = shared # WfBudget shared with other accumulators
+        self.used = 0
+
+        self.last = None # newest waveform id
+        self.done = None # id of the last completed waveform
+        self.behind = 0 # consecutive segments beyond the window behind the newest id
+        self.wf = None # last complete waveform (wfid, array), base for patches
+        self.clock = clock
+        self.assembly = None # seconds from first to last segment of the last completed waveform
+
+        # counters
+        self.evicted = 0 # incomplete waveforms dropped
+        self.stale = 0 # segments of outdated waveforms ignored
+        self.rejected = 0 # waveforms not fitting into budget
+        self.resets = 0
+        self.unbased = 0 # patches whose base waveform was not received
+
+    def _evict(self, i):
+        slot = self.slots[i]
+        self.slots[i] = None
+        self._free(slot[2])
+        self.evicted += 1
+
+    def _free(self, nbytes):
+        self.used -= nbytes
+        if self.shared is not None:
+            self.shared.give(nbytes)
+
+    def _evict_oldest(self):
+        oldest = None
+        for i, slot in enumerate(self.slots):
+            if slot is not None and (oldest is None or wfid_diff(slot[0], self.slots[oldest][0]) < 0):
+                oldest = i
+        if oldest is None:
+            return False
+        self._evict(oldest)
+        return True
+
+    def _alloc(self, nbytes):
+        if self.budget is not None:
+            if nbytes > self.budget:
+                self.rejected += 1
+                raise ValueError("Waveform of %d bytes exceeds budget of %d bytes" % (nbytes, self.budget))
+            while self.used + nbytes > self.budget:
+                self._evict_oldest()
+        if self.shared is not None:
+            while not self.shared.take(nbytes):
+                if not self._evict_oldest():
+                    self.rejected += 1
+                    raise ValueError("Waveform of %d bytes exceeds shared budget" % nbytes)
+        self.used += nbytes
+
+    def reset(self):
+        for i in range(self.window):
+            if self.slots[i] is not None:
+                self._evict(i)
+        self.last = None
+        self.done = None
+        self.behind = 0
+        self.wf = None
+
+    # checks waveform id, moves the window, returns False for outdated waveforms
+    def _admit(self, wfid):
+        if self.last is not None:
+            d = wfid_diff(wfid, self.last)
+            if -self.resync <= d < -self.window:
+                # late duplicate or, if it repeats, restarted sender
+                self.behind += 1
+                if self.behind < RESTART_SEGMENTS:
+                    self.stale += 1
+                    return False
+            else:
+                self.behind = 0
+            if d < -self.window or d > self.resync:
+                # sender restarted or we lost too many waveforms
+                self.reset()
+                self.resets += 1
+        if self.last is None:
+            self.last = wfid
+
+        d = wfid_diff(wfid, self.last)
+        if d > 0:
+            # remove waveforms leaving the window
+            for j in range(min(d, self.window)):
+                old = wfid - self.wfdd - 1 - j
+                i = old & (self.window - 1)
+                if self.slots[i] is not None and wfid_diff(self.slots[i][0], old) == 0:
+                    self._evict(i)
+            self.last = wfid
+        elif d < -self.wfdd:
+            self.stale += 1
+            return False
+        if self.done is not None and wfid_diff(wfid, self.done) <= 0:
+            self.stale += 1
+            return False
+        return True
+
+    def _slot(self, wfid):
+        i = wfid & (self.window - 1)
+        slot = self.slots[i]
+        if slot is not None and slot[0] != wfid:
+            self._evict(i)
+            slot = None
+        return i, slot
 
-    def push(self, wfid, idx, size, array):
-        # remove distant incomplete waveforms
-        for key in list(self.wfs.keys()):
-            d = key - wfid
-            if d > 2*self.wfdd or d < -self.wfdd:
-                del self.wfs[key]
+    def _complete(self, i, wfid):
+        self.assembly = self.clock() - self.slots[i][3]
+        self._free(self.slots[i][2])
+        self.slots[i] = None
+        self.done = wfid
+        # remove previous incomplete waveforms
+        for j in range(1, self.window):
+            k = (wfid - j) & (self.window - 1)
+            if self.slots[k] is not None and wfid_diff(self.slots[k][0], wfid) < 0:
+                self._evict(k)
 
-        if wfid in self.wfs:
-            cat = self.wfs[wfid]
+    # 'offset' is element offset of the segment if known
+    def push(self, wfid, idx, size, array, offset=None):
+        if not self._admit(wfid):
+            return None
+
+        i, slot = self._slot(wfid)
+        if slot is not None:
+            cat = slot[1]
+            if not isinstance(cat, WfCat):
+                raise ValueError("Full and patch segments of the same waveform mixed")
             if cat.size != size:
                 raise ValueError("Total size of segments of the same waveform mismatch (%d != %d)" % (cat.size, size))
         else:
+            if size <= 0:
+                raise ValueError("Waveform size must be > 0 (%d given)" % size)
+            nbytes = size*array.dtype.itemsize
+            self._alloc(nbytes)
             cat = WfCat(size)
-            self.wfs[wfid] = cat
-        
-        if cat.add(idx, array):
+            self.slots[i] = [wfid, cat, nbytes, self.clock()]
+
+        if cat.add(idx, array) if offset is None else cat.add_at(idx, offset, array):
             # waveform completed
-            wf = cat.join()
-            # remove previous incomplete waveforms
-            for key in list(self.wfs.keys()):
-                if key < wfid:
-                    del self.wfs[key]
-            return (wfid, wf)
+            self._complete(i, wfid)
+            self.wf = (wfid, cat.join())
+            return self.wf
+        return None
+
+    # collects segments of a patch to the waveform 'base',
+    # returns patched waveform when all 'count' segments received
+    def push_patch(self, wfid, idx, size, base, count, offset, array):
+        if not self._admit(wfid):
+            return None
+
+        i, slot = self._slot(wfid)
+        if slot is not None:
+            patch = slot[1]
+            if not isinstance(patch, WfPatch):
+                raise ValueError("Full and patch segments of the same waveform mixed")
+            if (patch.size, patch.base, patch.count) != (size, base, count):
+                raise ValueError("Header of patch segments of the same waveform mismatch")
+        else:
+            if size <= 0:
+                raise ValueError("Waveform size must be > 0 (%d given)" % size)
+            patch = WfPatch(size, base, count)
+            self.slots[i] = [wfid, patch, 0, self.clock()] # segments are kept as payload views
+
+        if patch.add(idx, offset, array):
+            self._complete(i, wfid)
+            if self.wf is None or wfid_diff(self.wf[0], base) != 0 or len(self.wf[1]) != size:
+                # base waveform is lost, wait for full one
+                self.unbased += 1
+                return None
+            self.wf = (wfid, patch.apply(self.wf[1]))
+            return self.wf
         return None
 
 # Waveform compare
@@ -125,6 +392,27 @@ class Test(unittest.TestCase):
         with self.assertRaises(ValueError):
             cat.add(2, np.array([6]))
 
+    def test_wfcat_dup_err(self):
+        cat = WfCat(6)
+        self.assertFalse(cat.add(1, np.array([2, 3])))
+        with self.assertRaises(ValueError):
+            cat.add(1, np.array([2, 3]))
+        self.assertFalse(cat.add(0, np.array([0, 1])))
+        with self.assertRaises(ValueError):
+            cat.add(0, np.array([0, 1]))
+        self.assertTrue(cat.add(2, np.array([4, 5])))
+        self.assertTrue(np.array_equal(cat.join(), np.arange(6)))
+
+    def test_wfcat_swap(self):
+        # big-endian segments are converted into native buffer
+        cat = WfCat(4)
+        seg = np.frombuffer(np.array([2, 3]).astype(">i4").tobytes(), dtype=">i4")
+        self.assertFalse(cat.add(1, seg))
+        self.assertTrue(cat.add(0, np.array([0, 1], dtype=">i4")))
+        wf = cat.join()
+        self.assertTrue(wf.dtype.isnative)
+        self.assertTrue(np.array_equal(wf, np.arange(4)))
+
     def test_wfcat_idx_err(self):
         cat = WfCat(4)
         self.assertFalse(cat.add(0, np.array([0, 1])))
@@ -132,6 +420,16 @@ class Test(unittest.TestCase):
         with self.assertRaises(IndexError):
             cat.join()
 
+    def test_wfcat_overlap(self):
+        cat = WfCat(6)
+        self.assertFalse(cat.add_at(1, 2, np.array([2, 3])))
+        for idx, offset, seg in [(0, 1, [9, 9]), (2, 3, [9, 9, 9]), (3, 0, [9, 9, 9]), (4, 2, [9])]:
+            with self.assertRaises(ValueError):
+                cat.add_at(idx, offset, np.array(seg))
+        self.assertFalse(cat.add_at(0, 0, np.array([0, 1])))
+        self.assertTrue(cat.add_at(2, 4, np.array([4, 5])))
+        self.assertTrue(np.array_equal(cat.join(), np.arange(6)))
+
     def test_wfaccum(self):
         accum = WfAccum(2)
         self.assertIsNone(accum.push(1, 0, 6, np.array([0, 1])))
@@ -180,6 +478,141 @@ class Test(unittest.TestCase):
             (4, np.array([40, 41, 42, 43]))
         ))
 
+    def test_wfaccum_window(self):
+        accum = WfAccum(2)
+        self.assertIsNone(accum.push(1, 0, 4, np.array([10, 11])))
+        self.assertIsNone(accum.push(3, 0, 4, np.array([30, 31])))
+        self.assertEqual(accum.evicted, 0)
+        self.assertIsNone(accum.push(4, 0, 4, np.array([40, 41])))
+        self.assertEqual(accum.evicted, 1)
+        self.assertIsNone(accum.push(1, 1, 4, np.array([12, 13])))
+        self.assertEqual(accum.stale, 1)
+        self.assertIsNone(accum.push(2, 0, 4, np.array([20, 21])))
+        # 2, 3 and 4 leave the window
+        self.assertIsNone(accum.push(7, 0, 4, np.array([70, 71])))
+        self.assertEqual(accum.evicted, 4)
+        self.assertIsNone(accum.push(5, 0, 4, np.array([50, 51])))
+        self.assertTrue(wfcmp(
+            accum.push(7, 1, 4, np.array([72, 73])),
+            (7, np.array([70, 71, 72, 73]))
+        ))
+        self.assertEqual(accum.evicted, 5)
+        self.assertEqual(accum.used, 0)
+
+    def test_wfaccum_offset(self):
+        accum = WfAccum(2)
+        self.assertIsNone(accum.push(1, 2, 5, np.array([4]), 4))
+        self.assertIsNone(accum.push(1, 0, 5, np.array([0, 1]), 0))
+        self.assertTrue(wfcmp(
+            accum.push(1, 1, 5, np.array([2, 3]), 2),
+            (1, np.array([0, 1, 2, 3, 4]))
+        ))
+        with self.assertRaises(ValueError):
+            accum.push(2, 0, 5, np.array([0, 1]), 4)
+
+    def test_wfaccum_assembly(self):
+        now = [0.0]
+        accum = WfAccum(2, clock=lambda: now[0])
+        self.assertIsNone(accum.push(1, 0, 4, np.array([10, 11])))
+        now[0] = 0.5
+        self.assertIsNone(accum.push(2, 0, 4, np.array([20, 21])))
+        now[0] = 2.0
+        accum.push(2, 1, 4, np.array([22, 23]))
+        self.assertEqual(accum.assembly, 1.5)
+
+    def test_wfaccum_wrap(self):
+        accum = WfAccum(2)
+        imax = 0x7FFFFFFF
+        imin = -0x80000000
+        self.assertEqual(wfid_diff(imin, imax), 1)
+        self.assertIsNone(accum.push(imax, 0, 4, np.array([10, 11])))
+        self.assertIsNone(accum.push(imin, 0, 4, np.array([20, 21])))
+        self.assertTrue(wfcmp(
+            accum.push(imin, 1, 4, np.array([22, 23])),
+            (imin, np.array([20, 21, 22, 23]))
+        ))
+        # older than completed one
+        self.assertIsNone(accum.push(imax, 1, 4, np.array([12, 13])))
+        self.assertTrue(wfcmp(
+            accum.push(imin + 1, 0, 2, np.array([30, 31])),
+            (imin + 1, np.array([30, 31]))
+        ))
+
+    def test_wfaccum_resync(self):
+        accum = WfAccum(2)
+        self.assertTrue(wfcmp(accum.push(1000, 0, 2, np.array([0, 1])), (1000, np.array([0, 1]))))
+        # sender restarted
+        self.assertTrue(wfcmp(accum.push(0, 0, 2, np.array([2, 3])), (0, np.array([2, 3]))))
+        self.assertEqual(accum.resets, 1)
+        # restarted after a few waveforms
+        for wfid in range(1, 10):
+            accum.push(wfid, 0, 2, np.array([0, 1]))
+        for wfid in range(RESTART_SEGMENTS - 1):
+            self.assertIsNone(accum.push(wfid, 0, 2, np.array([4, 5])))
+        wfid = RESTART_SEGMENTS - 1
+        self.assertTrue(wfcmp(accum.push(wfid, 0, 2, np.array([4, 5])), (wfid, np.array([4, 5]))))
+        self.assertEqual((accum.resets, accum.stale), (2, RESTART_SEGMENTS - 1))
+
+    def test_wfaccum_late(self):
+        # late duplicate segment is dropped, waveform in progress survives
+        accum = WfAccum(2)
+        for wfid in range(10):
+            accum.push(wfid, 0, 2, np.array([0, 1]))
+        self.assertIsNone(accum.push(10, 0, 4, np.array([0, 1])))
+        self.assertIsNone(accum.push(3, 0, 2, np.array([0, 1])))
+        self.assertTrue(wfcmp(accum.push(10, 1, 4, np.array([2, 3])), (10, np.arange(4))))
+        self.assertEqual((accum.resets, accum.stale, accum.wf[0]), (0, 1, 10))
+
+    def test_wfaccum_budget(self):
+        accum = WfAccum(2, budget=4*4)
+        with self.assertRaises(ValueError):
+            accum.push(1, 0, 5, np.array([0, 1], dtype=np.int32))
+        self.assertEqual(accum.rejected, 1)
+        self.assertIsNone(accum.push(1, 0, 4, np.array([0, 1], dtype=np.int32)))
+        self.assertIsNone(accum.push(2, 0, 2, np.array([0], dtype=np.int32)))
+        self.assertEqual(accum.evicted, 1)
+        self.assertEqual(accum.used, 2*4)
+        with self.assertRaises(ValueError):
+            accum.push(3, 0, -1, np.array([0], dtype=np.int32))
+
+    def test_wfaccum_shared(self):
+        shared = WfBudget(6*4)
+        accum1 = WfAccum(2, shared=shared)
+        accum2 = WfAccum(2, shared=shared)
+        self.assertIsNone(accum1.push(1, 0, 4, np.array([0, 1], dtype=np.int32)))
+        with self.assertRaises(ValueError):
+            accum2.push(1, 0, 4, np.array([0, 1], dtype=np.int32))
+        self.assertEqual(accum2.rejected, 1)
+        self.assertIsNone(accum2.push(1, 0, 2, np.array([0], dtype=np.int32)))
+        self.assertEqual(shared.used, 6*4)
+        self.assertIsNotNone(accum1.push(1, 1, 4, np.array([2, 3], dtype=np.int32)))
+        self.assertEqual(shared.used, 2*4)
+
+    def test_wfaccum_patch(self):
+        accum = WfAccum(2)
+        self.assertTrue(wfcmp(accum.push(1, 0, 6, np.arange(6)), (1, np.arange(6))))
+        self.assertIsNone(accum.push_patch(2, 1, 6, 1, 2, 4, np.array([40, 50])))
+        self.assertTrue(wfcmp(
+            accum.push_patch(2, 0, 6, 1, 2, 0, np.array([0, 10])),
+            (2, np.array([0, 10, 2, 3, 40, 50]))
+        ))
+        # previous complete waveform is not changed
+        self.assertTrue(np.array_equal(accum.push_patch(3, 0, 6, 2, 1, 2, np.array([20]))[1], [0, 10, 20, 3, 40, 50]))
+        # patch to lost waveform
+        self.assertIsNone(accum.push_patch(5, 0, 6, 4, 1, 0, np.array([1])))
+        self.assertEqual(accum.unbased, 1)
+        self.assertTrue(wfcmp(accum.push(6, 0, 2, np.array([7, 8])), (6, np.array([7, 8]))))
+
+    def test_wfaccum_patch_err(self):
+        accum = WfAccum(2)
+        accum.push(1, 0, 4, np.arange(2))
+        with self.assertRaises(ValueError):
+            accum.push_patch(1, 0, 4, 0, 1, 0, np.arange(2))
+        with self.assertRaises(ValueError):
+            accum.push_patch(2, 0, 4, 1, 1, 3, np.arange(2))
+        with self.assertRaises(IndexError):
+            accum.push_patch(3, 1, 4, 1, 1, 0, np.arange(2))
+
     def test_wfaccum_size_err(self):
         accum = WfAccum(2)
         self.assertIsNone(accum.push(1, 0, 4, np.array([0, 1])))